@@ -9,23 +9,44 @@ File: audio_identification.py
 Description: Searches a fingerprint database for likely matches to a folder of
              query audio files.
 """
+from contextlib import ExitStack
+from functools import partial
+from multiprocessing import Pool
 import os
-import pickle
 import time
 
 import numpy as np
 
-from fingerprint_builder import extract_spectral_peaks, create_pairwise_hashes
+from fingerprint_builder import\
+    extract_spectral_peaks, create_pairwise_hashes, pair_hash_layout,\
+    check_feature_version
+from fingerprint_db import\
+    load_fingerprint_db, load_shard, find_postings, shard_numbers,\
+    doc_name
+from ground_truth import doc_matches_query
+from instrumentation import new_metrics, collect_metrics, stage_timer, count,\
+    merge_metrics, export_event, export_run_metrics
+import jit_kernels
+from jit_kernels import histogram_scores_kernel
 from print_status import print_status, enable_printing
 
+# number of best matching documents to report for each query
+N_GUESSES = 3
+
+# number of hashes looked up between checks for a clear winner when
+# identifying with early exit
+DEFAULT_EARLY_EXIT_CHUNK_SIZE = 256
+
 
 def get_query_hashes(
         query_file,
         peak_picking_options={},
-        pair_searching_options={}):
+        pair_searching_options={},
+        cache_options={},
+        decoding_options={}):
     """
-    Given the path of a query audio file, return a list of pairwise spectral
-    peak hashes present in the query.
+    Given the path of a query audio file, return an array of the packed
+    pairwise spectral peak hashes present in the query, with their offsets.
     
     Arguments:
         query_file {str} -- Path to query audio
@@ -35,133 +56,516 @@ def get_query_hashes(
                                        (default: {{}})
         pair_searching_options {dict} -- Optional dict of pair searching 
                                          options (default: {{}})
+        cache_options {dict} -- Optional dict of feature cache options, as
+                                taken by extract_spectral_peaks
+                                (default: {{}})
+        decoding_options {dict} -- Optional dict of audio decoding options,
+                                   as taken by extract_spectral_peaks
+                                   (default: {{}})
     """        
 
-    query_fingerprint =\
-        extract_spectral_peaks(query_file, peak_picking_options)
-    query_hashes =\
-        create_pairwise_hashes(query_fingerprint, **pair_searching_options)
+    query_fingerprint = extract_spectral_peaks(
+        query_file, peak_picking_options, cache_options, decoding_options)
+    with stage_timer("pairs"):
+        query_hashes =\
+            create_pairwise_hashes(query_fingerprint, **pair_searching_options)
 
     return query_hashes
 
 
-def find_potentially_matching_docs(query_hashes, doc_hashes):
+def gather_index_evidence(query_hashes, index):
     """
-    Given a list of hashes present in a query and a hash table linked hashes
-    to document IDs and time offsets, return all potentially matching documents
-    with a list of relevant hashes and the difference between their time
-    offsets in the query and document.
-    
+    Given the hashes present in a query and an index linking hashes to
+    document IDs and time offsets, gather every posting sharing a hash with
+    the query in one vectorised pass, along with the difference between its
+    time offset in the document and in the query.
+
     Arguments:
-        query_hashes {list} -- List of hashes present in the query
-        doc_hashes {dict} -- Hash table linking hashes to documents
-    
+        query_hashes {NumPy Array} -- Hashes and offsets present in the query
+        index {dict} -- Fingerprint index linking hashes to documents
+
     Returns:
-        dict -- Dictionary linking document IDs to lists of relevant hashes and
-                their offset time deltas.
-    """    
-
-    # initialise dict for docs sharing hashes with query
-    query_docs = {}
-    # iterate over query hashes
-    for hash in query_hashes:
-        # if we have seen this hash in our database
-        if hash["hash"] in doc_hashes:
-            # for every document associated with it
-            for hash_match in doc_hashes[hash["hash"]]:
-                # start a list if we don't have one already
-                if hash_match["name"] not in query_docs:
-                    query_docs[hash_match["name"]] = []
-            
-                # add the time difference between the query hash and the
-                # document hash under the document's key in our dict of
-                # potentially matching docs
-                query_docs[hash_match["name"]].append(
-                    hash_match["offset"] - hash["offset"])
-    
-    return query_docs
+        tuple -- NumPy Arrays of the document ID and offset time delta of each
+                 matching posting, and the position in the query of the hash
+                 it matched
+    """
+    # binary search the index for each query hash's postings, in the order
+    # we'd meet them walking the query hash by hash — hashes we haven't seen
+    # in our database have none
+    postings, counts = find_postings(index, query_hashes["hash"])
+    query_positions = np.repeat(np.arange(len(query_hashes)), counts)
+    count("postings_touched", len(postings))
 
-def compute_histogram_ranges(query_docs):
+    deltas = postings["offset"].astype(np.int64)\
+        - query_hashes["offset"][query_positions]
+
+    return postings["doc_id"], deltas, query_positions
+
+
+def gather_offset_evidence(query_hashes, fingerprints):
     """
-    Given a dict associating docs to a list of hashes and their offset time
-    deltas, compute a histogram for each and return a dict associating docs
-    to the range of their histograms.
-    
+    Gather the postings matching a query from every segment of a database,
+    numbering documents by their database-wide IDs and skipping deleted ones.
+    If the database is sharded, the postings are gathered from its shards.
+
     Arguments:
-        query_docs {dict} -- Dictionary linking document IDs to a list of their
-                             hashes and time deltas
-    
+        query_hashes {NumPy Array} -- Hashes and offsets present in the query
+        fingerprints {dict} -- Fingerprint database linking hashes to
+                               documents
+
     Returns:
-        dict -- Dictionary associating docs to their histogram ranges
-    """    
-    # initialise the dict which will contain the ranges of the histograms
-    # of time offsets
-    histogram_ranges = {}
-
-    # iterate over each potentially matching doc
-    for doc in query_docs:
-        # skip any zero length docs
-        if len(query_docs[doc]) == 0:
+        tuple -- NumPy Arrays of the document ID and offset time delta of each
+                 matching posting, and the position in the query of the hash
+                 it matched
+    """
+    doc_ids = []
+    deltas = []
+    query_positions = []
+    for index, doc_id_base, deleted in zip(
+            fingerprints["segments"],
+            fingerprints["doc_id_bases"],
+            fingerprints["deleted_docs"]):
+        segment_doc_ids, segment_deltas, segment_positions =\
+            gather_index_evidence(query_hashes, index)
+        live = ~deleted[segment_doc_ids]
+
+        doc_ids.append(segment_doc_ids[live].astype(np.int64) + doc_id_base)
+        deltas.append(segment_deltas[live])
+        query_positions.append(segment_positions[live])
+
+    if "shards" in fingerprints:
+        shard_doc_ids, shard_deltas, shard_positions =\
+            gather_shard_evidence(query_hashes, fingerprints)
+        doc_ids.append(shard_doc_ids)
+        deltas.append(shard_deltas)
+        query_positions.append(shard_positions)
+
+    return\
+        np.concatenate(doc_ids),\
+        np.concatenate(deltas),\
+        np.concatenate(query_positions)
+
+
+def gather_shard_evidence(query_hashes, fingerprints):
+    """
+    Scatter a query's hashes to the shards of a sharded database holding
+    them, and gather the matching postings back. Shards served by their own
+    process (see start_shard_servers) are all sent their hashes before any
+    results are waited for, so they search in parallel. Documents are
+    numbered the same in every shard, so their evidence can be merged as is.
+
+    Arguments:
+        query_hashes {NumPy Array} -- Hashes and offsets present in the query
+        fingerprints {dict} -- Sharded fingerprint database
+
+    Returns:
+        tuple -- NumPy Arrays of the document ID and offset time delta of each
+                 matching posting, and the position in the query of the hash
+                 it matched
+    """
+    query_shards = shard_numbers(
+        fingerprints["shard_boundaries"], query_hashes["hash"])
+
+    # scatter
+    pending = []
+    for number, shard in enumerate(fingerprints["shards"]):
+        positions = np.flatnonzero(query_shards == number)
+        if len(positions) == 0:
             continue
+        if "server" in shard:
+            pending.append((positions, shard["server"].apply_async(
+                gather_in_shard_server, (query_hashes[positions],))))
+        elif shard["fingerprints"] is not None:
+            pending.append((positions, gather_offset_evidence(
+                query_hashes[positions], shard["fingerprints"])))
+
+    # gather, mapping positions in each shard's hashes back to the query's
+    doc_ids = [np.zeros(0, dtype=np.int64)]
+    deltas = [np.zeros(0, dtype=np.int64)]
+    query_positions = [np.zeros(0, dtype=np.int64)]
+    for positions, evidence in pending:
+        if hasattr(evidence, "get"):
+            shard_doc_ids, shard_deltas, shard_positions = evidence.get()
+            # the server's own counts stay in its process, so count the
+            # postings it sent back instead
+            count("postings_touched", len(shard_doc_ids))
+        else:
+            shard_doc_ids, shard_deltas, shard_positions = evidence
+        doc_ids.append(shard_doc_ids)
+        deltas.append(shard_deltas)
+        query_positions.append(positions[shard_positions])
+
+    return\
+        np.concatenate(doc_ids),\
+        np.concatenate(deltas),\
+        np.concatenate(query_positions)
+
+
+def init_shard_server(path_to_shard, generation):
+    """
+    Prepare a process to serve lookups in one shard of a sharded database,
+    loading only that shard.
 
-        # create a histogram — NB np.bincount is faster than np.histogram
-        # but at the expense of being able to create any sized bin
-        histogram = np.bincount(query_docs[doc] - np.min(query_docs[doc]))
+    Arguments:
+        path_to_shard {str} -- Path to the shard file
+        generation {str} -- Generation of the build recorded in the base
+    """
+    print_status.screen = None
+    gather_in_shard_server.fingerprints =\
+        load_shard(path_to_shard, generation)
 
-        # store the min to max range of the histogram in our dict
-        histogram_ranges[doc] = int(np.ptp(histogram))
 
-    return histogram_ranges
+def gather_in_shard_server(query_hashes):
+    """
+    gather_offset_evidence against the shard loaded by init_shard_server.
+    """
+    return gather_offset_evidence(
+        query_hashes, gather_in_shard_server.fingerprints)
 
 
-def sort_flat_dict(dict_to_sort):
+def start_shard_servers(fingerprints, stack):
     """
-    Given a dictionary of depth 1, return a list of keys sorted by values
-    
+    Start a process for each shard of a sharded database, which loads the
+    shard and serves lookups in it, standing in for a remote shard server.
+    Every shard the database lists is served, whether or not this process
+    loaded it.
+
     Arguments:
-        dict_to_sort {dict} -- A dict of depth 1
-    
+        fingerprints {dict} -- Sharded fingerprint database
+        stack {ExitStack} -- Stack the servers are shut down with
+    """
+    for shard in fingerprints["shards"]:
+        shard["server"] = stack.enter_context(Pool(
+            1,
+            initializer=init_shard_server,
+            initargs=(shard["path"], fingerprints["shard_generation"])))
+
+
+def histogram_scores(doc_ids, deltas, query_positions, return_offsets):
+    """
+    Score each document by the range of the histogram of its offset time
+    deltas, given the postings matching a query sorted by document and then
+    delta.
+
     Returns:
-        list -- A list of keys sorted by their values in dict_to_sort
-    """    
-    scores = [key for key in dict_to_sort]
-    keys_by_scores = sorted(scores, key=lambda x: -dict_to_sort[x])
-    return keys_by_scores
+        tuple -- NumPy Arrays of each document's ID, score and first matching
+                 query position, and if asked for, the delta of its first
+                 tallest histogram bin (or else None)
+    """
+    # find runs of equal (document, delta) — i.e. the non-empty bins of each
+    # document's histogram — and the runs of equal document
+    new_bin = np.ones(len(doc_ids), dtype=bool)
+    new_bin[1:] = (doc_ids[1:] != doc_ids[:-1]) | (deltas[1:] != deltas[:-1])
+    bin_starts = np.flatnonzero(new_bin)
+    bin_counts = np.diff(np.append(bin_starts, len(doc_ids)))
+    bin_docs = doc_ids[bin_starts]
+
+    new_doc = np.ones(len(bin_starts), dtype=bool)
+    new_doc[1:] = bin_docs[1:] != bin_docs[:-1]
+    doc_bin_starts = np.flatnonzero(new_doc)
+    doc_starts = bin_starts[doc_bin_starts]
+    doc_ends = np.append(doc_starts[1:], len(doc_ids))
+
+    # the histogram spans every delta from a document's smallest to largest,
+    # so unless every delta in between occurs its least populated bin is 0
+    max_counts = np.maximum.reduceat(bin_counts, doc_bin_starts)
+    min_counts = np.minimum.reduceat(bin_counts, doc_bin_starts)
+    n_bins = np.diff(np.append(doc_bin_starts, len(bin_starts)))
+    histogram_widths = deltas[doc_ends - 1] - deltas[doc_starts] + 1
+    min_counts = np.where(n_bins == histogram_widths, min_counts, 0)
+    scores = max_counts - min_counts
+
+    unique_docs = doc_ids[doc_starts]
+    first_matches = np.minimum.reduceat(query_positions, doc_starts)
+    if not return_offsets:
+        return unique_docs, scores, first_matches, None
+
+    # the first (i.e. smallest delta) of each document's tallest bins
+    bin_doc_numbers = np.repeat(np.arange(len(unique_docs)), n_bins)
+    tallest_bins = np.flatnonzero(
+        bin_counts == max_counts[bin_doc_numbers])
+    _, first_tallest = np.unique(
+        bin_doc_numbers[tallest_bins], return_index=True)
+    offsets = deltas[bin_starts[tallest_bins[first_tallest]]]
+
+    return unique_docs, scores, first_matches, offsets
+
+
+def score_offset_evidence(
+        doc_ids, deltas, query_positions, return_offsets=False):
+    """
+    Given the offset time deltas of every posting matching a query, score each
+    document by the range of the histogram of its deltas — a true match will
+    have many hashes sharing the same delta. Rather than computing one
+    histogram per document, we sort all (document, delta) pairs at once and
+    count runs — with Numba, in a single compiled pass.
 
+    Arguments:
+        doc_ids {NumPy Array} -- Document ID of each matching posting
+        deltas {NumPy Array} -- Offset time delta of each matching posting
+        query_positions {NumPy Array} -- Position in the query of the hash
+                                         each posting matched
 
-def doc_matches_query(doc_name, query_name):
+    Keyword Arguments:
+        return_offsets {bool} -- Whether to also return the delta of each
+                                 document's tallest histogram bin, i.e. the
+                                 frame of the document where the query
+                                 starts (default: {False})
+
+    Returns:
+        tuple -- NumPy Arrays of document IDs, best match first, and their
+                 scores, and if asked for, their offsets. Ties are broken by
+                 which document the query's hashes matched first.
     """
-    Returns true if the doc name matches the ground truth in the query name,
-    based on the filename formatting in the GTZAN dataset.
-    
+    if len(doc_ids) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return (empty, empty, empty) if return_offsets else (empty, empty)
+
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    order = np.lexsort((deltas, doc_ids))
+    doc_ids = doc_ids[order]
+    deltas = deltas[order]
+    query_positions = query_positions[order]
+
+    if jit_kernels.use_jit:
+        unique_docs, scores, first_matches, offsets =\
+            histogram_scores_kernel(doc_ids, deltas, query_positions)
+    else:
+        unique_docs, scores, first_matches, offsets = histogram_scores(
+            doc_ids, deltas, query_positions, return_offsets)
+    ranking = np.lexsort((unique_docs, first_matches, -scores))
+
+    if not return_offsets:
+        return unique_docs[ranking], scores[ranking]
+    return unique_docs[ranking], scores[ranking], offsets[ranking]
+
+
+def rank_documents(query_hashes, fingerprints, return_offsets=False):
+    """
+    Given the hashes present in a query, rank the documents in the database
+    by how well they match it.
+
     Arguments:
-        doc_name {str} -- The document file name
-        query_name {str} -- The query file name
-    
+        query_hashes {NumPy Array} -- Hashes and offsets present in the query
+        fingerprints {dict} -- Fingerprint database linking hashes to
+                               documents
+
+    Keyword Arguments:
+        return_offsets {bool} -- Whether to also return the frame of each
+                                 document where the query starts
+                                 (default: {False})
+
+    Returns:
+        tuple -- NumPy Arrays of document IDs, best match first, and their
+                 scores, and if asked for, their offsets
+    """
+    with stage_timer("lookup"):
+        evidence = gather_offset_evidence(query_hashes, fingerprints)
+    with stage_timer("scoring"):
+        return score_offset_evidence(*evidence, return_offsets=return_offsets)
+
+
+def rank_documents_early_exit(
+        query_hashes,
+        fingerprints,
+        margin,
+        chunk_size=DEFAULT_EARLY_EXIT_CHUNK_SIZE):
+    """
+    Rank the documents in the database by how well they match a query,
+    looking its hashes up in growing chunks and stopping as soon as the best
+    document's score beats the runner up's by a clear margin.
+
+    Arguments:
+        query_hashes {NumPy Array} -- Hashes and offsets present in the query
+        fingerprints {dict} -- Fingerprint database linking hashes to
+                               documents
+        margin {int} -- How far ahead of the runner up the best document's
+                        score must be to stop early
+
+    Keyword Arguments:
+        chunk_size {int} -- Number of hashes to look up before the first
+                            check. Each later chunk is twice the size of the
+                            last, so that rescoring costs at most as much
+                            again as scoring everything once. (default: {256})
+
     Returns:
-        boolean -- True if the document matches the query
-    """    
-    ground_truth = query_name.split("-")[0] + ".wav"
-    return ground_truth == doc_name
+        tuple -- NumPy Arrays of document IDs, best match first, and their
+                 scores, and the number of hashes looked up
+    """
+    doc_ids = []
+    deltas = []
+    query_positions = []
+    ranked_docs, scores = score_offset_evidence([], [], [])
+
+    n_used = 0
+    while n_used < len(query_hashes):
+        with stage_timer("lookup"):
+            chunk_doc_ids, chunk_deltas, chunk_positions =\
+                gather_offset_evidence(
+                    query_hashes[n_used:n_used + chunk_size], fingerprints)
+        doc_ids.append(chunk_doc_ids)
+        deltas.append(chunk_deltas)
+        query_positions.append(chunk_positions + n_used)
+        n_used = min(n_used + chunk_size, len(query_hashes))
+        chunk_size *= 2
+
+        # rescoring from scratch keeps scores exactly as rank_documents would
+        # give for the hashes used so far
+        with stage_timer("scoring"):
+            ranked_docs, scores = score_offset_evidence(
+                np.concatenate(doc_ids),
+                np.concatenate(deltas),
+                np.concatenate(query_positions))
+        runner_up_score = scores[1] if len(scores) > 1 else 0
+        if len(scores) > 0 and scores[0] - runner_up_score >= margin:
+            break
+
+    return ranked_docs, scores, n_used
 
 
 def write_output_line(output_file, sorted_docs, query_name):
     if len(sorted_docs) > 0:
         output_line = "%s\t%s\n" % (
             query_name,
-            "\t".join(sorted_docs[:min(3, len(sorted_docs))]))
+            "\t".join(sorted_docs[:min(N_GUESSES, len(sorted_docs))]))
     else:
-        output_line = query_name
+        output_line = "%s\n" % query_name
     output_file.write(output_line)
 
 
+def identify_query(
+        query_file,
+        fingerprints,
+        peak_picking_options={},
+        pair_searching_options={},
+        cache_options={},
+        early_exit_options={},
+        decoding_options={}):
+    """
+    Find the best matching documents for a single query audio file, timing
+    hash extraction and database search separately, and collecting the
+    metrics of each stage.
+
+    Arguments:
+        query_file {str} -- Path to query audio
+        fingerprints {dict} -- Fingerprint database to search
+
+    Keyword Arguments:
+        peak_picking_options {dict} -- Optional dict of keyword args to peak
+                                       picking algorithm (default: {{}})
+        pair_searching_options {dict} -- Optional dict of keyword args to pair
+                                         searching algorithm (default: {{}})
+        cache_options {dict} -- Optional dict of feature cache options, as
+                                taken by extract_spectral_peaks
+                                (default: {{}})
+        early_exit_options {dict} -- Optional dict with the "margin" by which
+                                     the best document must beat the runner
+                                     up to stop searching early, and the
+                                     "chunk_size" of hashes to search between
+                                     checks. An empty dict searches every
+                                     hash. (default: {{}})
+        decoding_options {dict} -- Optional dict of audio decoding options,
+                                   as taken by extract_spectral_peaks
+                                   (default: {{}})
+
+    Returns:
+        tuple -- Names of the best matching documents, best first, the times
+                 taken to extract hashes and search the database, the number
+                 of hashes searched out of the number in the query, and the
+                 metrics of each stage (see instrumentation.py)
+    """
+    with collect_metrics() as metrics:
+        # extract hashes from query (and time it)
+        hash_start_time = time.perf_counter()
+        query_hashes = get_query_hashes(
+            query_file,
+            peak_picking_options,
+            pair_searching_options,
+            cache_options,
+            decoding_options)
+        hash_time = time.perf_counter() - hash_start_time
+
+        print_status(
+            "id_searching_db",
+            { "now_analysing": os.path.basename(query_file) })
+        db_search_start_time = time.perf_counter()
+
+        # find all docs sharing hashes with the query, and sort them by the
+        # ranges of the histograms of their time deltas — best match first
+        if early_exit_options:
+            ranked_docs, _, n_hashes_used = rank_documents_early_exit(
+                query_hashes, fingerprints, **early_exit_options)
+        else:
+            ranked_docs, _ = rank_documents(query_hashes, fingerprints)
+            n_hashes_used = len(query_hashes)
+        sorted_docs = [
+            doc_name(fingerprints, doc_id)
+            for doc_id in ranked_docs[:N_GUESSES].tolist()]
+
+        db_search_time = time.perf_counter() - db_search_start_time
+
+        count("query_hashes", len(query_hashes))
+        count("hashes_looked_up", n_hashes_used)
+
+    return (
+        sorted_docs,
+        hash_time,
+        db_search_time,
+        n_hashes_used,
+        len(query_hashes),
+        metrics)
+
+
+def init_identification_worker(path_to_fingerprints, hash_layout):
+    """
+    Prepare a worker process for identifying queries. Each worker maps the
+    fingerprint database itself rather than being sent a copy, so all the
+    workers on a host share the same pages of it.
+
+    Arguments:
+        path_to_fingerprints {str} -- Path to fingerprint database file
+        hash_layout {dict} -- Layout to pack the hashes of a pickled database
+                              with
+    """
+    # only the parent process may draw on the screen
+    print_status.screen = None
+    identify_in_worker.fingerprints =\
+        load_fingerprint_db(path_to_fingerprints, hash_layout)
+
+
+def identify_in_worker(
+        query_file,
+        peak_picking_options={},
+        pair_searching_options={},
+        cache_options={},
+        early_exit_options={},
+        decoding_options={}):
+    """
+    identify_query against the database loaded by init_identification_worker.
+    """
+    return identify_query(
+        query_file,
+        identify_in_worker.fingerprints,
+        peak_picking_options,
+        pair_searching_options,
+        cache_options,
+        early_exit_options,
+        decoding_options)
+
+
 @enable_printing
 def audioIdentification(
         path_to_queries,
         path_to_fingerprints,
         path_to_output,
         peak_picking_options={},
-        pair_searching_options={}):
+        pair_searching_options={},
+        workers=1,
+        cache_options={},
+        early_exit_options={},
+        decoding_options={},
+        parallel_shards=False,
+        metrics_options={}):
     """
     The main entry point for the audio identifying algorithm
     
@@ -175,86 +579,169 @@ def audioIdentification(
                                        picking algorithm (default: {{}})
         pair_searching_options {dict} -- Optional dict of keyword args to pair
                                          searching algorithm (default: {{}})
+        workers {int} -- Number of processes to identify queries with. Results
+                         are written in the same order whatever the number.
+                         (default: {1})
+        cache_options {dict} -- Optional dict of feature cache options, as
+                                taken by extract_spectral_peaks
+                                (default: {{}})
+        early_exit_options {dict} -- Optional dict of early exit options, as
+                                     taken by identify_query (default: {{}})
+        decoding_options {dict} -- Optional dict of audio decoding options,
+                                   as taken by extract_spectral_peaks
+                                   (default: {{}})
+        parallel_shards {bool} -- Whether to search each shard of a sharded
+                                  database in its own process. Only used when
+                                  workers is 1, as otherwise each worker
+                                  searches every shard itself.
+                                  (default: {False})
+        metrics_options {dict} -- Optional dict with the path of a
+                                  "json_lines" file to append each query's
+                                  and the whole run's metrics to, and of a
+                                  "prometheus" textfile to write the run's
+                                  metrics to (default: {{}})
     
     Returns:
-        [type] -- [description]
+        float -- Fraction of queries whose best match was correct
     """
     print_status("id_blank_status", {})
     print_status("id_loading_db", {"db_file": path_to_fingerprints})
 
     start_time = time.perf_counter()
+    # each query's metrics are collected wherever it was identified, and
+    # summed here
+    metrics = new_metrics()
     # open output file for writing
     output_file = open(path_to_output, "w")
 
-    # load fingerprint database from disk
-    with open(path_to_fingerprints, "rb") as f:
-        fingerprints = pickle.load(f)
+    # map fingerprint database from disk — index files are memory-mapped so
+    # this is instant whatever their size. Old pickled databases are
+    # converted to an index as they load, which needs to know how their
+    # hashes were built
+    hash_layout = pair_hash_layout(pair_searching_options)
+    # shard servers load their own shards, so this process needn't
+    serve_shards = parallel_shards and workers == 1
+    with collect_metrics() as load_metrics, stage_timer("db_load"):
+        fingerprints = load_fingerprint_db(
+            path_to_fingerprints,
+            hash_layout,
+            shards=[] if serve_shards else None)
+    merge_metrics(metrics, load_metrics)
+    if fingerprints["hash_layout"] != hash_layout:
+        raise ValueError(
+            "Pair searching options don't match those %s was built with"
+            % path_to_fingerprints)
+    check_feature_version(fingerprints, path_to_fingerprints)
 
     # initialise counters
     n_queries = 0
     n_correct = 0
 
-    # iterate over files in query directory
-    for entry in os.scandir(path_to_queries):
-        # skip any files that aren't WAVs
-        if os.path.splitext(entry.name)[1] != ".wav":
-            continue
-        n_queries += 1
-
-        # extract hashes from query (and time it + report status)
-        print_status(
-            "id_analysing_file",
-            { "now_analysing": entry.name })
-        hash_start_time = time.perf_counter()
-        query_hashes = get_query_hashes(
-            entry.path,
-            peak_picking_options,
-            pair_searching_options)
-        hash_time = time.perf_counter() - hash_start_time
-
-        print_status(
-            "id_searching_db",
-            { "now_analysing": entry.name })
-        db_search_start_time = time.perf_counter()
-
-        # find all docs sharing hashes with the query, and construct a dict of
-        # their names and the time deltas between the hash time in the query
-        # and the doc:
-        query_docs =\
-            find_potentially_matching_docs(query_hashes, fingerprints)
-
-        # find the ranges of histograms of their time deltas:
-        histogram_ranges = compute_histogram_ranges(query_docs)
-        
-        # sort the docs in order of their negative histogram ranges — i.e. best
-        # match first
-        sorted_docs = sort_flat_dict(histogram_ranges)
-
-        # compare first result to ground truth and find out if we are correct
-        correct = len(sorted_docs) > 0\
-                and doc_matches_query(sorted_docs[0], entry.name)
-        n_correct += 1 if correct else 0
-        
-        db_search_time = time.perf_counter() - db_search_start_time
-
-        print_status(
-            "id_finished_identifying",
-            {
-                "file_name": entry.name,
-                "correctly_identified": "Yes" if correct else "No",
-                "correct_so_far":
-                    "%.1f%%" % (100 * float(n_correct) / n_queries),
-                "guess_1": sorted_docs[0] if len(sorted_docs) >= 1 else "",
-                "guess_2": sorted_docs[1] if len(sorted_docs) >= 2 else "",
-                "guess_3": sorted_docs[2] if len(sorted_docs) >= 3 else "",
-                "time_to_hashes": "%.3f" % hash_time,
-                "time_to_db": "%.3f" % db_search_time,
-                "total_time": "%.1f" % (time.perf_counter() - start_time)
-            }
-        )
-
-        write_output_line(output_file, sorted_docs, entry.name)
+    # skip any files that aren't WAVs
+    entries = [
+        entry for entry in os.scandir(path_to_queries)
+        if os.path.splitext(entry.name)[1] == ".wav"]
+
+    with ExitStack() as stack:
+        if serve_shards and "shards" in fingerprints:
+            start_shard_servers(fingerprints, stack)
+
+        if workers > 1:
+            # each worker maps the database for itself. imap hands results
+            # back in the order the queries were submitted, so the output file
+            # is in the same order as a serial run
+            pool = stack.enter_context(Pool(
+                workers,
+                initializer=init_identification_worker,
+                initargs=(path_to_fingerprints, hash_layout)))
+            results = pool.imap(
+                partial(
+                    identify_in_worker,
+                    peak_picking_options=peak_picking_options,
+                    pair_searching_options=pair_searching_options,
+                    cache_options=cache_options,
+                    early_exit_options=early_exit_options,
+                    decoding_options=decoding_options),
+                [entry.path for entry in entries])
+        else:
+            results = (
+                identify_query(
+                    entry.path,
+                    fingerprints,
+                    peak_picking_options,
+                    pair_searching_options,
+                    cache_options,
+                    early_exit_options,
+                    decoding_options)
+                for entry in entries)
+
+        # iterate over files in query directory
+        for entry in entries:
+            n_queries += 1
+
+            # report status while we wait for the query to be identified
+            print_status(
+                "id_analysing_file",
+                { "now_analysing": entry.name })
+            sorted_docs, hash_time, db_search_time, n_hashes_used, n_hashes,\
+                query_metrics = next(results)
+            merge_metrics(metrics, query_metrics)
+
+            # compare first result to ground truth and find out if we are
+            # correct
+            correct = len(sorted_docs) > 0\
+                    and doc_matches_query(sorted_docs[0], entry.name)
+            n_correct += 1 if correct else 0
+
+            print_status(
+                "id_finished_identifying",
+                {
+                    "file_name": entry.name,
+                    "correctly_identified": "Yes" if correct else "No",
+                    "correct_so_far":
+                        "%.1f%%" % (100 * float(n_correct) / n_queries),
+                    "guess_1":
+                        sorted_docs[0] if len(sorted_docs) >= 1 else "",
+                    "guess_2":
+                        sorted_docs[1] if len(sorted_docs) >= 2 else "",
+                    "guess_3":
+                        sorted_docs[2] if len(sorted_docs) >= 3 else "",
+                    "time_to_hashes": "%.3f" % hash_time,
+                    "time_to_db": "%.3f" % db_search_time,
+                    "hashes_used": n_hashes_used,
+                    "num_hashes": n_hashes,
+                    "total_time":
+                        "%.1f" % (time.perf_counter() - start_time)
+                }
+            )
+
+            write_output_line(output_file, sorted_docs, entry.name)
+            export_event(
+                metrics_options,
+                dict(
+                    {
+                        "event": "query",
+                        "query": entry.name,
+                        "correct": correct,
+                        "guesses": sorted_docs,
+                        "time_to_hashes": hash_time,
+                        "time_to_db": db_search_time
+                    },
+                    **query_metrics))
 
     output_file.close()
 
-    return float(n_correct) / n_queries
+    # an empty folder of queries identifies none of them
+    accuracy = float(n_correct) / max(n_queries, 1)
+    export_run_metrics(
+        metrics_options,
+        "identification",
+        metrics,
+        {
+            "n_queries": n_queries,
+            "n_correct": n_correct,
+            "accuracy": accuracy,
+            "elapsed_seconds": time.perf_counter() - start_time
+        })
+
+    return accuracy
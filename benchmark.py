@@ -0,0 +1,162 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: benchmark.py
+Description: Checks the optimised stages of the fingerprinting pipeline
+             against straightforward reference implementations and times
+             both. Can be called directly as a script on a folder of audio.
+"""
+from argparse import ArgumentParser
+import os
+import time
+
+import librosa
+import numpy as np
+
+from audio_decoding import load_audio
+from fingerprint_builder import pick_peaks, compute_spectrogram, SAMPLE_RATE
+
+# least fraction of peaks (intersection over union) the fast audio decoding
+# path must share with librosa.load's on every file
+DECODING_PEAK_TOLERANCE = 0.9
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("audio_folder")
+    parser.add_argument("--n_files", type=int, default=5)
+
+    return parser.parse_args()
+
+
+def reference_pick_peaks(spectrogram, tau, kappa, hop_tau, hop_kappa):
+    """
+    The original window-by-window peak picker, kept as a reference for the
+    vectorised implementation in fingerprint_builder.pick_peaks.
+    """
+    peaks = np.zeros_like(spectrogram)
+
+    n_freq_steps =\
+        int(np.floor((spectrogram.shape[0] - 2 * kappa) / hop_kappa))
+    n_time_steps = int(np.floor((spectrogram.shape[1] - 2 * tau) / hop_tau))
+
+    for n in range(n_time_steps):
+        for k in range(n_freq_steps):
+            freq_lower = k * hop_kappa
+            freq_upper = k * hop_kappa + 2 * kappa
+            time_lower = n * hop_tau
+            time_upper = n * hop_tau + 2 * tau
+
+            window = spectrogram[freq_lower:freq_upper, time_lower:time_upper]
+            peak = np.unravel_index(np.argmax(window), window.shape)
+
+            peaks[freq_lower + peak[0], time_lower + peak[1]] = 1
+
+    return peaks
+
+
+def peak_mask(peaks, shape):
+    """
+    Mark a list of peaks, as returned by pick_peaks, in a boolean array of the
+    given spectrogram shape, for comparison with the reference.
+    """
+    mask = np.zeros(shape, dtype=bool)
+    mask[peaks["freq"], peaks["time"]] = True
+    return mask
+
+
+def time_call(func, *args, **kwargs):
+    """
+    Calls func with the given arguments, returning its result and the time it
+    took in seconds.
+    """
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def benchmark_pick_peaks(spectrograms, peak_picking_options):
+    """
+    Checks that pick_peaks finds exactly the same constellation as the
+    reference loop on every spectrogram, and prints the time taken by each.
+
+    Arguments:
+        spectrograms {list} -- List of magnitude spectrograms
+        peak_picking_options {dict} -- Keyword args to the peak pickers
+    """
+    reference_time = 0.0
+    vectorised_time = 0.0
+    for spectrogram in spectrograms:
+        expected, elapsed = time_call(
+            reference_pick_peaks, spectrogram, **peak_picking_options)
+        reference_time += elapsed
+
+        actual, elapsed = time_call(
+            pick_peaks, spectrogram, **peak_picking_options)
+        vectorised_time += elapsed
+
+        # pick_peaks lists peaks by their co-ordinates
+        assert np.array_equal(
+            expected != 0, peak_mask(actual, spectrogram.shape)),\
+            "pick_peaks disagrees with reference for %s" % peak_picking_options
+
+    print("pick_peaks %s" % peak_picking_options)
+    print("    reference:  %.3f seconds" % reference_time)
+    print("    vectorised: %.3f seconds" % vectorised_time)
+
+
+def benchmark_decoding(paths):
+    """
+    Checks that the peaks of audio decoded by the fast path agree with those
+    of audio decoded by librosa to within DECODING_PEAK_TOLERANCE (exactly,
+    if no resampling is needed), and prints the time taken to decode by
+    each.
+
+    Arguments:
+        paths {list} -- List of paths to audio files
+    """
+    librosa_time = 0.0
+    fast_time = 0.0
+    for path in paths:
+        _, elapsed = time_call(load_audio, path, SAMPLE_RATE, "librosa")
+        librosa_time += elapsed
+        _, elapsed = time_call(load_audio, path, SAMPLE_RATE, "fast")
+        fast_time += elapsed
+
+        X = compute_spectrogram(path)
+        expected = peak_mask(pick_peaks(X), X.shape)
+        X = compute_spectrogram(path, {"method": "fast"})
+        actual = peak_mask(pick_peaks(X), X.shape)
+        overlap = np.sum(expected & actual) / max(np.sum(expected | actual), 1)
+        assert overlap >= DECODING_PEAK_TOLERANCE,\
+            "Fast decoding only shares %.3f of peaks for %s" % (overlap, path)
+
+    print("load_audio")
+    print("    librosa: %.3f seconds" % librosa_time)
+    print("    fast:    %.3f seconds" % fast_time)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    paths = sorted(
+        entry.path for entry in os.scandir(args.audio_folder)
+        if os.path.splitext(entry.name)[1] == ".wav")[:args.n_files]
+    spectrograms = [
+        np.abs(librosa.core.stft(librosa.load(path)[0])) for path in paths]
+
+    benchmark_decoding(paths)
+    benchmark_pick_peaks(
+        spectrograms,
+        {"tau": 29, "kappa": 66, "hop_tau": 6, "hop_kappa": 17})
+    benchmark_pick_peaks(
+        spectrograms,
+        {"tau": 8, "kappa": 8, "hop_tau": 4, "hop_kappa": 4})
+    benchmark_pick_peaks(
+        spectrograms,
+        {"tau": 100, "kappa": 100, "hop_tau": 100, "hop_kappa": 100})
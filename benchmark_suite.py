@@ -0,0 +1,340 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: benchmark_suite.py
+Description: A reproducible, offline benchmark of the whole pipeline. Builds
+             a synthetic corpus, times each stage of fingerprinting and
+             lookup on it separately, and reports their throughput along with
+             the peak memory used and the size of the database. A report can
+             be saved as a baseline, and later runs compared against it to
+             flag regressions. Can be called directly as a script.
+"""
+from argparse import ArgumentParser
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+from audio_decoding import load_audio
+from audio_identification import get_query_hashes, rank_documents
+from fingerprint_builder import\
+    pick_peaks, create_pairwise_hashes, stft_magnitudes, pair_hash_layout,\
+    SAMPLE_RATE, DEFAULT_BATCH_SIZE
+from fingerprint_db import build_index, save_index, load_fingerprint_db,\
+    doc_name
+from ground_truth import doc_matches_query
+from synthetic_corpus import generate_corpus, DEFAULT_N_TRACKS,\
+    DEFAULT_TRACK_SECONDS, DEFAULT_QUERIES_PER_TRACK, DEFAULT_QUERY_SECONDS,\
+    DEFAULT_QUERY_SNR_DB
+
+STAGES = [
+    "decode",
+    "stft",
+    "pick_peaks",
+    "find_peak_pairs",
+    "db_build",
+    "db_load",
+    "match"
+]
+
+# each stage is run this many times, and its fastest run reported, so that
+# one-off stalls (and the first decode paying for librosa's lazy imports)
+# don't register as regressions
+DEFAULT_REPEATS = 3
+# how much slower, bigger or hungrier than the baseline a run may be before
+# it's flagged as a regression
+DEFAULT_TOLERANCE = 0.25
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("output_folder")
+    parser.add_argument("--baseline")
+    parser.add_argument("--save_baseline")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--n_tracks", type=int, default=DEFAULT_N_TRACKS)
+    parser.add_argument(
+        "--track_seconds", type=float, default=DEFAULT_TRACK_SECONDS)
+    parser.add_argument(
+        "--queries_per_track", type=int, default=DEFAULT_QUERIES_PER_TRACK)
+    parser.add_argument(
+        "--query_seconds", type=float, default=DEFAULT_QUERY_SECONDS)
+    parser.add_argument(
+        "--query_snr_db", type=float, default=DEFAULT_QUERY_SNR_DB)
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args()
+
+
+def peak_rss_bytes():
+    """
+    The most memory this process has held resident so far, in bytes.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def fastest_run(func, repeats):
+    """
+    Call func repeats times, returning its last result and the time taken by
+    its fastest call in seconds.
+    """
+    best_time = np.inf
+    for _ in range(max(repeats, 1)):
+        start_time = time.perf_counter()
+        result = func()
+        best_time = min(best_time, time.perf_counter() - start_time)
+    return result, best_time
+
+
+def wav_paths(folder):
+    return sorted(
+        entry.path for entry in os.scandir(folder)
+        if os.path.splitext(entry.name)[1] == ".wav")
+
+
+def run_benchmark(
+        docs_folder,
+        queries_folder,
+        path_to_db,
+        repeats=DEFAULT_REPEATS,
+        peak_picking_options={},
+        pair_searching_options={},
+        decoding_options={},
+        batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Time each stage of fingerprinting a folder of documents and identifying
+    a folder of queries against them. Each stage is given the output of the
+    one before, so only its own work is timed.
+
+    Arguments:
+        docs_folder {str} -- Folder of documents to fingerprint
+        queries_folder {str} -- Folder of queries of those documents
+        path_to_db {str} -- Path to write the fingerprint database to
+
+    Keyword Arguments:
+        repeats {int} -- Number of times to run each stage (default: {3})
+        peak_picking_options {dict} -- Optional dict of keyword args to peak
+                                       picking algorithm (default: {{}})
+        pair_searching_options {dict} -- Optional dict of keyword args to pair
+                                         searching algorithm (default: {{}})
+        decoding_options {dict} -- Optional dict of keyword args to
+                                   load_audio (default: {{}})
+        batch_size {int} -- Number of files to compute spectrograms of
+                            together (default: {8})
+
+    Returns:
+        dict -- The report: the size of the corpus, the time and throughput
+                of each stage and the peak RSS once it had run, the size of
+                the database, and the fraction of queries identified
+                correctly
+    """
+    doc_paths = wav_paths(docs_folder)
+    query_paths = wav_paths(queries_folder)
+    hash_layout = pair_hash_layout(pair_searching_options)
+    stages = {}
+
+    def record(stage, seconds, n_units, units):
+        stages[stage] = {
+            "seconds": seconds,
+            "throughput": n_units / seconds if seconds > 0 else None,
+            "units": "%s per second" % units,
+            "peak_rss_bytes": peak_rss_bytes()
+        }
+
+    signals, seconds = fastest_run(
+        lambda: [
+            load_audio(path, SAMPLE_RATE, **decoding_options)
+            for path in doc_paths],
+        repeats)
+    audio_seconds = sum(len(x) for x in signals) / SAMPLE_RATE
+    record("decode", seconds, audio_seconds, "audio seconds")
+
+    spectrograms, seconds = fastest_run(
+        lambda: [
+            X for start in range(0, len(signals), batch_size)
+            for X in stft_magnitudes(signals[start:start + batch_size])],
+        repeats)
+    record("stft", seconds, audio_seconds, "audio seconds")
+    del signals
+
+    peaks, seconds = fastest_run(
+        lambda: [
+            pick_peaks(X, **peak_picking_options) for X in spectrograms],
+        repeats)
+    record("pick_peaks", seconds, audio_seconds, "audio seconds")
+    del spectrograms
+
+    doc_hashes, seconds = fastest_run(
+        lambda: [
+            create_pairwise_hashes(doc_peaks, **pair_searching_options)
+            for doc_peaks in peaks],
+        repeats)
+    record("find_peak_pairs", seconds, audio_seconds, "audio seconds")
+    n_postings = sum(len(hashes) for hashes in doc_hashes)
+
+    doc_names = [os.path.basename(path) for path in doc_paths]
+    _, seconds = fastest_run(
+        lambda: save_index(
+            build_index(doc_names, doc_hashes, hash_layout), path_to_db),
+        repeats)
+    record("db_build", seconds, n_postings, "postings")
+
+    # read the whole database, as memory-mapping it would defer the reading
+    # to the first lookups
+    fingerprints, seconds = fastest_run(
+        lambda: load_fingerprint_db(path_to_db, hash_layout, mmap=False),
+        repeats)
+    record("db_load", seconds, n_postings, "postings")
+
+    # extracting hashes from the queries runs the stages already timed
+    query_hashes = [
+        get_query_hashes(
+            path,
+            peak_picking_options,
+            pair_searching_options,
+            decoding_options=decoding_options)
+        for path in query_paths]
+    rankings, seconds = fastest_run(
+        lambda: [
+            rank_documents(hashes, fingerprints)[0]
+            for hashes in query_hashes],
+        repeats)
+    record("match", seconds, len(query_paths), "queries")
+
+    n_correct = sum(
+        len(ranked_docs) > 0 and doc_matches_query(
+            doc_name(fingerprints, ranked_docs[0]), os.path.basename(path))
+        for ranked_docs, path in zip(rankings, query_paths))
+
+    return {
+        "corpus": {
+            "n_docs": len(doc_paths),
+            "audio_seconds": audio_seconds,
+            "n_queries": len(query_paths)
+        },
+        "stages": stages,
+        "n_postings": n_postings,
+        "db_bytes": os.path.getsize(path_to_db),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "accuracy": n_correct / max(len(query_paths), 1)
+    }
+
+
+def compare_to_baseline(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Find where a benchmark report has regressed from a baseline: a stage
+    taking longer, the database growing or the process peaking at more
+    memory by more than the tolerance, or identification getting any less
+    accurate.
+
+    Arguments:
+        report {dict} -- Report, as returned by run_benchmark
+        baseline {dict} -- Report to compare against
+
+    Keyword Arguments:
+        tolerance {float} -- Fraction by which a measurement may exceed the
+                             baseline's (default: {0.25})
+
+    Returns:
+        list -- A description of each regression
+    """
+    regressions = []
+    if report["corpus"] != baseline["corpus"]:
+        regressions.append(
+            "Corpus differs from the baseline's, so runs aren't comparable")
+
+    def check(name, value, baseline_value):
+        if baseline_value is not None and value > baseline_value * (
+                1 + tolerance):
+            regressions.append("%s: %.4g, up from %.4g (%+.0f%%)" % (
+                name,
+                value,
+                baseline_value,
+                100 * (value / baseline_value - 1)))
+
+    for stage in STAGES:
+        if stage in report["stages"] and stage in baseline["stages"]:
+            check(
+                "%s seconds" % stage,
+                report["stages"][stage]["seconds"],
+                baseline["stages"][stage]["seconds"])
+    check("db_bytes", report["db_bytes"], baseline.get("db_bytes"))
+    check(
+        "peak_rss_bytes",
+        report["peak_rss_bytes"],
+        baseline.get("peak_rss_bytes"))
+
+    if report["accuracy"] < baseline["accuracy"]:
+        regressions.append("accuracy: %.3f, down from %.3f" % (
+            report["accuracy"], baseline["accuracy"]))
+
+    return regressions
+
+
+def print_report(report):
+    """
+    Print a report as returned by run_benchmark.
+    """
+    print("Corpus: %(n_docs)d documents, %(audio_seconds).0f seconds of "
+          "audio, %(n_queries)d queries" % report["corpus"])
+    print()
+    print("Stage             Seconds    Throughput                        "
+          "Peak RSS")
+    for stage in STAGES:
+        result = report["stages"][stage]
+        print("%-15s %9.4f    %-33s %5.0f MB" % (
+            stage,
+            result["seconds"],
+            "%.4g %s" % (result["throughput"] or 0, result["units"]),
+            result["peak_rss_bytes"] / 1024 ** 2))
+    print()
+    print("Postings:        %d" % report["n_postings"])
+    print("Database size:   %.2f MB" % (report["db_bytes"] / 1024 ** 2))
+    print("Peak RSS:        %.0f MB" % (report["peak_rss_bytes"] / 1024 ** 2))
+    print("Accuracy:        %.3f" % report["accuracy"])
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    docs_folder, queries_folder = generate_corpus(
+        os.path.join(args.output_folder, "corpus"),
+        args.n_tracks,
+        args.track_seconds,
+        args.queries_per_track,
+        args.query_seconds,
+        args.query_snr_db,
+        args.seed)
+    report = run_benchmark(
+        docs_folder,
+        queries_folder,
+        os.path.join(args.output_folder, "fingerprint_db.db"),
+        args.repeats)
+    print_report(report)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(
+                report, json.load(f), args.tolerance)
+        print()
+        if len(regressions) > 0:
+            print("Regressions against %s:" % args.baseline)
+            for regression in regressions:
+                print("    %s" % regression)
+            sys.exit(1)
+        print("No regressions against %s" % args.baseline)
@@ -9,39 +9,136 @@ File: evaluation.py
 Description: A set of simple functions for calculation evaluation metrics on
              the output of an audio identification system. Can also be called
              directly as a script to print scores at a number of ranks.
+
+             Output files are read in chunks of lines, and every metric is
+             computed from one cumulative sum of each chunk's relevances, so
+             files of millions of queries are scored in bounded memory and to
+             any rank depth. Confidence intervals are estimated with a
+             Poisson bootstrap, which resamples each chunk as it streams past
+             rather than the whole file at once.
 """
 from argparse import ArgumentParser
+from itertools import chain, islice
 
 import numpy as np
 
+from ground_truth import query_ground_truth
+
+DEFAULT_RANKS = [1, 2, 3]
+
+# number of lines of an output file read at once
+DEFAULT_CHUNK_SIZE = 65536
+
+DEFAULT_N_BOOTSTRAP = 1000
+DEFAULT_CONFIDENCE = 0.95
+# number of queries resampled at once, bounding the memory the bootstrap
+# weights take to n_bootstrap * BOOTSTRAP_BLOCK_SIZE
+BOOTSTRAP_BLOCK_SIZE = 1024
+
+
 def parse_args():
     parser = ArgumentParser()
 
     parser.add_argument("input_file")
+    parser.add_argument(
+        "--ranks", type=int, nargs="+", default=DEFAULT_RANKS)
+    parser.add_argument("--depth", type=int)
+    parser.add_argument(
+        "--chunk_size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--n_bootstrap", type=int, default=0)
+    parser.add_argument(
+        "--confidence", type=float, default=DEFAULT_CONFIDENCE)
 
     return parser.parse_args()
 
 
+def padded_array(values, lengths, width=None):
+    """
+    Lay rows of uneven lengths, given end to end, out in a zero-padded 2D
+    array.
+
+    Arguments:
+        values {NumPy Array} -- Every row's values, one row after another
+        lengths {NumPy Array} -- Length of each row
+
+    Keyword Arguments:
+        width {int} -- Width of the array, at least the longest row's
+                       (default: {None}, the longest row's)
+
+    Returns:
+        NumPy Array -- The rows, padded with zeros
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if width is None:
+        width = int(np.max(lengths)) if len(lengths) > 0 else 0
+    array = np.zeros((len(lengths), width), dtype=np.asarray(values).dtype)
+    # a boolean mask fills the array row by row, in the order of values
+    array[np.arange(width) < lengths[:, np.newaxis]] = values
+    return array
+
+
 def numpy_array_from_uneven_lists(lists):
-    longest_list = len(max(lists, key=len))
-    np_array = np.zeros((len(lists), longest_list))
-    for i, x in enumerate(lists):
-        np_array[i, :len(x)] = x
-    return np_array
+    return padded_array(
+        np.fromiter(chain.from_iterable(lists), dtype=float),
+        [len(x) for x in lists])
 
 
-def parse_id_file(id_file):
-    with open(id_file) as f:
-        lines = [line.split() for line in f]
+def parse_relevances(lines, depth=None):
+    """
+    Find which of the documents listed for each query in lines of an output
+    file are the query's ground truth, as doc_matches_query would.
+
+    Arguments:
+        lines {list} -- Lines of an output file, each a query name followed
+                        by tab separated document names, best first
 
-    relevances = []
+    Keyword Arguments:
+        depth {int} -- Number of documents to read from each line
+                       (default: {None}, every document)
+
+    Returns:
+        NumPy Array -- Whether each document listed for each query is
+                       relevant, padded with False
+    """
+    truths = []
+    docs = []
+    lengths = []
     for line in lines:
-        split_line = line[0].split("-")
-        ground_truth = split_line[0]
-        relevances.append(
-            [1 if ground_truth in doc else 0 for doc in line[1:]])
+        fields = line.rstrip("\r\n").split("\t")
+        if fields[0] == "":
+            continue
+        guesses = fields[1:] if depth is None else fields[1:1 + depth]
+        truths.append(query_ground_truth(fields[0]))
+        docs.extend(guesses)
+        lengths.append(len(guesses))
+
+    relevant = np.array(docs, dtype=object)\
+        == np.repeat(np.array(truths, dtype=object), lengths)
+    return padded_array(relevant.astype(bool), lengths)
+
+
+def iter_relevance_chunks(id_file, depth=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read an output file chunk_size lines at a time, yielding the relevances
+    of each chunk as parse_relevances returns them. Chunks may differ in
+    width.
+    """
+    with open(id_file) as f:
+        while True:
+            lines = list(islice(f, chunk_size))
+            if len(lines) == 0:
+                break
+            yield parse_relevances(lines, depth)
+
 
-    return numpy_array_from_uneven_lists(relevances)
+def parse_id_file(id_file, depth=None):
+    chunks = list(iter_relevance_chunks(id_file, depth))
+    width = max([chunk.shape[1] for chunk in chunks], default=0)
+    return np.concatenate(
+        [np.zeros((0, width))] + [
+            np.pad(chunk, ((0, 0), (0, width - chunk.shape[1])))
+            .astype(float)
+            for chunk in chunks])
 
 
 def precision(rank, relevances):
@@ -59,32 +156,159 @@ def f_measure(rank, relevances, num_relevant_docs=1):
     return np.nan_to_num(f)
 
 
+def query_metrics(relevances, ranks=DEFAULT_RANKS, num_relevant_docs=1):
+    """
+    Compute every metric of every query from one cumulative sum of their
+    relevances: average precision over every rank, and precision, recall and
+    f-measure at each of the given ranks.
+
+    Arguments:
+        relevances {NumPy Array} -- Relevance of each document listed for
+                                    each query
+
+    Keyword Arguments:
+        ranks {list} -- Ranks to compute precision, recall and f-measure at.
+                        Ranks past the last document listed count the
+                        documents that weren't as irrelevant.
+                        (default: {[1, 2, 3]})
+        num_relevant_docs {int} -- Number of documents relevant to each
+                                   query (default: {1})
+
+    Returns:
+        dict -- Each metric's value for each query, by name
+    """
+    relevances = np.asarray(relevances, dtype=float)
+    n_queries, width = relevances.shape
+    hits = np.cumsum(relevances, axis=1)
+
+    metrics = {
+        "avg_precision":
+            np.sum(hits / np.arange(1, width + 1) * relevances, axis=1)
+            / float(num_relevant_docs)
+    }
+    for rank in ranks:
+        hits_at_rank = hits[:, min(rank, width) - 1] if width > 0\
+            else np.zeros(n_queries)
+        prec = hits_at_rank / float(rank)
+        rec = hits_at_rank / float(num_relevant_docs)
+        metrics["precision@%d" % rank] = prec
+        metrics["recall@%d" % rank] = rec
+        metrics["f_measure@%d" % rank] = np.divide(
+            2 * prec * rec,
+            prec + rec,
+            out=np.zeros(n_queries),
+            where=prec + rec > 0)
+    return metrics
+
+
 def avg_precision(relevances, num_relevant_docs=1):
-    if relevances.shape[-1] == 0:
-        return 0.0
-    inner_sum = np.concatenate(
-            [precision(r + 1, relevances).reshape(-1, 1) for r in range(
-                relevances.shape[-1])],
-            axis=1)\
-        * relevances[:, :relevances.shape[-1]]
-    return np.sum(inner_sum, axis=1) / float(num_relevant_docs)
+    return query_metrics(relevances, [], num_relevant_docs)["avg_precision"]
 
 
 def mean_avg_precision(relevances, num_relevant_docs=1):
     return np.mean(avg_precision(relevances, num_relevant_docs))
 
 
+def evaluate_id_file(
+        id_file,
+        ranks=DEFAULT_RANKS,
+        depth=None,
+        num_relevant_docs=1,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        n_bootstrap=0,
+        confidence=DEFAULT_CONFIDENCE,
+        seed=0):
+    """
+    Compute the mean of every metric over the queries of an output file,
+    streaming it in chunks, along with bootstrap confidence intervals.
+
+    Each bootstrap replicate weights every query by a draw from a Poisson
+    distribution of mean 1, which approximates resampling the queries with
+    replacement while only ever needing the queries in hand.
+
+    Arguments:
+        id_file {str} -- Path to output file
+
+    Keyword Arguments:
+        ranks {list} -- Ranks to compute precision, recall and f-measure at
+                        (default: {[1, 2, 3]})
+        depth {int} -- Number of documents to read for each query
+                       (default: {None}, every document)
+        num_relevant_docs {int} -- Number of documents relevant to each
+                                   query (default: {1})
+        chunk_size {int} -- Number of lines to read at once
+                            (default: {65536})
+        n_bootstrap {int} -- Number of bootstrap replicates. None are drawn
+                             if 0. (default: {0})
+        confidence {float} -- Confidence level of the intervals
+                              (default: {0.95})
+        seed {int} -- Seed of the bootstrap's random generator
+                      (default: {0})
+
+    Returns:
+        dict -- The number of queries, each metric's mean, and if replicates
+                were drawn, the bounds of each metric's confidence interval
+    """
+    names = list(query_metrics(np.zeros((0, 0)), ranks))
+    rng = np.random.default_rng(seed)
+    n_queries = 0
+    totals = np.zeros(len(names))
+    replicate_totals = np.zeros((n_bootstrap, len(names)))
+    replicate_weights = np.zeros(n_bootstrap)
+
+    for relevances in iter_relevance_chunks(id_file, depth, chunk_size):
+        metrics = query_metrics(relevances, ranks, num_relevant_docs)
+        values = np.stack([metrics[name] for name in names], axis=1)
+        n_queries += len(values)
+        totals += np.sum(values, axis=0)
+
+        for start in range(0, len(values) if n_bootstrap > 0 else 0,
+                           BOOTSTRAP_BLOCK_SIZE):
+            block = values[start:start + BOOTSTRAP_BLOCK_SIZE]
+            weights = rng.poisson(1.0, (n_bootstrap, len(block)))
+            replicate_totals += weights @ block
+            replicate_weights += np.sum(weights, axis=1)
+
+    means = totals / max(n_queries, 1)
+    report = {
+        "n_queries": n_queries,
+        "mean": dict(zip(names, means.tolist()))
+    }
+    if n_bootstrap > 0 and n_queries > 0:
+        replicate_means = replicate_totals\
+            / np.maximum(replicate_weights, 1)[:, np.newaxis]
+        bounds = np.percentile(
+            replicate_means,
+            [50 * (1 - confidence), 50 * (1 + confidence)],
+            axis=0)
+        report["confidence_interval"] = {
+            name: [low, high] for name, low, high in zip(
+                names, bounds[0].tolist(), bounds[1].tolist())}
+
+    return report
+
+
 if __name__ == "__main__":
     args = parse_args()
 
-    relevance_function = parse_id_file(args.input_file)
-    for r in range(1, 3 + 1):
+    report = evaluate_id_file(
+        args.input_file,
+        args.ranks,
+        args.depth,
+        chunk_size=args.chunk_size,
+        n_bootstrap=args.n_bootstrap,
+        confidence=args.confidence)
+
+    def score(name):
+        if "confidence_interval" not in report:
+            return "%.3f" % report["mean"][name]
+        return "%.3f (%.3f to %.3f)" % (
+            report["mean"][name], *report["confidence_interval"][name])
+
+    for r in args.ranks:
         print("---- Rank %d ----" % r)
-        print(
-            "Mean Precision: %.3f" % np.mean(precision(r, relevance_function)))
-        print("Mean Recall: %.3f" % np.mean(recall(r, relevance_function)))
-        print(
-            "Mean f-measure: %.3f" % np.mean(f_measure(r, relevance_function)))
+        print("Mean Precision: %s" % score("precision@%d" % r))
+        print("Mean Recall: %s" % score("recall@%d" % r))
+        print("Mean f-measure: %s" % score("f_measure@%d" % r))
     print("----------------")
-    print(
-        "Mean avg precision: %.3f" % mean_avg_precision(relevance_function))
\ No newline at end of file
+    print("Mean avg precision: %s" % score("avg_precision"))
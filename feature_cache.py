@@ -0,0 +1,168 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: feature_cache.py
+Description: An on-disk cache of the features extracted from audio files, so
+             that repeated runs over the same files (e.g. in a parameter
+             search) needn't decode and analyse them again. Entries are keyed
+             on a hash of the file's contents and the options used to compute
+             them, and the least recently used are evicted once the cache
+             outgrows its size cap.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# bump this whenever the way features are computed changes, so that stale
+# entries are never read back
+CACHE_VERSION = 3
+
+DEFAULT_MAX_CACHE_BYTES = 8 * 1024 ** 3
+
+# size of the blocks files are read in to hash their contents
+HASH_BLOCK_SIZE = 1 << 20
+
+# scanning the cache to evict from it stats every entry, so it's only done
+# once the size this process has seen the cache reach passes its cap, or
+# after this many writes to pick up what other processes have written
+EVICTION_SCAN_INTERVAL = 64
+
+# for each cache folder this process writes to, the size of the cache as of
+# its last scan plus what it has written since, and the writes since
+tracked_sizes = {}
+
+
+def content_hash(path):
+    """
+    Compute a hash of a file's contents, so that cache entries follow the
+    audio rather than its path or modification time.
+
+    Arguments:
+        path {str} -- Path on disk to file
+
+    Returns:
+        str -- Hex digest of the file's contents
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(*parts):
+    """
+    Combine a file's content hash with any number of option dicts into a
+    single key. Options may hold NumPy scalars, as a parameter search might
+    produce, which key the same as the equivalent Python values.
+    """
+    return hashlib.sha1(
+        json.dumps(
+            [CACHE_VERSION] + list(parts),
+            sort_keys=True,
+            default=lambda value: value.item())
+        .encode("utf-8")).hexdigest()
+
+
+def entry_path(cache_options, tier, key):
+    return os.path.join(cache_options["path"], "%s-%s.npz" % (tier, key))
+
+
+def cache_get(cache_options, tier, key):
+    """
+    Look up an entry in the cache, marking it as recently used.
+
+    Arguments:
+        cache_options {dict} -- The cache's "path" and optional "max_bytes"
+        tier {str} -- Name of the kind of feature stored
+        key {str} -- Key of the entry, as returned by cache_key
+
+    Returns:
+        dict -- The entry's arrays, or None if it isn't cached
+    """
+    path = entry_path(cache_options, tier, key)
+    try:
+        with np.load(path) as entry:
+            arrays = {name: entry[name] for name in entry.files}
+        # eviction goes by modification time, so touching the entry makes it
+        # the most recently used
+        os.utime(path)
+    except (OSError, ValueError):
+        # missing, or evicted or half written by another process
+        return None
+    return arrays
+
+
+def cache_put(cache_options, tier, key, arrays):
+    """
+    Store an entry in the cache, evicting the least recently used entries if
+    the cache seems to have grown past its size cap.
+
+    Arguments:
+        cache_options {dict} -- The cache's "path" and optional "max_bytes"
+        tier {str} -- Name of the kind of feature stored
+        key {str} -- Key of the entry, as returned by cache_key
+        arrays {dict} -- NumPy Arrays to store, by name
+    """
+    os.makedirs(cache_options["path"], exist_ok=True)
+    path = entry_path(cache_options, tier, key)
+
+    # write then move into place, so other processes never read half an entry
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp_path, "wb") as f:
+        np.savez(f, **arrays)
+        entry_bytes = f.tell()
+    os.replace(temp_path, path)
+
+    max_bytes = cache_options.get("max_bytes", DEFAULT_MAX_CACHE_BYTES)
+    tracked = tracked_sizes.get(cache_options["path"])
+    if tracked is not None:
+        tracked["bytes"] += entry_bytes
+        tracked["writes"] += 1
+    if tracked is None or tracked["bytes"] > max_bytes\
+            or tracked["writes"] >= EVICTION_SCAN_INTERVAL:
+        tracked_sizes[cache_options["path"]] = {
+            "bytes": evict(cache_options["path"], max_bytes),
+            "writes": 0
+        }
+
+
+def evict(cache_path, max_bytes):
+    """
+    Remove the least recently used entries from a cache until it fits in
+    max_bytes.
+
+    Arguments:
+        cache_path {str} -- Path to the cache folder
+        max_bytes {int} -- Size cap of the cache
+
+    Returns:
+        int -- Size of the cache's remaining entries
+    """
+    entries = []
+    for entry in os.scandir(cache_path):
+        if not entry.name.endswith(".npz"):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+    return total_bytes
@@ -9,16 +9,38 @@ File: fingerprint_builder.py
 Description: Builds a database on disk of spectral peak and pairwise hash based
              fingerprints from a folder of audio files.
 """
+from contextlib import ExitStack
 import curses
+from functools import partial
+from itertools import chain
+from multiprocessing import Pool
 import os
-import pickle
 import time
+import warnings
 
-import librosa
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import rfft
+from scipy.ndimage import maximum_filter
+from scipy.signal import get_window
 
+from audio_decoding import load_audio
+from feature_cache import content_hash, cache_key, cache_get, cache_put
+from fingerprint_db import\
+    hash_layout, encode_hashes, build_index, prune_index, save_index,\
+    save_sharded_db, discard_stale_shards, add_segment, discard_segments,\
+    DEFAULT_MAX_SEGMENTS
+from instrumentation import new_metrics, collect_metrics, stage_timer, count,\
+    merge_metrics, export_event, export_run_metrics
+import jit_kernels
+from jit_kernels import window_peak_kernel, pair_candidates_kernel
 from print_status import print_status, enable_printing
 
+# librosa's default sample rate and FFT size, giving 1 + N_FFT // 2
+# frequency bins
+SAMPLE_RATE = 22050
+N_FFT = 2048
+
 DEFAULT_KAPPA = 66
 DEFAULT_TAU = 29
 DEFAULT_HOP_KAPPA = 17
@@ -28,18 +50,189 @@ DEFAULT_TARGET_TIME_OFFSET = 96
 DEFAULT_TARGET_TIME_WIDTH = 76
 DEFAULT_TARGET_FREQ_HEIGHT = 80
 
+# upper bound on the number of candidate (anchor, target) pairings considered
+# at once when pairing peaks, which keeps memory bounded for dense peak maps
+PAIR_CANDIDATES_PER_BATCH = 1 << 20
 
-def pick_peaks(
+# hop size and window of librosa's default STFT
+HOP_LENGTH = N_FFT // 4
+STFT_WINDOW = get_window("hann", N_FFT, fftbins=True).astype(np.float32)
+
+# version of the features fingerprints are made from, recorded in every
+# database built. Databases without one were made by librosa's STFT in double
+# precision (version 1). Version 2 computes it in single precision, which
+# frames the audio identically but can pick a different one of two nearly
+# equal peaks, so databases of one version match queries of the other less
+# well.
+FEATURE_VERSION = 2
+
+# number of files whose spectrograms are computed together when building a
+# database
+DEFAULT_BATCH_SIZE = 8
+# number of STFT frames transformed per FFT call. Blocks of this size keep
+# the windowed frames and their spectra in cache, which matters far more
+# than the per-call overhead saved by larger ones
+STFT_BLOCK_FRAMES = 256
+
+# spectral peaks are kept as a list of co-ordinates sorted by time, then by
+# frequency, rather than as a dense array the size of the spectrogram. The
+# magnitude field is optional, and only needed to choose between peaks
+PEAK_DTYPE = np.dtype([
+    ("time", np.int32),
+    ("freq", np.int32),
+    ("magnitude", np.float32)
+])
+
+PEAK_PAIR_DTYPE = np.dtype([
+    ("anchor_freq", np.int32),
+    ("target_freq", np.int32),
+    ("dt", np.int32),
+    ("anchor_time", np.int32)
+])
+
+
+def window_peak_coordinates(
         spectrogram,
         tau=DEFAULT_TAU,
         kappa=DEFAULT_KAPPA,
         hop_tau=DEFAULT_HOP_TAU,
         hop_kappa=DEFAULT_HOP_KAPPA):
     """
+    Finds the location of the maximum in every window of a spectrogram
+    without looping over the windows in Python. The window argmax is
+    separable: we first take the argmax of each frequency bin across every
+    time window, and then the argmax of those row maxima across every
+    frequency window. As np.argmax returns the first occurrence of the maximum
+    in both passes, ties are broken in the same row-major order as an argmax
+    over the whole window. With Numba, a compiled kernel does the same
+    without the intermediate arrays.
+
+    Arguments:
+        spectrogram {NumPy Array} -- Time-frequency magnitude representation of
+                                     signal
+
+    Keyword Arguments:
+        tau {int} --  Window size in time direction (default: {29})
+        kappa {int} -- Window size in frequency direction (default: {66})
+        hop_tau {int} -- Hop size in time direction (default: {6})
+        hop_kappa {int} -- Hop size in frequency direction (default: {17})
+
+    Returns:
+        tuple -- NumPy Arrays of shape (n_freq_steps, n_time_steps) holding
+                 the frequency and time indices of the peak in each window
+    """
+    # calculate how many hops we will make along each axis
+    n_freq_steps =\
+        int(np.floor((spectrogram.shape[0] - 2 * kappa) / hop_kappa))
+    n_time_steps = int(np.floor((spectrogram.shape[1] - 2 * tau) / hop_tau))
+
+    if n_freq_steps <= 0 or n_time_steps <= 0:
+        empty = np.zeros((0, 0), dtype=np.intp)
+        return empty, empty
+
+    if jit_kernels.use_jit:
+        return window_peak_kernel(
+            np.asarray(spectrogram), tau, kappa, hop_tau, hop_kappa,
+            n_freq_steps, n_time_steps)
+
+    # strided view of shape (n_freq_bins, n_time_steps, 2 * tau) holding the
+    # time windows of every frequency bin — no data is copied here
+    time_windows = sliding_window_view(
+        spectrogram, 2 * tau, axis=1)[:, ::hop_tau][:, :n_time_steps]
+    time_argmax = np.argmax(time_windows, axis=-1)
+    row_maxima = np.take_along_axis(
+        time_windows, time_argmax[..., np.newaxis], axis=-1)[..., 0]
+
+    # strided view of shape (n_freq_steps, n_time_steps, 2 * kappa) over the
+    # row maxima, telling us which frequency bin holds each window's peak
+    freq_windows = sliding_window_view(
+        row_maxima, 2 * kappa, axis=0)[::hop_kappa][:n_freq_steps]
+    time_steps = np.arange(n_time_steps)
+    peak_freqs = np.arange(n_freq_steps)[:, np.newaxis] * hop_kappa\
+        + np.argmax(freq_windows, axis=-1)
+
+    # and look up where in its time window that bin peaked
+    peak_times = time_steps * hop_tau + time_argmax[peak_freqs, time_steps]
+
+    return peak_freqs, peak_times
+
+
+def strongest_in_groups(groups, magnitudes, n):
+    """
+    Mark the n largest magnitudes within each group of a set of points. Ties
+    go to whichever point comes first.
+
+    Arguments:
+        groups {NumPy Array} -- Group of each point
+        magnitudes {NumPy Array} -- Magnitude of each point
+        n {int} -- Number of points to keep in each group
+
+    Returns:
+        NumPy Array -- Boolean mask of the points to keep
+    """
+    # sort by group, then loudest first, and number the points in each group
+    order = np.lexsort((np.arange(len(groups)), -magnitudes, groups))
+    sorted_groups = groups[order]
+    group_starts = np.flatnonzero(
+        np.concatenate(([True], sorted_groups[1:] != sorted_groups[:-1])))
+    ranks = np.arange(len(groups)) - np.repeat(
+        group_starts, np.diff(np.append(group_starts, len(groups))))
+
+    keep = np.zeros(len(groups), dtype=bool)
+    keep[order] = ranks < n
+    return keep
+
+
+def limit_peak_density(
+        peak_freqs,
+        peak_times,
+        peak_magnitudes,
+        max_peaks_per_frame=None,
+        min_magnitude=None):
+    """
+    Drop peaks below an amplitude floor, and all but the strongest peaks in
+    each STFT frame.
+
+    Arguments:
+        peak_freqs {NumPy Array} -- Frequency indices of distinct peaks
+        peak_times {NumPy Array} -- Time indices of the peaks
+        peak_magnitudes {NumPy Array} -- Magnitudes of the peaks
+
+    Keyword Arguments:
+        max_peaks_per_frame {int} -- Most peaks to keep in any frame, or None
+                                     for no limit (default: {None})
+        min_magnitude {float} -- Quietest magnitude to keep a peak at, or
+                                 None for no floor (default: {None})
+
+    Returns:
+        NumPy Array -- Boolean mask of the peaks to keep
+    """
+    keep = np.ones(len(peak_freqs), dtype=bool)
+    if min_magnitude is not None:
+        keep &= peak_magnitudes >= min_magnitude
+    if max_peaks_per_frame is not None:
+        keep[keep] = strongest_in_groups(
+            peak_times[keep], peak_magnitudes[keep], max_peaks_per_frame)
+    return keep
+
+
+def pick_peaks(
+        spectrogram,
+        tau=DEFAULT_TAU,
+        kappa=DEFAULT_KAPPA,
+        hop_tau=DEFAULT_HOP_TAU,
+        hop_kappa=DEFAULT_HOP_KAPPA,
+        method="window",
+        max_peaks_per_frame=None,
+        min_magnitude=None):
+    """
     Given a spectrogram, finds peaks within window specified by parameters.
     Window shape will be (2 * kappa + 1, 2 * tau + 1)
 
-    Default parameters selected by random search.
+    Default parameters selected by random search. Together with
+    max_pairs_per_anchor in create_pairwise_hashes, max_peaks_per_frame puts
+    a hard upper bound on the number of hashes per second of audio:
+    max_peaks_per_frame * max_pairs_per_anchor * SAMPLE_RATE / HOP_LENGTH.
     
     Arguments:
         spectrogram {NumPy Array} -- Time-frequency magnitude representation of
@@ -50,131 +243,493 @@ def pick_peaks(
         kappa {int} -- Window size in frequency direction (default: {59})
         hop_tau {int} -- Hop size in time direction (default: {11})
         hop_kappa {int} -- Hop size in frequency direction (default: {74})
+        method {str} -- "window" takes the maximum of each hopped window.
+                        "max_filter" instead marks every point that is the
+                        maximum of the window centred on it, ignoring the hop
+                        sizes. (default: {"window"})
+        max_peaks_per_frame {int} -- Most peaks to keep in any STFT frame,
+                                     strongest first, or None for no limit
+                                     (default: {None})
+        min_magnitude {float} -- Quietest magnitude to keep a peak at, or
+                                 None for no floor (default: {None})
     
     Returns:
-        NumPy Array -- A sparse NumPy array of same shape as the input. Peaks
-                       will be signified by ones and non-peaks by zeros.
+        NumPy Array -- Structured array of dtype PEAK_DTYPE with one entry
+                       per peak, sorted by time then frequency. Each peak's
+                       magnitude is kept so that we can later choose between
+                       them.
     """    
-    # create empty array to store peaks
-    peaks = np.zeros_like(spectrogram)
+    if method == "window":
+        peak_freqs, peak_times = window_peak_coordinates(
+            spectrogram, tau, kappa, hop_tau, hop_kappa)
+    elif method == "max_filter":
+        # a point is a peak if nothing in its neighbourhood is louder. We skip
+        # zero magnitude points so that digital silence isn't one giant peak
+        local_maxima = maximum_filter(
+            spectrogram,
+            size=(2 * kappa + 1, 2 * tau + 1),
+            mode="constant",
+            cval=-np.inf)
+        peak_freqs, peak_times =\
+            np.nonzero((spectrogram == local_maxima) & (spectrogram > 0))
+    else:
+        raise ValueError("Unknown peak picking method: %s" % method)
 
-    # calculate how many hops we will make along each axis
-    n_freq_steps =\
-        int(np.floor((spectrogram.shape[0] - 2 * kappa) / hop_kappa))
-    n_time_steps = int(np.floor((spectrogram.shape[1] - 2 * tau) / hop_tau))
+    peaks = peak_list(
+        peak_freqs, peak_times, spectrogram[peak_freqs, peak_times],
+        spectrogram.shape[0])
 
-    for n in range(n_time_steps):
-        for k in range(n_freq_steps):
-            # calculate the bounds of our window
-            freq_lower = k * hop_kappa
-            freq_upper = k * hop_kappa + 2 * kappa
-            time_lower = n * hop_tau
-            time_upper = n * hop_tau + 2 * tau
+    if max_peaks_per_frame is not None or min_magnitude is not None:
+        peaks = peaks[limit_peak_density(
+            peaks["freq"],
+            peaks["time"],
+            peaks["magnitude"],
+            max_peaks_per_frame,
+            min_magnitude)]
+    
+    return peaks
 
-            # find the time and frequency indices of the peak in our window
-            window = spectrogram[freq_lower:freq_upper, time_lower:time_upper]
-            peak = np.unravel_index(np.argmax(window), window.shape)
 
-            # store the peak in the main array
-            peaks[freq_lower + peak[0], time_lower + peak[1]] = 1
-    
+def peak_list(peak_freqs, peak_times, peak_magnitudes, n_freq_bins):
+    """
+    Given the co-ordinates of a set of spectral peaks, some of which may be
+    found more than once (as by overlapping peak picking windows), return
+    each distinct peak once, sorted by time, then by frequency.
+
+    Arguments:
+        peak_freqs {NumPy Array} -- Frequency indices of peaks
+        peak_times {NumPy Array} -- Time indices of peaks
+        peak_magnitudes {NumPy Array} -- Magnitudes of peaks
+        n_freq_bins {int} -- Number of frequency bins in the spectrogram
+
+    Returns:
+        NumPy Array -- Structured array of dtype PEAK_DTYPE
+    """
+    peak_keys, first = np.unique(
+        np.ravel(peak_times).astype(np.int64) * n_freq_bins
+        + np.ravel(peak_freqs),
+        return_index=True)
+
+    peaks = np.empty(len(peak_keys), dtype=PEAK_DTYPE)
+    peaks["time"], peaks["freq"] = np.divmod(peak_keys, n_freq_bins)
+    # peaks in silence still need a positive magnitude
+    peaks["magnitude"] = np.maximum(
+        np.ravel(peak_magnitudes)[first].astype(np.float32),
+        np.finfo(np.float32).tiny)
+
     return peaks
 
 
+def optional_magnitudes(peaks):
+    """
+    The magnitudes of a list of spectral peaks, or None if they weren't kept.
+    """
+    return peaks["magnitude"] if "magnitude" in peaks.dtype.names else None
+
+
+def pair_candidate_batches(
+        peak_freqs,
+        peak_times,
+        zone_lo,
+        n_candidates,
+        target_freq_height,
+        max_pairs_per_anchor,
+        peak_magnitudes):
+    """
+    Pair each anchor with the peaks of its target zone that fall inside the
+    zone's frequency extent, keeping only its strongest targets if limited.
+
+    Returns:
+        tuple -- NumPy Arrays of the indices of the anchor and target of each
+                 pair, by anchor and then target
+    """
+    # split the anchors into batches so that we never hold more than roughly
+    # PAIR_CANDIDATES_PER_BATCH candidate pairings in memory at once
+    candidates_so_far = np.cumsum(n_candidates)
+    batch_ends = np.searchsorted(
+        candidates_so_far,
+        np.arange(
+            PAIR_CANDIDATES_PER_BATCH,
+            candidates_so_far[-1] if len(candidates_so_far) > 0 else 0,
+            PAIR_CANDIDATES_PER_BATCH),
+        side="right")
+    batch_bounds = np.concatenate(([0], batch_ends, [len(peak_times)]))
+
+    anchors = []
+    targets = []
+    for batch_start, batch_end in zip(batch_bounds[:-1], batch_bounds[1:]):
+        counts = n_candidates[batch_start:batch_end]
+        # index of the anchor and target of every candidate pairing
+        anchor = np.repeat(np.arange(batch_start, batch_end), counts)
+        target = np.arange(len(anchor))\
+            - np.repeat(np.cumsum(counts) - counts, counts)\
+            + np.repeat(zone_lo[batch_start:batch_end], counts)
+
+        # keep only targets inside the frequency extent of the zone
+        in_zone =\
+            (peak_freqs[target] >= peak_freqs[anchor] - target_freq_height)\
+            & (peak_freqs[target] < peak_freqs[anchor] + target_freq_height)
+        anchor = anchor[in_zone]
+        target = target[in_zone]
+
+        # every candidate of an anchor is in the same batch, so we can keep
+        # just its strongest targets here
+        if max_pairs_per_anchor is not None:
+            strongest = strongest_in_groups(
+                anchor, peak_magnitudes[target], max_pairs_per_anchor)
+            anchor = anchor[strongest]
+            target = target[strongest]
+
+        anchors.append(anchor)
+        targets.append(target)
+
+    return np.concatenate(anchors), np.concatenate(targets)
+
+
+def find_peak_pair_array(
+        peak_freqs,
+        peak_times,
+        target_time_offset=DEFAULT_TARGET_TIME_OFFSET,
+        target_time_width=DEFAULT_TARGET_TIME_WIDTH,
+        target_freq_height=DEFAULT_TARGET_FREQ_HEIGHT,
+        max_pairs_per_anchor=None,
+        peak_magnitudes=None):
+    """
+    Given the co-ordinates of a set of spectral peaks sorted by time, find all
+    peak pairs according to a given set of window parameters in one batch.
+    Each anchor's target zone spans a contiguous run of the time-sorted peaks,
+    which we find with a binary search rather than by scanning a peak matrix.
+    Pairs are returned in the same order find_peak_pairs has always produced
+    them: by anchor frequency, anchor time, target frequency and target time.
+    With Numba, a compiled kernel pairs each anchor with its targets in one
+    pass rather than in batches of candidates.
+
+    Arguments:
+        peak_freqs {NumPy Array} -- Frequency indices of peaks
+        peak_times {NumPy Array} -- Time indices of peaks, in ascending order
+
+    Keyword Arguments:
+        target_time_offset {int} -- Offset of window from peak (default: {96})
+        target_time_width {int} -- Width of window in time (default: {76})
+        target_freq_height {int} -- Height of window in frequency
+                                    (default: {80})
+        max_pairs_per_anchor {int} -- Most pairs to make from any anchor,
+                                      keeping those with the strongest
+                                      targets, or None for no limit
+                                      (default: {None})
+        peak_magnitudes {NumPy Array} -- Magnitudes of the peaks, needed
+                                         to limit pairs per anchor
+                                         (default: {None})
+
+    Returns:
+        NumPy Array -- Structured array of dtype PEAK_PAIR_DTYPE with one
+                       entry per peak pair
+    """
+    peak_freqs = np.asarray(peak_freqs, dtype=np.int64)
+    peak_times = np.asarray(peak_times, dtype=np.int64)
+    if max_pairs_per_anchor is not None and peak_magnitudes is None:
+        raise ValueError("Limiting pairs per anchor needs peak magnitudes")
+
+    # the target zone of each anchor covers peaks [zone_lo, zone_hi) in time
+    zone_lo = np.searchsorted(
+        peak_times, peak_times + target_time_offset, side="left")
+    zone_hi = np.searchsorted(
+        peak_times,
+        peak_times + target_time_offset + target_time_width,
+        side="left")
+    n_candidates = zone_hi - zone_lo
+
+    if jit_kernels.use_jit:
+        anchor, target = pair_candidates_kernel(
+            peak_freqs,
+            zone_lo,
+            zone_hi,
+            target_freq_height,
+            -1 if max_pairs_per_anchor is None else max_pairs_per_anchor,
+            np.zeros(0, dtype=np.float32) if peak_magnitudes is None
+            else np.asarray(peak_magnitudes))
+    else:
+        anchor, target = pair_candidate_batches(
+            peak_freqs,
+            peak_times,
+            zone_lo,
+            n_candidates,
+            target_freq_height,
+            max_pairs_per_anchor,
+            peak_magnitudes)
+
+    # put pairs in the order of the original frequency-major peak scan
+    order = np.lexsort((
+        peak_times[target],
+        peak_freqs[target],
+        peak_times[anchor],
+        peak_freqs[anchor]))
+    anchor = anchor[order]
+    target = target[order]
+
+    pairs = np.empty(len(anchor), dtype=PEAK_PAIR_DTYPE)
+    pairs["anchor_freq"] = peak_freqs[anchor]
+    pairs["target_freq"] = peak_freqs[target]
+    pairs["dt"] = peak_times[target] - peak_times[anchor]
+    pairs["anchor_time"] = peak_times[anchor]
+
+    return pairs
+
+
 def find_peak_pairs(
         peaks,
         target_time_offset=DEFAULT_TARGET_TIME_OFFSET,
         target_time_width=DEFAULT_TARGET_TIME_WIDTH,
-        target_freq_height=DEFAULT_TARGET_FREQ_HEIGHT):
+        target_freq_height=DEFAULT_TARGET_FREQ_HEIGHT,
+        max_pairs_per_anchor=None):
     """
-    Given a sparse array of spectral peaks, find all peak pairs according to
-    a given set of window parameters.
+    Given a list of spectral peaks, find all peak pairs according to a given
+    set of window parameters. This is a compatibility wrapper around
+    find_peak_pair_array, yielding one dict per pair.
     
     Arguments:
-        peaks {NumPy Array} -- Sparse array of spectral peaks
+        peaks {NumPy Array} -- Spectral peaks, as returned by pick_peaks
     
     Keyword Arguments:
         target_time_offset {int} -- Offset of window from peak (default: {3})
         target_time_width {int} -- Width of window in time (default: {196})
         target_freq_height {int} -- Height of window in frequency
                                     (default: {220})
+        max_pairs_per_anchor {int} -- Most pairs to make from any anchor
+                                      (default: {None})
     """        
+    pairs = find_peak_pair_array(
+        peaks["freq"],
+        peaks["time"],
+        target_time_offset,
+        target_time_width,
+        target_freq_height,
+        max_pairs_per_anchor,
+        optional_magnitudes(peaks))
 
-    # create an array of shape (N, 2) of the co-ordinates of all N peaks in
-    # our sparse peak array
-    points = np.dstack(np.nonzero(peaks)).squeeze()
+    for anchor_freq, target_freq, dt, anchor_time in pairs.tolist():
+        yield {
+            "peak_pair": (anchor_freq, target_freq, dt),
+            "offset": anchor_time
+        }
 
-    for point in points:
-        # define the bounds of our target zone
-        freq_lo = max(point[0] - target_freq_height, 0)
-        freq_hi = min(point[0] + target_freq_height, peaks.shape[0])
-        time_lo = point[1] + target_time_offset
-        time_hi = time_lo + target_time_width
+def pair_hash_layout(pair_searching_options={}, n_freq_bins=1 + N_FFT // 2):
+    """
+    The hash layout create_pairwise_hashes will use for spectrograms from
+    extract_spectral_peaks with the given pair searching options.
 
-        # if we've passed the end of the array then skip this iteration
-        if time_lo > peaks.shape[1]:
-            continue
+    Keyword Arguments:
+        pair_searching_options {dict} -- Optional dict of keyword args to pair
+                                         searching algorithm (default: {{}})
+        n_freq_bins {int} -- Number of frequency bins in the spectrogram
+                             (default: {1025})
+
+    Returns:
+        dict -- The hash layout
+    """
+    return hash_layout(
+        n_freq_bins,
+        pair_searching_options.get(
+            "target_time_offset", DEFAULT_TARGET_TIME_OFFSET),
+        pair_searching_options.get(
+            "target_time_width", DEFAULT_TARGET_TIME_WIDTH))
+
+
+def check_feature_version(fingerprints, path_to_fingerprints):
+    """
+    Warn if a loaded database, or any of its segments, was built from
+    features of a different version to those queries are now made from.
+
+    Arguments:
+        fingerprints {dict} -- The loaded database
+        path_to_fingerprints {str} -- Path to the database, to name it by
+    """
+    versions = sorted(set(
+        segment["metadata"].get("feature_version", 1)
+        for segment in fingerprints["segments"]))
+    if versions != [FEATURE_VERSION]:
+        warnings.warn(
+            "%s was built with feature version %s, but queries use version "
+            "%d, so fewer of them may be identified. Rebuild it to match."
+            % (path_to_fingerprints, " and ".join(map(str, versions)),
+               FEATURE_VERSION))
+
+
+def hash_record_dtype(layout):
+    """
+    The structured dtype of the (hash, offset) records produced by
+    create_pairwise_hashes for a given hash layout.
+    """
+    return np.dtype([("hash", layout["dtype"]), ("offset", np.int32)])
 
-        # pull our target zone out of the sparse peak array
-        target_zone = peaks[freq_lo:freq_hi, time_lo:time_hi]
-
-        # again create another array of point co-ordinates, this time just in
-        # our target zone
-        target_points = np.dstack(np.nonzero(target_zone)).reshape(-1, 2)
-        for target_point in target_points:
-            # create our hashable tuple: (k_1, k_2, n_2 - n_1)
-            peak_pair = (
-                point[0],
-                freq_lo + target_point[0],
-                (time_lo + target_point[1]) - point[1])
-            
-            # using yield rather than return, we can call this function as a
-            # generator which means we can write a pretty dict comprehension
-            # and take advantage of some of python's (modest) optimisations:
-            yield {
-                "peak_pair": peak_pair,
-                "offset": point[1]
-            }
 
 def create_pairwise_hashes(
         peaks,
         target_time_offset=DEFAULT_TARGET_TIME_OFFSET,
         target_time_width=DEFAULT_TARGET_TIME_WIDTH,
-        target_freq_height=DEFAULT_TARGET_FREQ_HEIGHT):
+        target_freq_height=DEFAULT_TARGET_FREQ_HEIGHT,
+        max_pairs_per_anchor=None,
+        n_freq_bins=1 + N_FFT // 2):
     """
-    Given a sparse array of spectral peaks, create a list of peak pair hashes
-    and their corresponding time offsets.
+    Given a list of spectral peaks, create an array of packed peak pair
+    hashes and their corresponding time offsets.
     
     Arguments:
-        peaks {NumPy Array} -- Sparse array of spectral peaks
+        peaks {NumPy Array} -- Spectral peaks, as returned by pick_peaks
     
     Keyword Arguments:
         target_time_offset {int} -- Offset of window from peak (default: {3})
         target_time_width {int} -- Width of window in time (default: {196})
         target_freq_height {int} -- Height of window in frequency
                                     (default: {220})
+        max_pairs_per_anchor {int} -- Most pairs to make from any anchor,
+                                      keeping those with the strongest
+                                      targets, or None for no limit. Needs
+                                      the peaks' magnitudes.
+                                      (default: {None})
+        n_freq_bins {int} -- Number of frequency bins in the spectrogram the
+                             peaks were picked from (default: {1025})
+
+    Returns:
+        NumPy Array -- Structured array with a "hash" and an "offset" field
+                       for every peak pair
     """        
 
-    # find all our peak pairs according to the criteria passed as arguments,
-    # and construct a list of them along with their offset times. Note that as
-    # we will be storing these in a Python dict (the fastest implementation of 
-    # a hash table available to us in Python) and tuples are immutable and
-    # therefore hashable, we don't need to explicitly calculate a hash value
-    # and can instead directly use them as keys
-    return [{
-            "hash": pair["peak_pair"],
-            "offset": int(pair["offset"])
-        } for pair in find_peak_pairs(
-            peaks,
-            target_time_offset,
-            target_time_width,
-            target_freq_height
-        )]
-
-
-def extract_spectral_peaks(path_to_audio, peak_picking_options={}):
-    """
-    Given an audio file, create a fingerprint (sparse array of spectral peaks)
+    # find all our peak pairs according to the criteria passed as arguments
+    pairs = find_peak_pair_array(
+        peaks["freq"],
+        peaks["time"],
+        target_time_offset,
+        target_time_width,
+        target_freq_height,
+        max_pairs_per_anchor,
+        optional_magnitudes(peaks))
+
+    # rather than keying our tables on (k_1, k_2, n_2 - n_1) tuples, which
+    # cost a tuple and three boxed integers each, pack each pair into a single
+    # unsigned integer that NumPy can store unboxed and Python hashes quickly
+    layout = hash_layout(n_freq_bins, target_time_offset, target_time_width)
+
+    hashes = np.empty(len(pairs), dtype=hash_record_dtype(layout))
+    hashes["hash"] = encode_hashes(
+        pairs["anchor_freq"], pairs["target_freq"], pairs["dt"], layout)
+    hashes["offset"] = pairs["anchor_time"]
+
+    return hashes
+
+
+def frame_magnitudes(frames):
+    """
+    Compute the magnitude spectra of a stack of STFT frames. Every STFT in
+    this package goes through here, so spectrograms are computed identically
+    whether files are analysed one at a time, in batches, or streamed.
+
+    Arguments:
+        frames {NumPy Array} -- Frames of audio, with N_FFT samples along the
+                                last axis
+
+    Returns:
+        NumPy Array -- Magnitude spectra, with 1 + N_FFT // 2 bins along the
+                       last axis
+    """
+    # scipy's FFT keeps single precision input in single precision, which
+    # is several times faster than NumPy's
+    return np.abs(rfft(frames * STFT_WINDOW, axis=-1))
+
+
+def stft_magnitudes(signals):
+    """
+    Compute the magnitude spectrograms of several signals in one pass. The
+    signals are stacked, zero padding any shorter ones, and the same frames
+    of every signal are transformed together, a block at a time, so the
+    per-call overhead and FFT planning are shared by the whole batch. Frames
+    are centred and zero padded as librosa's STFT does.
+
+    Arguments:
+        signals {list} -- Mono audio signals at SAMPLE_RATE
+
+    Returns:
+        list -- Magnitude STFT of each signal, of shape
+                (1 + N_FFT // 2, 1 + len(signal) // HOP_LENGTH)
+    """
+    if len(signals) == 0:
+        return []
+
+    # pad the start and end of each signal with half a frame of silence, so
+    # frame n is centred on sample n * HOP_LENGTH
+    lengths = [len(x) for x in signals]
+    batch = np.zeros(
+        (len(signals), max(lengths) + N_FFT), dtype=np.float32)
+    for x, padded in zip(signals, batch):
+        padded[N_FFT // 2:N_FFT // 2 + len(x)] = x
+
+    n_frames = [1 + length // HOP_LENGTH for length in lengths]
+    frames = sliding_window_view(
+        batch, N_FFT, axis=1)[:, ::HOP_LENGTH][:, :max(n_frames)]
+
+    spectrograms = np.empty(
+        (len(signals), 1 + N_FFT // 2, max(n_frames)), dtype=np.float32)
+    block = max(STFT_BLOCK_FRAMES // len(signals), 1)
+    for start in range(0, max(n_frames), block):
+        spectrograms[..., start:start + block] = np.swapaxes(
+            frame_magnitudes(frames[:, start:start + block]), 1, 2)
+
+    # trim off frames that only covered another signal's padding
+    return [
+        np.ascontiguousarray(spectrogram[:, :n])
+        for spectrogram, n in zip(spectrograms, n_frames)]
+
+
+def compute_spectrogram(path_to_audio, decoding_options={}):
+    """
+    Load an audio file and compute its magnitude spectrogram.
+
+    Arguments:
+        path_to_audio {str} -- Path on disk to audio file
+
+    Keyword Arguments:
+        decoding_options {dict} -- Optional dict of keyword args to load_audio
+                                   (default: {{}})
+
+    Returns:
+        NumPy Array -- Magnitude STFT of the audio
+    """
+    return compute_spectrograms([path_to_audio], decoding_options)[0]
+
+
+def compute_spectrograms(paths_to_audio, decoding_options={}):
+    """
+    Load several audio files and compute their magnitude spectrograms in a
+    single batch.
+
+    Arguments:
+        paths_to_audio {list} -- Paths on disk to audio files
+
+    Keyword Arguments:
+        decoding_options {dict} -- Optional dict of keyword args to load_audio
+                                   (default: {{}})
+
+    Returns:
+        list -- Magnitude STFT of each file
+    """
+    # load audio
+    with stage_timer("decode"):
+        signals = [
+            load_audio(path, SAMPLE_RATE, **decoding_options)
+            for path in paths_to_audio]
+
+    # compute STFTs
+    with stage_timer("stft"):
+        return stft_magnitudes(signals)
+
+
+def extract_spectral_peaks(
+        path_to_audio,
+        peak_picking_options={},
+        cache_options={},
+        decoding_options={}):
+    """
+    Given an audio file, create a fingerprint (list of spectral peaks)
     
     Arguments:
         path_to_audio {str} -- Path on disk to audio file
@@ -184,20 +739,294 @@ def extract_spectral_peaks(path_to_audio, peak_picking_options={}):
                                        picking alogrithm. Useful for performing
                                        searches across parameter space for
                                        optimal combinations. (default: {{}})
+        cache_options {dict} -- Optional dict with the "path" of a feature
+                                cache folder and its "max_bytes". The file's
+                                spectrogram and peaks are read from the cache
+                                if present, and stored in it if not. An empty
+                                dict disables caching. (default: {{}})
+        decoding_options {dict} -- Optional dict of keyword args to load_audio,
+                                   choosing how the file is decoded and which
+                                   region of it is read (default: {{}})
     
     Returns:
-        [type] -- [description]
+        NumPy Array -- Spectral peaks of the file, as returned by pick_peaks
     """    
-    # load audio
-    x, _ = librosa.load(path_to_audio)
+    return extract_spectral_peaks_batch(
+        [path_to_audio],
+        peak_picking_options,
+        cache_options,
+        decoding_options)[0]
 
-    # compute STFT
-    X = np.abs(librosa.core.stft(x))
 
-    # pick peaks
-    peaks = pick_peaks(X, **peak_picking_options)
+def extract_spectral_peaks_batch(
+        paths_to_audio,
+        peak_picking_options={},
+        cache_options={},
+        decoding_options={}):
+    """
+    Given several audio files, create their fingerprints, computing the
+    spectrograms of every file not already cached in a single batch. Batches
+    of equal length files, such as 30 second clips, waste no work on padding.
 
-    return peaks
+    Arguments:
+        paths_to_audio {list} -- Paths on disk to audio files
+
+    Keyword Arguments:
+        As for extract_spectral_peaks
+
+    Returns:
+        list -- Spectral peaks of each file, as returned by pick_peaks
+    """
+    if not cache_options:
+        spectrograms = compute_spectrograms(paths_to_audio, decoding_options)
+        with stage_timer("peaks"):
+            return [
+                pick_peaks(X, **peak_picking_options) for X in spectrograms]
+
+    # peaks depend on both the audio and how we pick them, whereas the
+    # spectrogram can be shared by every set of peak picking options. Both
+    # are keyed on the feature version, so a change to how spectrograms are
+    # computed never reads back entries computed the old way
+    spectrogram_options = dict(
+        {
+            "sr": SAMPLE_RATE,
+            "n_fft": N_FFT,
+            "feature_version": FEATURE_VERSION
+        },
+        **decoding_options)
+    audio_hashes = [content_hash(path) for path in paths_to_audio]
+    peaks_keys = [
+        cache_key(audio_hash, spectrogram_options, peak_picking_options)
+        for audio_hash in audio_hashes]
+    spectrogram_keys = [
+        cache_key(audio_hash, spectrogram_options)
+        for audio_hash in audio_hashes]
+
+    all_peaks = []
+    for peaks_key in peaks_keys:
+        cached = cache_get(cache_options, "peaks", peaks_key)
+        all_peaks.append(cached["peaks"] if cached is not None else None)
+
+    spectrograms = {}
+    for n, peaks in enumerate(all_peaks):
+        if peaks is not None:
+            continue
+        cached = cache_get(cache_options, "spectrogram", spectrogram_keys[n])
+        if cached is not None:
+            spectrograms[n] = cached["spectrogram"]
+
+    # compute every spectrogram we're still missing in one batch
+    missing = [
+        n for n, peaks in enumerate(all_peaks)
+        if peaks is None and n not in spectrograms]
+    for n, X in zip(
+            missing,
+            compute_spectrograms(
+                [paths_to_audio[n] for n in missing], decoding_options)):
+        cache_put(
+            cache_options, "spectrogram", spectrogram_keys[n],
+            {"spectrogram": X})
+        spectrograms[n] = X
+
+    for n, X in sorted(spectrograms.items()):
+        # pick peaks
+        with stage_timer("peaks"):
+            peaks = pick_peaks(X, **peak_picking_options)
+
+        cache_put(cache_options, "peaks", peaks_keys[n], {"peaks": peaks})
+        all_peaks[n] = peaks
+
+    return all_peaks
+
+
+def fingerprint_files(
+        paths_to_audio,
+        peak_picking_options={},
+        pair_searching_options={},
+        cache_options={},
+        decoding_options={}):
+    """
+    Compute the pairwise hashes of a batch of audio files, extracting their
+    peaks with extract_spectral_peaks_batch. Defined at module level so that
+    it can be sent to worker processes.
+
+    Arguments:
+        paths_to_audio {list} -- Paths on disk to audio files
+
+    Keyword Arguments:
+        peak_picking_options {dict} -- Optional dict of keyword args to peak
+                                       picking algorithm (default: {{}})
+        pair_searching_options {dict} -- Optional dict of keyword args to pair
+                                         searching algorithm (default: {{}})
+        cache_options {dict} -- Optional dict of feature cache options, as
+                                taken by extract_spectral_peaks
+                                (default: {{}})
+        decoding_options {dict} -- Optional dict of audio decoding options,
+                                   as taken by extract_spectral_peaks
+                                   (default: {{}})
+
+    Returns:
+        list -- Array of hashes and offsets of each file, the time taken in
+                seconds and the metrics of each stage (see
+                instrumentation.py), sharing the batch's extraction time and
+                metrics equally
+    """
+    # start timing hash creation
+    batch_start_time = time.perf_counter()
+
+    # pick out spectral peaks
+    with collect_metrics() as batch_metrics:
+        fingerprints = extract_spectral_peaks_batch(
+            paths_to_audio,
+            peak_picking_options,
+            cache_options,
+            decoding_options)
+    extraction_time =\
+        (time.perf_counter() - batch_start_time) / max(len(paths_to_audio), 1)
+
+    results = []
+    for fingerprint in fingerprints:
+        hash_start_time = time.perf_counter()
+        # compute hashes
+        with collect_metrics() as metrics:
+            with stage_timer("pairs"):
+                hashes = create_pairwise_hashes(
+                    fingerprint, **pair_searching_options)
+            count("hashes_created", len(hashes))
+        results.append((
+            hashes,
+            extraction_time + time.perf_counter() - hash_start_time,
+            merge_metrics(
+                metrics, batch_metrics, 1 / max(len(paths_to_audio), 1))))
+
+    return results
+
+
+def fingerprint_folder(
+        path_to_db,
+        peak_picking_options={},
+        pair_searching_options={},
+        workers=1,
+        cache_options={},
+        decoding_options={},
+        batch_size=DEFAULT_BATCH_SIZE,
+        metrics_options={}):
+    """
+    Compute the pairwise hashes of every WAV file in a folder, reporting
+    progress as we go.
+
+    Arguments:
+        path_to_db {str} -- Path to folder containing audio files
+
+    Keyword Arguments:
+        peak_picking_options {dict} -- Optional dict of keyword args to peak
+                                       picking algorithm (default: {{}})
+        pair_searching_options {dict} -- Optional dict of keyword args to pair
+                                         searching algorithm (default: {{}})
+        workers {int} -- Number of processes to fingerprint files with. The
+                         results are identical whatever the number.
+                         (default: {1})
+        cache_options {dict} -- Optional dict of feature cache options, as
+                                taken by extract_spectral_peaks
+                                (default: {{}})
+        decoding_options {dict} -- Optional dict of audio decoding options,
+                                   as taken by extract_spectral_peaks
+                                   (default: {{}})
+        batch_size {int} -- Number of files to compute spectrograms of
+                            together (default: {8})
+        metrics_options {dict} -- Optional dict with the path of a
+                                  "json_lines" file to append each file's
+                                  metrics to (default: {{}})
+
+    Returns:
+        tuple -- List of file names, a list of the array of hashes and
+                 offsets of each file, and the metrics of fingerprinting
+                 them all
+    """
+    # initialise timer
+    start_time = time.perf_counter()
+
+    # rather than one big dict of hashes, keep each document's hash array
+    # and build a sorted index from them all at the end
+    doc_names = []
+    doc_hashes = []
+    # each file's metrics are collected wherever it was fingerprinted, and
+    # summed here
+    folder_metrics = new_metrics()
+
+    # set of hashes seen so far, useful for tracking how many new hashes each
+    # file contributes
+    seen_hashes = set()
+
+    # skip over non-wav files
+    entries = [
+        entry for entry in os.scandir(path_to_db)
+        if os.path.splitext(entry.name)[1] == ".wav"]
+
+    extract = partial(
+        fingerprint_files,
+        peak_picking_options=peak_picking_options,
+        pair_searching_options=pair_searching_options,
+        cache_options=cache_options,
+        decoding_options=decoding_options)
+
+    # fingerprint the files in batches, so their spectrograms can be computed
+    # together
+    batches = [
+        [entry.path for entry in entries[start:start + batch_size]]
+        for start in range(0, len(entries), batch_size)]
+
+    with ExitStack() as stack:
+        if workers > 1:
+            # fan batches out to a pool of processes. imap hands results back
+            # in the order the batches were submitted, so documents are merged
+            # in the same order as a serial build
+            pool = stack.enter_context(Pool(workers))
+            results = chain.from_iterable(pool.imap(extract, batches))
+        else:
+            results = chain.from_iterable(map(extract, batches))
+
+        n_processed = 0
+        for entry in entries:
+            print_status(
+                "fp_analysing_fingerprint", {"now_analysing": entry.name}
+            )
+
+            hashes, time_to_create, metrics = next(results)
+
+            doc_names.append(entry.name)
+            doc_hashes.append(hashes)
+            merge_metrics(folder_metrics, metrics)
+
+            last_seen_length = len(seen_hashes)
+            seen_hashes.update(np.unique(hashes["hash"]).tolist())
+
+            # find the current time to calculate performance
+            time_now = time.perf_counter()
+            n_processed += 1
+            print_status(
+                "fp_fingerprint_created",
+                {
+                    "file_name": entry.name,
+                    "num_hashes": len(hashes),
+                    "num_new_hashes": len(seen_hashes) - last_seen_length,
+                    "total_hashes": len(seen_hashes),
+                    "files_processed": n_processed,
+                    "time_to_create": "%.3f" % time_to_create,
+                    "total_time": "%.3f" % (time_now - start_time)
+                })
+            export_event(
+                metrics_options,
+                dict(
+                    {
+                        "event": "file",
+                        "file": entry.name,
+                        "n_hashes": len(hashes),
+                        "time_to_create": time_to_create
+                    },
+                    **metrics))
+
+    return doc_names, doc_hashes, folder_metrics
 
 
 @enable_printing
@@ -205,7 +1034,14 @@ def fingerprintBuilder(
         path_to_db,
         path_to_fingerprints,
         peak_picking_options={},      
-        pair_searching_options={}):   
+        pair_searching_options={},
+        workers=1,
+        cache_options={},
+        pruning_options={},
+        decoding_options={},
+        batch_size=DEFAULT_BATCH_SIZE,
+        n_shards=1,
+        metrics_options={}):   
     """
     The main entry point for our fingerprint builder application.
     
@@ -220,73 +1056,174 @@ def fingerprintBuilder(
                                        picking algorithm (default: {{}})
         pair_searching_options {dict} -- Optional dict of keyword args to pair
                                          searching algorithm (default: {{}})
-    """        
+        workers {int} -- Number of processes to fingerprint files with. The
+                         database is identical whatever the number.
+                         (default: {1})
+        cache_options {dict} -- Optional dict of feature cache options, as
+                                taken by extract_spectral_peaks
+                                (default: {{}})
+        pruning_options {dict} -- Optional dict of keyword args to prune_index
+                                  ("max_doc_fraction" and "method") to prune
+                                  stop hashes with. An empty dict keeps every
+                                  hash. (default: {{}})
+        decoding_options {dict} -- Optional dict of audio decoding options,
+                                   as taken by extract_spectral_peaks
+                                   (default: {{}})
+        batch_size {int} -- Number of files to compute spectrograms of
+                            together. The database is identical whatever the
+                            number. (default: {8})
+        n_shards {int} -- Number of shards to split the database into by hash
+                          range, each written to its own file next to
+                          path_to_fingerprints (default: {1})
+        metrics_options {dict} -- Optional dict with the path of a
+                                  "json_lines" file to append each file's
+                                  and the whole build's metrics to, and of a
+                                  "prometheus" textfile to write the build's
+                                  metrics to (default: {{}})
 
-    print_status("fp_blank_status", {})
-    # initialise timer
+    Returns:
+        dict -- Metrics of the build, as collected by instrumentation.py
+    """        
     start_time = time.perf_counter()
+    print_status("fp_blank_status", {})
 
-    # initialise our fingerprints dict
-    fingerprints = {}
+    doc_names, doc_hashes, metrics = fingerprint_folder(
+        path_to_db,
+        peak_picking_options,
+        pair_searching_options,
+        workers,
+        cache_options,
+        decoding_options,
+        batch_size,
+        metrics_options)
 
-    # last count of fingerprints is useful for tracking how many new hashes
-    # each file contributes
-    last_fingerprints_length = 0
+    print_status(
+        "fp_writing_db",
+        { "db_file": path_to_fingerprints }
+    )
 
-    n_processed = 0
-    for entry in os.scandir(path_to_db):
-        # skip over non-wav files
-        if os.path.splitext(entry.name)[1] != ".wav":
-            continue
+    # write the database to disk as a sorted array inverted index, which is
+    # far smaller than a pickled dict of dicts and needs no unpickling
+    with collect_metrics() as write_metrics, stage_timer("db_write"):
+        if n_shards > 1:
+            save_sharded_db(
+                path_to_fingerprints,
+                doc_names,
+                doc_hashes,
+                pair_hash_layout(pair_searching_options),
+                n_shards,
+                pruning_options,
+                {"feature_version": FEATURE_VERSION})
+        else:
+            index = build_index(
+                doc_names,
+                doc_hashes,
+                pair_hash_layout(pair_searching_options))
+            index["metadata"]["feature_version"] = FEATURE_VERSION
+            if pruning_options:
+                index = prune_index(index, **pruning_options)
+            save_index(index, path_to_fingerprints)
+            discard_stale_shards(path_to_fingerprints)
 
-        print_status(
-            "fp_analysing_fingerprint", {"now_analysing": entry.name}
-        )
+        # any segments added to a previous database at this path are now
+        # stale
+        discard_segments(path_to_fingerprints)
+    merge_metrics(metrics, write_metrics)
 
-        # start timing hash creation
-        hash_start_time = time.perf_counter()
+    export_run_metrics(
+        metrics_options,
+        "fingerprinting",
+        metrics,
+        {
+            "n_files": len(doc_names),
+            "elapsed_seconds": time.perf_counter() - start_time
+        })
 
-        # pick out spectral peaks
-        fingerprint = extract_spectral_peaks(entry.path, peak_picking_options)
-        # compute hashes
-        hashes = create_pairwise_hashes(fingerprint, **pair_searching_options)
-
-        for hash in hashes:
-            # if we haven't seen this hash before - computable in O(1)
-            if hash["hash"] not in fingerprints:
-                # create an empty list at this hash's address
-                fingerprints[hash["hash"]] = []
-
-            # append the appropriate file name and time offset under this hash
-            fingerprints[hash["hash"]].append({
-                "name": entry.name,
-                "offset": hash["offset"]
-            })
-
-        # find the current time to calculate performance
-        time_now = time.perf_counter()
-        n_processed += 1
-        print_status(
-            "fp_fingerprint_created",
-            {
-                "file_name": entry.name,
-                "num_hashes": len(hashes),
-                "num_new_hashes":
-                    len(fingerprints) - last_fingerprints_length,
-                "total_hashes": len(fingerprints),
-                "files_processed": n_processed,
-                "time_to_create": "%.3f" % (time_now - hash_start_time),
-                "total_time": "%.3f" % (time_now - start_time)
-            })
-        last_fingerprints_length = len(fingerprints)
+    return metrics
+
+
+@enable_printing
+def fingerprintAppend(
+        path_to_db,
+        path_to_fingerprints,
+        peak_picking_options={},
+        pair_searching_options={},
+        workers=1,
+        max_segments=DEFAULT_MAX_SEGMENTS,
+        cache_options={},
+        decoding_options={},
+        batch_size=DEFAULT_BATCH_SIZE,
+        metrics_options={}):
+    """
+    Add a folder of audio files to an existing fingerprint database. Only the
+    new files are fingerprinted: they are written to a new segment alongside
+    the database, so the cost is proportional to the number of new files.
+    Files with the same name as documents already in the database replace
+    them. Every max_segments additions the segments are compacted back into a
+    single file. New segments aren't pruned of stop hashes, but compaction
+    prunes the merged database as the original build did.
+
+    Arguments:
+        path_to_db {str} -- Path to folder containing new audio files
+        path_to_fingerprints {str} -- Path to existing database file
+
+    Keyword Arguments:
+        peak_picking_options {dict} -- Optional dict of keyword args to peak
+                                       picking algorithm. Must match the
+                                       database's. (default: {{}})
+        pair_searching_options {dict} -- Optional dict of keyword args to pair
+                                         searching algorithm. Must match the
+                                         database's. (default: {{}})
+        workers {int} -- Number of processes to fingerprint files with
+                         (default: {1})
+        max_segments {int} -- Number of segments at which to compact the
+                              database (default: {8})
+        cache_options {dict} -- Optional dict of feature cache options, as
+                                taken by extract_spectral_peaks
+                                (default: {{}})
+        decoding_options {dict} -- Optional dict of audio decoding options,
+                                   as taken by extract_spectral_peaks
+                                   (default: {{}})
+        batch_size {int} -- Number of files to compute spectrograms of
+                            together (default: {8})
+        metrics_options {dict} -- Optional dict of metrics exporters, as
+                                  taken by fingerprintBuilder (default: {{}})
+
+    Returns:
+        dict -- Metrics of the addition, as collected by instrumentation.py
+    """
+    start_time = time.perf_counter()
+    print_status("fp_blank_status", {})
+
+    doc_names, doc_hashes, metrics = fingerprint_folder(
+        path_to_db,
+        peak_picking_options,
+        pair_searching_options,
+        workers,
+        cache_options,
+        decoding_options,
+        batch_size,
+        metrics_options)
 
     print_status(
         "fp_writing_db",
         { "db_file": path_to_fingerprints }
     )
 
-    # write the database to disk
-    with open(path_to_fingerprints, "wb") as f:
-        # using HIGHEST_PROTOCOL allows pickle to read/write faster and deal
-        # with bigger files
-        pickle.dump(fingerprints, f, pickle.HIGHEST_PROTOCOL)
+    with collect_metrics() as write_metrics, stage_timer("db_write"):
+        index = build_index(
+            doc_names, doc_hashes, pair_hash_layout(pair_searching_options))
+        index["metadata"]["feature_version"] = FEATURE_VERSION
+        add_segment(path_to_fingerprints, index, max_segments)
+    merge_metrics(metrics, write_metrics)
+
+    export_run_metrics(
+        metrics_options,
+        "appending",
+        metrics,
+        {
+            "n_files": len(doc_names),
+            "elapsed_seconds": time.perf_counter() - start_time
+        })
+
+    return metrics
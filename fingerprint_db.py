@@ -0,0 +1,1484 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: fingerprint_db.py
+Description: Reads and writes fingerprint databases stored as a compact
+             inverted index: a sorted array of packed hashes, the (document
+             ID, offset) postings under each hash and a table of document
+             names. On disk, posting lists are delta and varint encoded in
+             small blocks, and only the blocks a query touches are decoded.
+             Large databases can be split by hash range into shards that are
+             loaded and searched independently. Can also be called directly
+             as a script to convert a pickled database to the index format.
+"""
+from argparse import ArgumentParser
+from bisect import bisect_right
+import hashlib
+import json
+import mmap as mmap_module
+import os
+import pickle
+
+import numpy as np
+
+INDEX_MAGIC = b"AFPINDEX"
+INDEX_VERSION = 2
+# version 1 indexes stored their postings uncompressed, and can still be read
+READABLE_INDEX_VERSIONS = [1, 2]
+# sections of the index file start on multiples of this many bytes
+SECTION_ALIGNMENT = 64
+# arrays of an index in memory, laid out on disk in this order by version 1
+INDEX_SECTIONS = ["hashes", "posting_starts", "postings", "doc_names"]
+# order in which a packed index's arrays are laid out on disk
+PACKED_INDEX_SECTIONS =\
+    ["hashes", "block_starts", "packed_postings", "doc_names"]
+# sections only written when the index has them, after the required ones
+OPTIONAL_INDEX_SECTIONS = ["pruned_hashes"]
+
+# number of consecutive hashes whose posting lists are packed into a block.
+# A lookup decodes the whole block holding a hash, so smaller blocks decode
+# less, but need a longer table of where each block starts
+POSTING_BLOCK_SIZE = 16
+
+POSTING_DTYPE = np.dtype([("doc_id", np.uint32), ("offset", np.uint32)])
+
+# a database can be extended by segments, listed in a manifest next to it
+MANIFEST_SUFFIX = ".manifest"
+SEGMENT_SUFFIX = ".seg%04d"
+# once a database has this many segments (including the base), adding
+# another merges them all back into one
+DEFAULT_MAX_SEGMENTS = 8
+
+# a database can instead be split by hash range into shards, stored next to a
+# base file holding just the document names and the shards' boundaries
+SHARD_SUFFIX = ".shard%04d"
+# every this many of a document's hashes is sampled to choose boundaries that
+# give each shard roughly as many postings
+SHARD_SAMPLE_STRIDE = 16
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("pickled_db")
+    parser.add_argument("index_db")
+    parser.add_argument("--target_time_offset", type=int)
+    parser.add_argument("--target_time_width", type=int)
+
+    return parser.parse_args()
+
+
+def hash_layout(n_freq_bins, target_time_offset, target_time_width):
+    """
+    Work out how to bit-pack a peak pair (k_1, k_2, n_2 - n_1) into a single
+    unsigned integer. Both frequencies get enough bits to hold any STFT bin
+    index, and the time delta is stored relative to the start of the target
+    zone so that it only needs enough bits for the zone's width. Packed
+    hashes sort in the same order as the tuples they encode.
+
+    Arguments:
+        n_freq_bins {int} -- Number of frequency bins in the spectrogram
+        target_time_offset {int} -- Offset of target zone from anchor peak
+        target_time_width {int} -- Width of target zone in time
+
+    Returns:
+        dict -- The hash layout: bit widths of each field, the time delta
+                offset, and the NumPy dtype holding the packed hashes
+    """
+    freq_bits = max(int(n_freq_bins - 1).bit_length(), 1)
+    dt_bits = max(int(target_time_width - 1).bit_length(), 1)
+    total_bits = 2 * freq_bits + dt_bits
+
+    if total_bits > 64:
+        raise ValueError(
+            "Peak pairs need %d bits, which won't pack into 64" % total_bits)
+
+    return {
+        "freq_bits": freq_bits,
+        "dt_bits": dt_bits,
+        "dt_offset": int(target_time_offset),
+        "dtype": np.dtype(np.uint32 if total_bits <= 32 else np.uint64).str
+    }
+
+
+def encode_hashes(anchor_freq, target_freq, dt, layout):
+    """
+    Pack arrays of peak pair components into integer hashes.
+
+    Arguments:
+        anchor_freq {NumPy Array} -- Frequency bin of each anchor peak (k_1)
+        target_freq {NumPy Array} -- Frequency bin of each target peak (k_2)
+        dt {NumPy Array} -- Time delta between the peaks (n_2 - n_1)
+        layout {dict} -- Hash layout, as returned by hash_layout
+
+    Returns:
+        NumPy Array -- The packed hashes, of the layout's dtype
+    """
+    dtype = np.dtype(layout["dtype"])
+    anchor_freq = np.asarray(anchor_freq).astype(dtype)
+    target_freq = np.asarray(target_freq).astype(dtype)
+    dt = (np.asarray(dt) - layout["dt_offset"]).astype(dtype)
+    anchor_shift = dtype.type(layout["freq_bits"] + layout["dt_bits"])
+    target_shift = dtype.type(layout["dt_bits"])
+
+    return (anchor_freq << anchor_shift) | (target_freq << target_shift) | dt
+
+
+def decode_hashes(hashes, layout):
+    """
+    Unpack integer hashes back into their peak pair components.
+
+    Arguments:
+        hashes {NumPy Array} -- Packed hashes
+        layout {dict} -- Hash layout, as returned by hash_layout
+
+    Returns:
+        tuple -- NumPy Arrays of k_1, k_2 and n_2 - n_1 for each hash
+    """
+    hashes = np.asarray(hashes).astype(np.int64)
+    freq_mask = (1 << layout["freq_bits"]) - 1
+    dt_mask = (1 << layout["dt_bits"]) - 1
+
+    anchor_freq = hashes >> (layout["freq_bits"] + layout["dt_bits"])
+    target_freq = (hashes >> layout["dt_bits"]) & freq_mask
+    dt = (hashes & dt_mask) + layout["dt_offset"]
+
+    return anchor_freq, target_freq, dt
+
+
+def build_index(doc_names, doc_hashes, hash_layout):
+    """
+    Given the hashes found in each of a list of documents, build an inverted
+    index. Postings under each hash are ordered by document ID (i.e. the order
+    the documents were given in), and then by offset.
+
+    Arguments:
+        doc_names {list} -- File names of the documents
+        doc_hashes {list} -- Array of hashes and offsets for each document, as
+                             returned by create_pairwise_hashes
+        hash_layout {dict} -- Layout used to pack the hashes
+
+    Returns:
+        dict -- The fingerprint index
+    """
+    hash_dtype = np.dtype(hash_layout["dtype"])
+    hashes = np.concatenate(
+        [np.zeros(0, dtype=hash_dtype)]
+        + [hashes["hash"].astype(hash_dtype) for hashes in doc_hashes])
+    postings = np.empty(len(hashes), dtype=POSTING_DTYPE)
+    postings["doc_id"] = np.repeat(
+        np.arange(len(doc_hashes), dtype=np.uint32),
+        [len(hashes) for hashes in doc_hashes])
+    postings["offset"] = np.concatenate(
+        [np.zeros(0, dtype=np.uint32)]
+        + [hashes["offset"].astype(np.uint32) for hashes in doc_hashes])
+
+    return index_from_postings(doc_names, hashes, postings, hash_layout)
+
+
+def index_from_postings(doc_names, hashes, postings, hash_layout):
+    """
+    Build an inverted index from a flat, unsorted list of postings.
+
+    Arguments:
+        doc_names {list} -- File names of the documents
+        hashes {NumPy Array} -- Packed hash of every posting
+        postings {NumPy Array} -- (doc_id, offset) of every posting
+        hash_layout {dict} -- Layout used to pack the hashes
+
+    Returns:
+        dict -- The fingerprint index
+    """
+    # order postings by hash, then by document and offset, which keeps the
+    # gaps between them small once packed
+    order = np.lexsort((postings["offset"], postings["doc_id"], hashes))
+    hashes = hashes[order]
+    postings = postings[order]
+
+    # store each distinct hash once, along with where its run of postings
+    # starts — CSR style, so postings for unique_hashes[i] live in
+    # postings[posting_starts[i]:posting_starts[i + 1]]
+    unique_hashes, posting_starts = np.unique(hashes, return_index=True)
+    posting_starts = np.append(posting_starts, len(hashes)).astype(np.int64)
+    doc_names = doc_name_table(doc_names)
+
+    return {
+        "hash_layout": hash_layout,
+        # a generation lets us tell this index apart from whatever was
+        # previously stored at the same path. Deriving it from the contents
+        # keeps the same build byte for byte the same.
+        "metadata": {
+            "generation": content_generation(
+                hash_layout, unique_hashes, posting_starts, postings,
+                doc_names)
+        },
+        "hashes": unique_hashes,
+        "posting_starts": posting_starts,
+        "postings": postings,
+        "doc_names": doc_names
+    }
+
+
+def content_generation(*parts):
+    """
+    Derive a generation from the contents of an index, or of whatever it is
+    built from: a digest of any number of NumPy Arrays and JSON-serialisable
+    values. Only different contents give a different generation.
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(json.dumps(
+                [np.lib.format.dtype_to_descr(part.dtype), part.shape])
+                .encode("utf-8"))
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(json.dumps(
+                part, sort_keys=True, default=lambda value: value.item())
+                .encode("utf-8"))
+    return digest.hexdigest()
+
+
+def posting_doc_starts(index):
+    """
+    Mark the postings that start a new document within their hash's run of
+    postings. As postings under each hash are ordered by document, these are
+    the first posting of each (hash, document) pair.
+    """
+    doc_ids = index["postings"]["doc_id"]
+    doc_starts = np.ones(len(doc_ids), dtype=bool)
+    doc_starts[1:] = doc_ids[1:] != doc_ids[:-1]
+    doc_starts[index["posting_starts"][:-1]] = True
+    return doc_starts
+
+
+def hash_doc_counts(index):
+    """
+    Count the documents each of an index's hashes occurs in — its document
+    frequency.
+
+    Arguments:
+        index {dict} -- The fingerprint index
+
+    Returns:
+        NumPy Array -- Number of documents holding each of index["hashes"]
+    """
+    index = unpack_index(index)
+    if len(index["hashes"]) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.add.reduceat(
+        posting_doc_starts(index).astype(np.int64),
+        index["posting_starts"][:-1])
+
+
+def max_docs_for_fraction(max_doc_fraction, n_docs):
+    """
+    The most documents a hash may occur in before it's pruned, given the
+    fraction of n_docs allowed. At least one document is always allowed, so
+    that a hash unique to one document is never pruned, however few
+    documents there are.
+
+    Arguments:
+        max_doc_fraction {float} -- Fraction of documents a hash may occur
+                                    in, greater than 0 and at most 1
+        n_docs {int} -- Number of documents in the index
+
+    Returns:
+        int -- The most documents a hash may occur in
+    """
+    if not 0 < max_doc_fraction <= 1:
+        raise ValueError(
+            "max_doc_fraction must be greater than 0 and at most 1, not %r"
+            % max_doc_fraction)
+    return max(int(max_doc_fraction * n_docs), 1)
+
+
+def prune_index(index, max_doc_fraction, method="drop", pruned_hashes=None):
+    """
+    Prune stop hashes — those occurring in more than max_doc_fraction of the
+    documents, such as pairs of low frequency bins or artefacts of silence —
+    from an index. Their long posting lists are expensive to walk at query
+    time but say little about which document a query came from. The pruning
+    options and totals are recorded in the index's metadata, and the pruned
+    hashes themselves in its "pruned_hashes" array.
+
+    Arguments:
+        index {dict} -- The fingerprint index
+        max_doc_fraction {float} -- Fraction of documents a hash may occur in
+                                    before it is pruned, greater than 0 and
+                                    at most 1. However small, a hash in
+                                    just one document is never pruned.
+
+    Keyword Arguments:
+        method {str} -- "drop" to remove every posting of a stop hash, or
+                        "cap" to keep those from the first documents holding
+                        it, up to the most allowed (default: {"drop"})
+        pruned_hashes {NumPy Array} -- Hashes to prune whatever their document
+                                       frequency, e.g. those pruned from an
+                                       index being merged (default: {None})
+
+    Returns:
+        dict -- The pruned index
+    """
+    if method not in ["drop", "cap"]:
+        raise ValueError("Unknown pruning method %s" % method)
+    index = unpack_index(index)
+
+    max_docs = max_docs_for_fraction(
+        max_doc_fraction, len(index["doc_names"]))
+    starts = index["posting_starts"]
+    run_lengths = np.diff(starts)
+
+    stop = hash_doc_counts(index) > max_docs
+    if pruned_hashes is not None:
+        stop |= np.isin(index["hashes"], pruned_hashes)
+
+    keep = ~np.repeat(stop, run_lengths)
+    if method == "cap" and len(keep) > 0:
+        # number each posting's document among those holding its hash
+        doc_counts = np.cumsum(posting_doc_starts(index))
+        doc_ranks =\
+            doc_counts - np.repeat(doc_counts[starts[:-1]], run_lengths)
+        keep |= doc_ranks < max_docs
+
+    # drop hashes left with no postings, and close up the gaps
+    kept_lengths = np.add.reduceat(keep.astype(np.int64), starts[:-1])\
+        if len(keep) > 0 else np.zeros(0, dtype=np.int64)
+    kept_hashes = kept_lengths > 0
+
+    # hashes pruned earlier may have no postings left here to prune, but
+    # are still recorded
+    all_pruned_hashes = index["hashes"][stop]
+    if pruned_hashes is not None:
+        all_pruned_hashes = np.union1d(
+            all_pruned_hashes,
+            np.asarray(pruned_hashes, dtype=index["hashes"].dtype))
+
+    metadata = dict(index.get("metadata", {}))
+    metadata["pruning"] = {
+        "max_doc_fraction": max_doc_fraction,
+        "method": method,
+        "max_docs": max_docs,
+        "n_pruned_hashes": len(all_pruned_hashes),
+        "n_pruned_postings": int(len(keep) - np.sum(keep))
+    }
+
+    return dict(
+        index,
+        metadata=metadata,
+        hashes=index["hashes"][kept_hashes],
+        posting_starts=np.append(
+            0, np.cumsum(kept_lengths[kept_hashes])).astype(np.int64),
+        postings=index["postings"][keep],
+        pruned_hashes=all_pruned_hashes)
+
+
+def doc_name_table(doc_names):
+    """
+    Store a list of document names as a fixed width byte string array, which
+    can be written to and read from disk without any parsing.
+    """
+    return np.array(
+        [name.encode("utf-8") for name in doc_names], dtype=np.bytes_)\
+        if len(doc_names) > 0 else np.zeros(0, dtype="S1")
+
+
+def index_doc_name(index, doc_id):
+    """
+    Look up the file name of a document in the index by its ID.
+    """
+    return index["doc_names"][doc_id].decode("utf-8")
+
+
+def doc_name(fingerprints, doc_id):
+    """
+    Look up the file name of a document in a loaded database by its ID.
+    """
+    segment = bisect_right(fingerprints["doc_id_bases"], doc_id) - 1
+    return index_doc_name(
+        fingerprints["segments"][segment],
+        doc_id - fingerprints["doc_id_bases"][segment])
+
+
+def find_hash_positions(index, hashes):
+    """
+    Binary search an index's sorted hashes for each of a set of hashes.
+
+    Returns:
+        tuple -- NumPy Arrays of the position of each hash among the index's
+                 hashes, and whether it's there at all
+    """
+    hashes = np.asarray(hashes, dtype=index["hashes"].dtype)
+    if len(index["hashes"]) == 0:
+        return\
+            np.zeros(len(hashes), dtype=np.int64),\
+            np.zeros(len(hashes), dtype=bool)
+
+    positions = np.searchsorted(index["hashes"], hashes)
+    positions = np.minimum(positions, len(index["hashes"]) - 1)
+    return positions, index["hashes"][positions] == hashes
+
+
+def find_posting_ranges(index, hashes):
+    """
+    Find where the postings for each of a set of hashes are stored in an
+    unpacked index, using a binary search over the index's sorted hashes.
+
+    Arguments:
+        index {dict} -- The fingerprint index
+        hashes {NumPy Array} -- Packed hashes to look up
+
+    Returns:
+        tuple -- NumPy Arrays of the start and end of each hash's run of
+                 postings. Hashes not in the index get an empty run.
+    """
+    positions, found = find_hash_positions(index, hashes)
+    if len(index["hashes"]) == 0:
+        return positions, positions
+
+    starts = index["posting_starts"][positions]
+    ends = np.where(found, index["posting_starts"][positions + 1], starts)
+
+    return starts, ends
+
+
+def expand_ranges(starts, lengths):
+    """
+    Every index in a set of ranges, one range after another.
+    """
+    return np.arange(np.sum(lengths), dtype=np.int64)\
+        - np.repeat(np.cumsum(lengths) - lengths, lengths)\
+        + np.repeat(starts, lengths)
+
+
+def find_postings(index, hashes):
+    """
+    Gather the postings of each of a set of hashes in one vectorised pass.
+    Only the blocks of a packed index holding the hashes are decoded.
+
+    Arguments:
+        index {dict} -- The fingerprint index, packed or not
+        hashes {NumPy Array} -- Packed hashes to look up
+
+    Returns:
+        tuple -- NumPy Arrays of the postings of every hash, one hash after
+                 another, and the number of postings of each hash. Hashes not
+                 in the index have none.
+    """
+    if "postings" in index:
+        starts, ends = find_posting_ranges(index, hashes)
+        return index["postings"][expand_ranges(starts, ends - starts)],\
+            ends - starts
+
+    positions, found = find_hash_positions(index, hashes)
+    counts = np.zeros(len(positions), dtype=np.int64)
+    if not np.any(found):
+        return np.zeros(0, dtype=POSTING_DTYPE), counts
+
+    block_size = index["posting_block_size"]
+    blocks, block_numbers = np.unique(
+        positions[found] // block_size, return_inverse=True)
+    postings, posting_starts, block_hash_bases =\
+        unpack_blocks(index, blocks)
+
+    # where each hash's postings are among those of the decoded blocks
+    slots = block_hash_bases[block_numbers] + positions[found] % block_size
+    starts = np.zeros(len(positions), dtype=np.int64)
+    starts[found] = posting_starts[slots]
+    counts[found] = posting_starts[slots + 1] - starts[found]
+
+    return postings[expand_ranges(starts, counts)], counts
+
+
+def encode_varints(values):
+    """
+    Encode unsigned integers as varints: seven bits to a byte, least
+    significant first, with the top bit of every byte but a value's last set.
+
+    Arguments:
+        values {NumPy Array} -- Non-negative integers
+
+    Returns:
+        tuple -- NumPy Arrays of the encoded bytes, and where each value's
+                 bytes start
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    remaining = values >> np.uint64(7)
+    while np.any(remaining):
+        n_bytes += remaining > 0
+        remaining >>= np.uint64(7)
+    starts = np.cumsum(n_bytes) - n_bytes
+
+    data = np.zeros(int(np.sum(n_bytes)), dtype=np.uint8)
+    for n in range(int(np.max(n_bytes, initial=0))):
+        has_byte = n_bytes > n
+        chunks = (values[has_byte] >> np.uint64(7 * n)) & np.uint64(0x7f)
+        more = (n_bytes[has_byte] > n + 1).astype(np.uint64) << np.uint64(7)
+        data[starts[has_byte] + n] = chunks | more
+
+    return data, starts
+
+
+def decode_varints(data):
+    """
+    Decode a run of whole varints, as written by encode_varints.
+    """
+    data = np.asarray(data, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80) + 1
+    if len(ends) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    starts = np.append(0, ends[:-1])
+
+    # shift each byte's seven bits by its place within its value — as they
+    # don't overlap, summing the shifted chunks puts the value together
+    places = np.arange(len(data)) - np.repeat(starts, ends - starts)
+    chunks = (data & 0x7f).astype(np.uint64) << (7 * places).astype(np.uint64)
+    return np.add.reduceat(chunks, starts)
+
+
+def segmented_cumsum(values, resets):
+    """
+    Cumulative sum of values, starting again wherever resets is True. The
+    first value must start a segment.
+    """
+    totals = np.cumsum(values)
+    reset_positions = np.flatnonzero(resets)
+    bases = totals[reset_positions] - values[reset_positions]
+    return totals - bases[np.cumsum(resets) - 1]
+
+
+def pack_index(index):
+    """
+    Compress an index's posting lists for writing to disk. Hashes are split
+    into blocks of POSTING_BLOCK_SIZE. Each block is a run of varints: the
+    number of postings of each of its hashes, followed by their postings, in
+    order of document and offset. Each posting stores the gap from the last
+    posting's document, and its offset — as a gap from the last posting's
+    offset if both are in the same document. Only the start of each block is
+    stored in full, so a hash's postings can be found by decoding its block.
+
+    Arguments:
+        index {dict} -- The fingerprint index
+
+    Returns:
+        dict -- The packed index, with the "block_starts" of each block in
+                "packed_postings" in place of "posting_starts" and "postings"
+    """
+    if "packed_postings" in index:
+        return index
+
+    n_hashes = len(index["hashes"])
+    lengths = np.diff(index["posting_starts"])
+    hash_numbers = np.repeat(np.arange(n_hashes), lengths)
+    # version 1 indexes ordered postings within a document by where the hash
+    # occurred rather than by offset
+    order = np.lexsort((
+        index["postings"]["offset"],
+        index["postings"]["doc_id"],
+        hash_numbers))
+    doc_ids = index["postings"]["doc_id"][order].astype(np.int64)
+    offsets = index["postings"]["offset"][order].astype(np.int64)
+
+    list_starts = np.zeros(len(doc_ids), dtype=bool)
+    list_starts[index["posting_starts"][:-1][lengths > 0]] = True
+    doc_gaps = np.diff(doc_ids, prepend=0)
+    doc_gaps[list_starts] = doc_ids[list_starts]
+    new_docs = list_starts | (doc_gaps != 0)
+    offset_gaps = np.diff(offsets, prepend=0)
+    offset_gaps[new_docs] = offsets[new_docs]
+
+    # lay each block's lengths out before its postings' pairs of values
+    block_size = POSTING_BLOCK_SIZE
+    block_firsts = np.arange(0, n_hashes, block_size)
+    block_hash_counts = np.minimum(block_size, n_hashes - block_firsts)
+    block_value_starts =\
+        block_firsts + 2 * index["posting_starts"][block_firsts]
+    hash_blocks = np.arange(n_hashes) // block_size
+    posting_blocks = hash_blocks[hash_numbers]
+
+    values = np.zeros(n_hashes + 2 * len(doc_ids), dtype=np.uint64)
+    values[block_value_starts[hash_blocks]
+           + np.arange(n_hashes) % block_size] = lengths
+    pair_starts = block_value_starts[posting_blocks]\
+        + block_hash_counts[posting_blocks]\
+        + 2 * (np.arange(len(doc_ids))
+               - index["posting_starts"][block_firsts][posting_blocks])
+    values[pair_starts] = doc_gaps
+    values[pair_starts + 1] = offset_gaps
+
+    packed_postings, value_byte_starts = encode_varints(values)
+    block_starts = np.append(
+        value_byte_starts[block_value_starts], len(packed_postings))
+
+    packed = {
+        name: value for name, value in index.items()
+        if name not in ["posting_starts", "postings"]}
+    packed.update({
+        "block_starts": block_starts.astype(np.int64),
+        "packed_postings": packed_postings,
+        "posting_block_size": block_size,
+        "n_postings": len(doc_ids)
+    })
+    return packed
+
+
+def unpack_blocks(index, blocks):
+    """
+    Decode the posting lists of some of the blocks of a packed index.
+
+    Arguments:
+        index {dict} -- The packed fingerprint index
+        blocks {NumPy Array} -- Ascending numbers of the blocks to decode
+
+    Returns:
+        tuple -- NumPy Arrays of the postings of every hash in the blocks,
+                 where each hash's postings start among them (and where the
+                 last ends), and where each block's hashes start among the
+                 decoded hashes
+    """
+    block_size = index["posting_block_size"]
+    byte_starts = index["block_starts"][blocks]
+    byte_lengths = index["block_starts"][blocks + 1] - byte_starts
+    data = index["packed_postings"][expand_ranges(byte_starts, byte_lengths)]
+    values = decode_varints(data).astype(np.int64)
+
+    # every block ends on a value's last byte, so counting those finds where
+    # each block's values start
+    value_ends = np.cumsum(data < 0x80)
+    block_value_starts = np.append(
+        0, value_ends[np.cumsum(byte_lengths)[:-1] - 1])
+    block_hash_counts = np.minimum(
+        block_size, len(index["hashes"]) - blocks * block_size)
+    block_hash_bases = np.append(0, np.cumsum(block_hash_counts))
+
+    lengths = values[expand_ranges(block_value_starts, block_hash_counts)]
+    block_posting_counts = np.add.reduceat(lengths, block_hash_bases[:-1])
+    pairs = values[expand_ranges(
+        block_value_starts + block_hash_counts,
+        2 * block_posting_counts)].reshape(-1, 2)
+
+    posting_starts = np.append(0, np.cumsum(lengths))
+    list_starts = np.zeros(len(pairs), dtype=bool)
+    list_starts[posting_starts[:-1][lengths > 0]] = True
+    new_docs = list_starts | (pairs[:, 0] != 0)
+
+    postings = np.empty(len(pairs), dtype=POSTING_DTYPE)
+    postings["doc_id"] = segmented_cumsum(pairs[:, 0], list_starts)
+    postings["offset"] = segmented_cumsum(pairs[:, 1], new_docs)
+
+    return postings, posting_starts, block_hash_bases
+
+
+def unpack_index(index):
+    """
+    Decode every posting list of a packed index, giving it back its
+    "posting_starts" and "postings". Unpacked indexes are returned as is.
+    """
+    if "postings" in index:
+        return index
+
+    n_blocks = len(index["block_starts"]) - 1
+    if n_blocks > 0:
+        postings, posting_starts, _ =\
+            unpack_blocks(index, np.arange(n_blocks))
+    else:
+        postings = np.zeros(0, dtype=POSTING_DTYPE)
+        posting_starts = np.zeros(1, dtype=np.int64)
+
+    unpacked = {
+        name: value for name, value in index.items()
+        if name not in [
+            "block_starts",
+            "packed_postings",
+            "posting_block_size",
+            "n_postings"]}
+    unpacked.update({
+        "posting_starts": posting_starts.astype(np.int64),
+        "postings": postings
+    })
+    return unpacked
+
+
+def save_index(index, path):
+    """
+    Write a fingerprint index to disk. The file is a short JSON header
+    describing the layout of each array, followed by the raw arrays
+    themselves, so that reading it back is a straight copy. Posting lists
+    are packed with pack_index first.
+
+    Arguments:
+        index {dict} -- The fingerprint index
+        path {str} -- Path to output file
+    """
+    index = pack_index(index)
+
+    # work out where each section goes. The header's size depends on the
+    # offsets it contains, so leave it plenty of room
+    header = {
+        "version": INDEX_VERSION,
+        "hash_layout": index["hash_layout"],
+        "metadata": index.get("metadata", {}),
+        "posting_block_size": index["posting_block_size"],
+        "n_postings": index["n_postings"],
+        "sections": {}
+    }
+    data_start = SECTION_ALIGNMENT * 64
+    position = data_start
+    sections = PACKED_INDEX_SECTIONS + [
+        name for name in OPTIONAL_INDEX_SECTIONS if name in index]
+    for name in sections:
+        header["sections"][name] = {
+            "dtype": np.lib.format.dtype_to_descr(index[name].dtype),
+            "shape": list(index[name].shape),
+            "offset": position
+        }
+        position += index[name].nbytes
+        position = -(-position // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    if len(INDEX_MAGIC) + 8 + len(header_bytes) > data_start:
+        raise ValueError("Fingerprint index header is too long")
+
+    # write to a temporary file and move it into place, so that anyone
+    # reading the index never sees it half written
+    with open(path + ".tmp", "wb") as f:
+        f.write(INDEX_MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name in sections:
+            f.seek(header["sections"][name]["offset"])
+            f.write(np.ascontiguousarray(index[name]).tobytes())
+        # pad the final section so the file is as long as the header says
+        f.truncate(position)
+    os.replace(path + ".tmp", path)
+
+
+def read_index_header(f):
+    """
+    Read the header of an index file, leaving the file positioned after it.
+    Returns None if the file isn't an index.
+    """
+    if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+        return None
+    header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+    header = json.loads(f.read(header_length).decode("utf-8"))
+    if header["version"] not in READABLE_INDEX_VERSIONS:
+        raise ValueError(
+            "Unsupported fingerprint index version %d" % header["version"])
+    return header
+
+
+def load_index(path, mmap=True):
+    """
+    Read a fingerprint index from disk. By default the file is memory-mapped
+    rather than read: the arrays are views straight onto the file, so opening
+    an index takes the same (tiny) time whatever its size, and pages are only
+    read from disk as lookups touch them. As the mapping is read-only and
+    shared, every process that opens the same index on a host shares one copy
+    of it in the page cache.
+
+    Arguments:
+        path {str} -- Path to index file
+
+    Keyword Arguments:
+        mmap {bool} -- Whether to memory-map the file rather than reading it
+                       into memory (default: {True})
+
+    Returns:
+        dict -- The fingerprint index, packed unless it was written by
+                version 1
+    """
+    with open(path, "rb") as f:
+        header = read_index_header(f)
+        if header is None:
+            raise ValueError("%s is not a fingerprint index" % path)
+
+        if mmap:
+            buffer = mmap_module.mmap(
+                f.fileno(), 0, access=mmap_module.ACCESS_READ)
+
+        index = {
+            "hash_layout": header["hash_layout"],
+            "metadata": header.get("metadata", {})
+        }
+        if header["version"] > 1:
+            index["posting_block_size"] = header["posting_block_size"]
+            index["n_postings"] = header["n_postings"]
+        for name, section in header["sections"].items():
+            dtype = np.lib.format.descr_to_dtype(section["dtype"])
+            count = int(np.prod(section["shape"]))
+            if mmap:
+                # the array keeps a reference to the mapping, which stays
+                # open for as long as the array is alive
+                index[name] = np.frombuffer(
+                    buffer, dtype=dtype, count=count, offset=section["offset"])
+            else:
+                f.seek(section["offset"])
+                index[name] = np.fromfile(f, dtype=dtype, count=count)
+            index[name] = index[name].reshape(section["shape"])
+
+    return index
+
+
+def index_from_pickle(fingerprints, hash_layout):
+    """
+    Convert a database in the old pickled format —
+    {hash: [{"name": str, "offset": int}, ...]} — to an inverted index.
+    Hashes may be (k_1, k_2, n_2 - n_1) tuples or already packed integers.
+
+    Arguments:
+        fingerprints {dict} -- The unpickled database
+        hash_layout {dict} -- Layout used to pack the hashes. This must match
+                              the pair searching options the database was
+                              built with.
+
+    Returns:
+        dict -- The fingerprint index
+    """
+    # the builder added documents one at a time, so each hash's posting list
+    # is in build order and whichever document a hash was first seen in
+    # heads its list. Ordering documents by when they first head a list
+    # therefore recovers the order they were built in.
+    doc_ids = {}
+    for postings in fingerprints.values():
+        doc_ids.setdefault(postings[0]["name"], len(doc_ids))
+    for postings in fingerprints.values():
+        for posting in postings:
+            doc_ids.setdefault(posting["name"], len(doc_ids))
+
+    keys = list(fingerprints.keys())
+    counts = [len(fingerprints[key]) for key in keys]
+    if len(keys) > 0 and isinstance(keys[0], tuple):
+        components = np.array(keys, dtype=np.int64).reshape(-1, 3)
+        keys = encode_hashes(
+            components[:, 0], components[:, 1], components[:, 2], hash_layout)
+    hashes = np.repeat(
+        np.asarray(keys, dtype=hash_layout["dtype"]), counts)
+
+    postings = np.empty(len(hashes), dtype=POSTING_DTYPE)
+    postings["doc_id"] = [
+        doc_ids[posting["name"]]
+        for key_postings in fingerprints.values()
+        for posting in key_postings]
+    postings["offset"] = [
+        posting["offset"]
+        for key_postings in fingerprints.values()
+        for posting in key_postings]
+
+    # sort by document within each hash, as build_index would have
+    order = np.argsort(postings["doc_id"], kind="stable")
+    return index_from_postings(
+        list(doc_ids), hashes[order], postings[order], hash_layout)
+
+
+def load_single_db(path, hash_layout, mmap=True):
+    """
+    Load a single fingerprint database file in either the index format or the
+    old pickled format, returning it as an index.
+
+    Arguments:
+        path {str} -- Path to fingerprint database file
+        hash_layout {dict} -- Layout to pack the hashes of a pickled database
+                              with. Index files record their own layout.
+
+    Keyword Arguments:
+        mmap {bool} -- Whether to memory-map index files (default: {True})
+
+    Returns:
+        dict -- The fingerprint index
+    """
+    with open(path, "rb") as f:
+        is_index = read_index_header(f) is not None
+
+    if is_index:
+        return load_index(path, mmap)
+
+    with open(path, "rb") as f:
+        fingerprints = pickle.load(f)
+    index = index_from_pickle(fingerprints, hash_layout)
+    # a converted pickle has no generation of its own on disk
+    index["metadata"] = {}
+    return index
+
+
+def shard_boundaries(doc_hashes, n_shards, hash_layout):
+    """
+    Choose hash boundaries that split a database's postings into n_shards
+    shards of roughly equal size, from a sample of its hashes. Shard n holds
+    the hashes from boundaries[n - 1] up to, but not including,
+    boundaries[n].
+
+    Arguments:
+        doc_hashes {list} -- Array of hashes and offsets for each document, as
+                             returned by create_pairwise_hashes
+        n_shards {int} -- Number of shards
+        hash_layout {dict} -- Layout used to pack the hashes
+
+    Returns:
+        NumPy Array -- The n_shards - 1 ascending boundaries between shards
+    """
+    hash_dtype = np.dtype(hash_layout["dtype"])
+    sample = np.sort(np.concatenate(
+        [np.zeros(0, dtype=hash_dtype)]
+        + [hashes["hash"][::SHARD_SAMPLE_STRIDE].astype(hash_dtype)
+           for hashes in doc_hashes]))
+    if len(sample) == 0:
+        return np.zeros(n_shards - 1, dtype=hash_dtype)
+
+    quantiles = np.arange(1, n_shards) * len(sample) // n_shards
+    return sample[quantiles]
+
+
+def shard_numbers(boundaries, hashes):
+    """
+    Find which shard each of a set of hashes belongs to.
+    """
+    return np.searchsorted(
+        boundaries, np.asarray(hashes, dtype=boundaries.dtype), side="right")
+
+
+def shard_path(path, number):
+    return path + SHARD_SUFFIX % number
+
+
+def save_sharded_db(
+        path,
+        doc_names,
+        doc_hashes,
+        hash_layout,
+        n_shards,
+        pruning_options={},
+        metadata={}):
+    """
+    Write a fingerprint database split by hash range into n_shards shards.
+    Each shard is built and written on its own, so only one shard's index is
+    ever held in memory. Every shard is a complete index in its own right,
+    numbering documents the same way, so it can be loaded alone to serve
+    just its range of hashes. The base file at path holds the document names
+    and the boundaries between shards, but no postings.
+
+    Arguments:
+        path {str} -- Path to the database's base file
+        doc_names {list} -- File names of the documents
+        doc_hashes {list} -- Array of hashes and offsets for each document, as
+                             returned by create_pairwise_hashes
+        hash_layout {dict} -- Layout used to pack the hashes
+        n_shards {int} -- Number of shards
+
+    Keyword Arguments:
+        pruning_options {dict} -- Optional dict of keyword args to prune_index.
+                                  Document frequency is counted per hash, so
+                                  each shard is pruned exactly as the whole
+                                  database would be. (default: {{}})
+        metadata {dict} -- Optional dict of further metadata to record in
+                           the base and every shard (default: {{}})
+    """
+    boundaries = shard_boundaries(doc_hashes, n_shards, hash_layout)
+    doc_shards = [
+        shard_numbers(boundaries, hashes["hash"]) for hashes in doc_hashes]
+    # shards are tied to the base they were built with, so a shard left over
+    # from another build is never mixed in. Only the same inputs give the
+    # same generation, and they give the same shards.
+    generation = content_generation(
+        doc_names, hash_layout, boundaries, pruning_options, *doc_hashes)
+
+    n_pruned_hashes = 0
+    n_pruned_postings = 0
+    for number in range(n_shards):
+        index = build_index(
+            doc_names,
+            [hashes[shards == number]
+             for hashes, shards in zip(doc_hashes, doc_shards)],
+            hash_layout)
+        index["metadata"].update(metadata)
+        if pruning_options:
+            index = prune_index(index, **pruning_options)
+            n_pruned_hashes += index["metadata"]["pruning"]["n_pruned_hashes"]
+            n_pruned_postings +=\
+                index["metadata"]["pruning"]["n_pruned_postings"]
+        index["metadata"]["shard"] = {
+            "generation": generation,
+            "number": number,
+            "n_shards": n_shards
+        }
+        save_index(index, shard_path(path, number))
+
+    # the base is written last, so until it is, the old base and its shards
+    # are what's found at path
+    base = build_index(doc_names, [], hash_layout)
+    base["metadata"].update(metadata)
+    base["metadata"]["shards"] = {
+        "generation": generation,
+        "files": [
+            os.path.basename(shard_path(path, number))
+            for number in range(n_shards)],
+        "boundaries": boundaries.tolist()
+    }
+    if pruning_options:
+        base["metadata"]["pruning"] = dict(
+            index["metadata"]["pruning"],
+            n_pruned_hashes=n_pruned_hashes,
+            n_pruned_postings=n_pruned_postings)
+    save_index(base, path)
+
+    discard_stale_shards(path, n_shards)
+
+
+def discard_stale_shards(path, n_shards=0):
+    """
+    Remove shard files left next to a database by an earlier build with more
+    shards than the current one's n_shards.
+    """
+    folder = os.path.dirname(path) or "."
+    prefix = os.path.basename(path) + SHARD_SUFFIX.split("%")[0]
+    current = set(
+        os.path.basename(shard_path(path, number))
+        for number in range(n_shards))
+    for entry in os.scandir(folder):
+        if entry.name.startswith(prefix) and entry.name not in current:
+            os.remove(entry.path)
+
+
+def load_shard(path, generation, mmap=True):
+    """
+    Load one shard of a sharded database, checking it belongs to the same
+    build as the base that lists it.
+
+    Arguments:
+        path {str} -- Path to the shard file
+        generation {str} -- Generation of the build recorded in the base
+
+    Keyword Arguments:
+        mmap {bool} -- Whether to memory-map the shard (default: {True})
+
+    Returns:
+        dict -- The shard, loaded as a database in its own right
+    """
+    shard = load_fingerprint_db(path, None, mmap)
+    if shard["segments"][0]["metadata"].get("shard", {})\
+            .get("generation") != generation:
+        raise ValueError("%s is from a different build of its database" % path)
+    return shard
+
+
+def merge_shards(fingerprints):
+    """
+    Join the loaded shards of a sharded database back into a single index.
+    Shards hold consecutive ranges of hashes, so this is a concatenation.
+
+    Arguments:
+        fingerprints {dict} -- The loaded database, with every shard loaded
+
+    Returns:
+        dict -- The merged index
+    """
+    if any(shard["fingerprints"] is None for shard in fingerprints["shards"]):
+        raise ValueError("Every shard must be loaded to merge them")
+
+    base = unpack_index(fingerprints["segments"][0])
+    indexes = [
+        unpack_index(shard["fingerprints"]["segments"][0])
+        for shard in fingerprints["shards"]]
+
+    posting_bases = np.cumsum(
+        [0] + [len(index["postings"]) for index in indexes])
+    index = dict(
+        base,
+        hashes=np.concatenate([index["hashes"] for index in indexes]),
+        posting_starts=np.append(
+            np.concatenate([
+                index["posting_starts"][:-1] + posting_base
+                for index, posting_base in zip(indexes, posting_bases)]),
+            posting_bases[-1]).astype(np.int64),
+        postings=np.concatenate([index["postings"] for index in indexes]))
+    pruned_hashes = [
+        index["pruned_hashes"] for index in indexes
+        if "pruned_hashes" in index]
+    if len(pruned_hashes) > 0:
+        index["pruned_hashes"] = np.concatenate(pruned_hashes)
+    return index
+
+
+def manifest_path(path):
+    return path + MANIFEST_SUFFIX
+
+
+def read_manifest(path):
+    """
+    Read the manifest listing a database's segments. Returns None if the
+    database has no segments, or if its manifest is left over from before
+    the base file was rebuilt or compacted.
+
+    Arguments:
+        path {str} -- Path to the database's base file
+
+    Returns:
+        dict -- The manifest, listing each segment's file name (relative to
+                the base file's folder) and the documents deleted from it
+    """
+    if not os.path.exists(manifest_path(path)):
+        return None
+
+    with open(manifest_path(path)) as f:
+        manifest = json.load(f)
+
+    with open(path, "rb") as f:
+        header = read_index_header(f)
+    generation = header.get("metadata", {}).get("generation")\
+        if header is not None else None
+    if generation is None or manifest["base_generation"] != generation:
+        return None
+
+    return manifest
+
+
+def write_manifest(path, manifest):
+    """
+    Atomically replace a database's manifest.
+    """
+    with open(manifest_path(path) + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(manifest_path(path) + ".tmp", manifest_path(path))
+
+
+def new_manifest(path):
+    """
+    Create the manifest for a database that has no segments yet beyond its
+    base file.
+    """
+    with open(path, "rb") as f:
+        header = read_index_header(f)
+    if header is None:
+        raise ValueError(
+            "%s must be converted to an index before it can be updated"
+            % path)
+    if "shards" in header.get("metadata", {}):
+        raise ValueError(
+            "%s is sharded, so must be rebuilt rather than updated" % path)
+
+    generation = header.get("metadata", {}).get("generation")
+    if generation is None:
+        # indexes written before segments existed don't have a generation,
+        # so give the base one by rewriting it
+        index = load_index(path, mmap=False)
+        index["metadata"]["generation"] = generation = content_generation(
+            *[index[name] for name in sorted(index)
+              if isinstance(index[name], np.ndarray)])
+        save_index(index, path)
+
+    return {
+        "base_generation": generation,
+        "next_segment": 1,
+        "segments": [{"file": os.path.basename(path), "deleted": []}]
+    }
+
+
+def segment_path(path, segment):
+    return os.path.join(os.path.dirname(path), segment["file"])
+
+
+def load_fingerprint_db(path, hash_layout, mmap=True, shards=None):
+    """
+    Load a fingerprint database — its base file along with any segments added
+    to it since it was last built or compacted. Documents in later segments
+    are numbered after those in earlier ones, and deleted documents are
+    masked out. If the database is sharded, its shards are loaded too.
+
+    Arguments:
+        path {str} -- Path to fingerprint database
+        hash_layout {dict} -- Layout to pack the hashes of a pickled database
+                              with. Index files record their own layout.
+
+    Keyword Arguments:
+        mmap {bool} -- Whether to memory-map index files (default: {True})
+        shards {list} -- Numbers of the shards of a sharded database to load,
+                         or None to load them all. Hashes in shards that
+                         aren't loaded match nothing. (default: {None})
+
+    Returns:
+        dict -- The database: its hash layout, its segments' indexes, the ID
+                of the first document in each segment, and a mask of the
+                deleted documents in each segment. A sharded database also
+                has the boundaries between its shards, and for each shard its
+                path and, if loaded, the shard as a database of its own.
+    """
+    manifest = read_manifest(path)
+    if manifest is None:
+        segments = [load_single_db(path, hash_layout, mmap)]
+        deleted_names = [[]]
+    else:
+        segments = [
+            load_index(segment_path(path, segment), mmap)
+            for segment in manifest["segments"]]
+        deleted_names = [
+            segment["deleted"] for segment in manifest["segments"]]
+
+    for segment in segments[1:]:
+        if segment["hash_layout"] != segments[0]["hash_layout"]:
+            raise ValueError(
+                "Segments of %s were built with different options" % path)
+
+    doc_id_bases = np.cumsum(
+        [0] + [len(segment["doc_names"]) for segment in segments[:-1]])
+
+    fingerprints = {
+        "hash_layout": segments[0]["hash_layout"],
+        "segments": segments,
+        "doc_id_bases": doc_id_bases.tolist(),
+        "deleted_docs": [
+            np.isin(segment["doc_names"], doc_name_table(names))
+            for segment, names in zip(segments, deleted_names)]
+    }
+
+    sharding = segments[0]["metadata"].get("shards")
+    if sharding is not None:
+        fingerprints["shard_generation"] = sharding["generation"]
+        fingerprints["shard_boundaries"] = np.array(
+            sharding["boundaries"], dtype=segments[0]["hashes"].dtype)
+        fingerprints["shards"] = []
+        for number, file in enumerate(sharding["files"]):
+            path_to_shard = os.path.join(os.path.dirname(path), file)
+            fingerprints["shards"].append({
+                "path": path_to_shard,
+                "fingerprints":
+                    load_shard(path_to_shard, sharding["generation"], mmap)
+                    if shards is None or number in shards else None
+            })
+
+    return fingerprints
+
+
+def live_doc_names(fingerprints):
+    """
+    The names of every document in a loaded database that hasn't been
+    deleted, in document ID order.
+    """
+    return [
+        index_doc_name(segment, doc_id)
+        for segment, deleted in zip(
+            fingerprints["segments"], fingerprints["deleted_docs"])
+        for doc_id in np.flatnonzero(~deleted).tolist()]
+
+
+def add_segment(path, index, max_segments=DEFAULT_MAX_SEGMENTS):
+    """
+    Add an index of new documents to a database as a segment, without
+    touching the database's existing files. Any documents already in the
+    database with the same names as new ones are replaced. If this takes the
+    database to max_segments segments, they are all merged back into one.
+
+    Arguments:
+        path {str} -- Path to the database's base file
+        index {dict} -- Index of the new documents
+
+    Keyword Arguments:
+        max_segments {int} -- Number of segments at which to compact the
+                              database (default: {8})
+    """
+    if not os.path.exists(path):
+        # nothing to add to, so the segment becomes the base
+        save_index(index, path)
+        return
+
+    manifest = read_manifest(path) or new_manifest(path)
+    existing = load_fingerprint_db(path, None)
+    if existing["hash_layout"] != index["hash_layout"]:
+        raise ValueError(
+            "New documents were built with different options to %s" % path)
+
+    new_names = [
+        index_doc_name(index, doc_id)
+        for doc_id in range(len(index["doc_names"]))]
+    mark_deleted(manifest, existing, new_names)
+
+    segment = {
+        "file": os.path.basename(path) + SEGMENT_SUFFIX
+            % manifest["next_segment"],
+        "deleted": []
+    }
+    save_index(index, segment_path(path, segment))
+    manifest["segments"].append(segment)
+    manifest["next_segment"] += 1
+    write_manifest(path, manifest)
+
+    if len(manifest["segments"]) >= max_segments:
+        compact_fingerprint_db(path)
+
+
+def mark_deleted(manifest, fingerprints, doc_names):
+    """
+    Record in a manifest that the named documents are deleted from every
+    segment of the database holding them.
+
+    Returns:
+        int -- The number of documents that were deleted
+    """
+    n_deleted = 0
+    for segment, index, deleted in zip(
+            manifest["segments"],
+            fingerprints["segments"],
+            fingerprints["deleted_docs"]):
+        to_delete = np.isin(index["doc_names"], doc_name_table(doc_names))\
+            & ~deleted
+        segment["deleted"].extend(
+            index_doc_name(index, doc_id)
+            for doc_id in np.flatnonzero(to_delete).tolist())
+        n_deleted += int(np.sum(to_delete))
+    return n_deleted
+
+
+def delete_documents(path, doc_names):
+    """
+    Delete documents from a database by name. Their postings stay on disk,
+    masked out, until the database is next compacted.
+
+    Arguments:
+        path {str} -- Path to the database's base file
+        doc_names {list} -- File names of the documents to delete
+
+    Returns:
+        int -- The number of documents that were deleted
+    """
+    manifest = read_manifest(path) or new_manifest(path)
+    n_deleted = mark_deleted(
+        manifest, load_fingerprint_db(path, None), doc_names)
+    if n_deleted > 0:
+        write_manifest(path, manifest)
+    return n_deleted
+
+
+def merge_segments(fingerprints):
+    """
+    Merge the segments of a loaded database into a single index, dropping
+    deleted documents. Documents keep their relative order.
+
+    Arguments:
+        fingerprints {dict} -- The loaded database
+
+    Returns:
+        dict -- The merged index
+    """
+    hashes = []
+    postings = []
+    doc_id_base = 0
+    for index, deleted in zip(
+            fingerprints["segments"], fingerprints["deleted_docs"]):
+        index = unpack_index(index)
+        # renumber the surviving documents to follow on from the last segment
+        new_doc_ids = doc_id_base + np.cumsum(~deleted) - 1
+        doc_id_base += int(np.sum(~deleted))
+
+        segment_hashes = np.repeat(
+            index["hashes"], np.diff(index["posting_starts"]))
+        live = ~deleted[index["postings"]["doc_id"]]
+        segment_postings = np.array(index["postings"][live])
+        segment_postings["doc_id"] = new_doc_ids[segment_postings["doc_id"]]
+
+        hashes.append(segment_hashes[live])
+        postings.append(segment_postings)
+
+    # index_from_postings puts each hash's postings back in order of
+    # document and offset
+    index = index_from_postings(
+        live_doc_names(fingerprints),
+        np.concatenate(hashes),
+        np.concatenate(postings),
+        fingerprints["hash_layout"])
+
+    # the merged features are only of one version if every segment's were
+    feature_versions = set(
+        segment["metadata"].get("feature_version")
+        for segment in fingerprints["segments"])
+    if len(feature_versions) == 1 and None not in feature_versions:
+        index["metadata"]["feature_version"] = feature_versions.pop()
+
+    # prune the merged index as the base was, along with any hashes already
+    # pruned from the segments
+    pruning = fingerprints["segments"][0]["metadata"].get("pruning")
+    if pruning is not None:
+        index = prune_index(
+            index,
+            pruning["max_doc_fraction"],
+            pruning["method"],
+            np.concatenate([
+                segment.get(
+                    "pruned_hashes", np.zeros(0, dtype=index["hashes"].dtype))
+                for segment in fingerprints["segments"]]))
+        # count the postings pruned from the segments before they were merged
+        index["metadata"]["pruning"]["n_pruned_postings"] += sum(
+            segment["metadata"].get("pruning", {}).get("n_pruned_postings", 0)
+            for segment in fingerprints["segments"])
+
+    return index
+
+
+def compact_fingerprint_db(path):
+    """
+    Merge all of a database's segments into a new base file, dropping deleted
+    documents, and remove the old segments.
+
+    Arguments:
+        path {str} -- Path to the database's base file
+    """
+    manifest = read_manifest(path)
+    if manifest is None:
+        return
+
+    # writing the new base, whose contents differ, gives it a new generation,
+    # which on its own marks the manifest as stale — so a crash past this
+    # point loses nothing
+    save_index(merge_segments(load_fingerprint_db(path, None)), path)
+    discard_segments(path, manifest)
+
+
+def discard_segments(path, manifest=None):
+    """
+    Remove a database's manifest and segment files, leaving its base file.
+    """
+    if manifest is None:
+        if not os.path.exists(manifest_path(path)):
+            return
+        with open(manifest_path(path)) as f:
+            manifest = json.load(f)
+
+    os.remove(manifest_path(path))
+    for segment in manifest["segments"][1:]:
+        if os.path.exists(segment_path(path, segment)):
+            os.remove(segment_path(path, segment))
+
+
+def convert_pickle_db(path_to_pickle, path_to_index, hash_layout):
+    """
+    Convert a pickled fingerprint database to the index format.
+
+    Arguments:
+        path_to_pickle {str} -- Path to pickled database
+        path_to_index {str} -- Path to output index file
+        hash_layout {dict} -- Layout to pack the hashes with. This must match
+                              the pair searching options the database was
+                              built with.
+    """
+    with open(path_to_pickle, "rb") as f:
+        fingerprints = pickle.load(f)
+
+    save_index(index_from_pickle(fingerprints, hash_layout), path_to_index)
+
+
+if __name__ == "__main__":
+    # imported here as fingerprint_builder itself depends on this module
+    from fingerprint_builder import pair_hash_layout
+
+    args = parse_args()
+
+    pair_searching_options = {
+        key: value for key, value in vars(args).items()
+        if key.startswith("target_") and value is not None}
+    convert_pickle_db(
+        args.pickled_db,
+        args.index_db,
+        pair_hash_layout(pair_searching_options))
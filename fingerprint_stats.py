@@ -0,0 +1,134 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: fingerprint_stats.py
+Description: Reports how a fingerprint database's postings are distributed
+             across its hashes, and how much of it stop-hash pruning would
+             remove at a range of thresholds, to help tune the
+             max_doc_fraction passed to fingerprintBuilder. Can be called
+             directly as a script on a database file.
+"""
+from argparse import ArgumentParser
+
+import numpy as np
+
+from fingerprint_builder import pair_hash_layout
+from fingerprint_db import\
+    load_fingerprint_db, merge_segments, merge_shards, hash_doc_counts,\
+    unpack_index, max_docs_for_fraction
+
+DEFAULT_DOC_FRACTIONS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5]
+REPORT_PERCENTILES = [50, 90, 99, 99.9, 100]
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("path_to_fingerprints")
+    parser.add_argument(
+        "--doc_fractions",
+        type=float,
+        nargs="+",
+        default=DEFAULT_DOC_FRACTIONS)
+
+    return parser.parse_args()
+
+
+def posting_list_report(index, doc_fractions=DEFAULT_DOC_FRACTIONS):
+    """
+    Summarise the distribution of an index's posting list lengths and hash
+    document frequencies.
+
+    Arguments:
+        index {dict} -- The fingerprint index
+
+    Keyword Arguments:
+        doc_fractions {list} -- Values of max_doc_fraction to report the
+                                effect of pruning with
+                                (default: {[0.01, 0.02, 0.05, 0.1, 0.2, 0.5]})
+
+    Returns:
+        dict -- Counts of documents, hashes and postings, percentiles of
+                posting list length and document frequency, and for each
+                pruning threshold the hashes and postings it would prune
+    """
+    index = unpack_index(index)
+    n_docs = len(index["doc_names"])
+    lengths = np.diff(index["posting_starts"])
+    doc_counts = hash_doc_counts(index)
+    n_postings = int(np.sum(lengths))
+
+    pruning = []
+    for fraction in doc_fractions:
+        stop = doc_counts > max_docs_for_fraction(fraction, n_docs)
+        pruning.append({
+            "max_doc_fraction": fraction,
+            "n_pruned_hashes": int(np.sum(stop)),
+            "n_pruned_postings": int(np.sum(lengths[stop]))
+        })
+
+    return {
+        "n_docs": n_docs,
+        "n_hashes": len(lengths),
+        "n_postings": n_postings,
+        "length_percentiles": np.percentile(
+            lengths, REPORT_PERCENTILES).tolist() if len(lengths) > 0 else [],
+        "doc_count_percentiles": np.percentile(
+            doc_counts, REPORT_PERCENTILES).tolist()
+            if len(doc_counts) > 0 else [],
+        "pruning": pruning,
+        "pruned": index.get("metadata", {}).get("pruning")
+    }
+
+
+def print_posting_list_report(report):
+    """
+    Print a report as returned by posting_list_report.
+    """
+    print("Documents: %d" % report["n_docs"])
+    print("Hashes:    %d" % report["n_hashes"])
+    print("Postings:  %d" % report["n_postings"])
+    if report["pruned"] is not None:
+        print(
+            "Already pruned %(n_pruned_hashes)d hashes and "
+            "%(n_pruned_postings)d postings (%(method)s above "
+            "max_doc_fraction %(max_doc_fraction)g)" % report["pruned"])
+
+    print()
+    print("Percentile   Postings per hash   Documents per hash")
+    for percentile, length, doc_count in zip(
+            REPORT_PERCENTILES,
+            report["length_percentiles"],
+            report["doc_count_percentiles"]):
+        print("%10g   %17.1f   %18.1f" % (percentile, length, doc_count))
+
+    print()
+    print("max_doc_fraction   Hashes pruned   Postings pruned")
+    for threshold in report["pruning"]:
+        print("%16g   %13d   %15d (%.1f%%)" % (
+            threshold["max_doc_fraction"],
+            threshold["n_pruned_hashes"],
+            threshold["n_pruned_postings"],
+            100 * threshold["n_pruned_postings"]
+            / max(report["n_postings"], 1)))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    fingerprints = load_fingerprint_db(
+        args.path_to_fingerprints, pair_hash_layout())
+    # report on the database as it would be once compacted
+    if "shards" in fingerprints:
+        index = merge_shards(fingerprints)
+    elif len(fingerprints["segments"]) == 1\
+            and not np.any(fingerprints["deleted_docs"][0]):
+        index = fingerprints["segments"][0]
+    else:
+        index = merge_segments(fingerprints)
+
+    print_posting_list_report(posting_list_report(index, args.doc_fractions))
@@ -0,0 +1,42 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: ground_truth.py
+Description: Functions for telling which document a query was cut from by
+             its file name, as in the GTZAN dataset. Kept apart from the
+             identification pipeline so that evaluating an output file needn't
+             load it.
+"""
+
+
+def query_ground_truth(query_name):
+    """
+    The name of the document a query was cut from, based on the filename
+    formatting in the GTZAN dataset.
+
+    Arguments:
+        query_name {str} -- The query file name
+
+    Returns:
+        str -- The document file name
+    """
+    return query_name.split("-")[0] + ".wav"
+
+
+def doc_matches_query(doc_name, query_name):
+    """
+    Returns true if the doc name matches the ground truth in the query name,
+    based on the filename formatting in the GTZAN dataset.
+    
+    Arguments:
+        doc_name {str} -- The document file name
+        query_name {str} -- The query file name
+    
+    Returns:
+        boolean -- True if the document matches the query
+    """    
+    return query_ground_truth(query_name) == doc_name
@@ -0,0 +1,181 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: identification_client.py
+Description: A client for identification_server.py. Can be called directly as
+             a script to benchmark a running server, sending it a folder of
+             queries from several connections at once and reporting the
+             latencies and throughput seen.
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+from identification_server import LATENCY_PERCENTILES
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("socket_path")
+    parser.add_argument("path_to_queries")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--send_bytes", action="store_true")
+
+    return parser.parse_args()
+
+
+def open_connection(socket_path):
+    """
+    Connect to an identification server.
+
+    Arguments:
+        socket_path {str} -- Path to the server's Unix socket
+
+    Returns:
+        dict -- The connection's socket, and a file to read replies from
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    return {"socket": connection, "replies": connection.makefile("rb")}
+
+
+def close_connection(connection):
+    connection["replies"].close()
+    connection["socket"].close()
+
+
+def send_request(connection, request, audio_bytes=None):
+    """
+    Send a request to the server and wait for its reply.
+
+    Arguments:
+        connection {dict} -- Connection, as returned by open_connection
+        request {dict} -- The request
+
+    Keyword Arguments:
+        audio_bytes {bytes} -- Contents of an audio file to send after the
+                               request (default: {None})
+
+    Returns:
+        dict -- The server's reply
+    """
+    if audio_bytes is not None:
+        request = dict(request, n_bytes=len(audio_bytes))
+    message = json.dumps(request).encode("utf-8") + b"\n"
+    connection["socket"].sendall(
+        message + audio_bytes if audio_bytes is not None else message)
+
+    reply = connection["replies"].readline()
+    if not reply:
+        raise ConnectionError("Identification server closed the connection")
+    return json.loads(reply)
+
+
+def identify(connection, path=None, audio_bytes=None, top_k=None):
+    """
+    Ask the server to identify an audio file, given either its path (which
+    the server must be able to read) or its contents.
+
+    Returns:
+        dict -- The server's reply, listing the best "matches"
+    """
+    request = {}
+    if path is not None:
+        request["path"] = os.path.abspath(path)
+    if top_k is not None:
+        request["top_k"] = top_k
+    return send_request(connection, request, audio_bytes)
+
+
+def server_stats(connection):
+    """
+    Ask the server for the percentiles of its recent requests' latencies.
+    """
+    return send_request(connection, {"command": "stats"})
+
+
+def benchmark_server(socket_path, paths, concurrency=4, send_bytes=False):
+    """
+    Send a list of queries to a server, from several connections at once, and
+    time each request as the client sees it.
+
+    Arguments:
+        socket_path {str} -- Path to the server's Unix socket
+        paths {list} -- Paths to query audio files
+
+    Keyword Arguments:
+        concurrency {int} -- Number of requests in flight at once
+                             (default: {4})
+        send_bytes {bool} -- Whether to send the files' contents rather than
+                             their paths (default: {False})
+
+    Returns:
+        dict -- Number of requests and errors, throughput in requests per
+                second, and percentiles of the latencies in seconds
+    """
+    local = threading.local()
+    connections = []
+
+    def timed_request(path):
+        if not hasattr(local, "connection"):
+            local.connection = open_connection(socket_path)
+            connections.append(local.connection)
+        start_time = time.perf_counter()
+        if send_bytes:
+            with open(path, "rb") as f:
+                reply = identify(local.connection, audio_bytes=f.read())
+        else:
+            reply = identify(local.connection, path=path)
+        return reply, time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed_request, paths))
+    elapsed = time.perf_counter() - start_time
+
+    for connection in connections:
+        close_connection(connection)
+
+    latencies = np.array([latency for _, latency in results])
+    return {
+        "n_requests": len(results),
+        "n_errors": sum("error" in reply for reply, _ in results),
+        "throughput": len(results) / elapsed if elapsed > 0 else 0.0,
+        "latency_percentiles": {
+            str(percentile): value for percentile, value in zip(
+                LATENCY_PERCENTILES,
+                np.percentile(latencies, LATENCY_PERCENTILES).tolist()
+                if len(latencies) > 0 else [None] * len(LATENCY_PERCENTILES))
+        }
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    paths = sorted(
+        entry.path for entry in os.scandir(args.path_to_queries)
+        if os.path.splitext(entry.name)[1] == ".wav")
+    report = benchmark_server(
+        args.socket_path, paths, args.concurrency, args.send_bytes)
+
+    print("Requests:   %d (%d errors)" % (
+        report["n_requests"], report["n_errors"]))
+    print("Throughput: %.1f requests per second" % report["throughput"])
+    for percentile, latency in report["latency_percentiles"].items():
+        print("p%-9s %.3f seconds" % (percentile + ":", latency))
+
+    connection = open_connection(args.socket_path)
+    print("Server:     %s" % json.dumps(server_stats(connection)))
+    close_connection(connection)
@@ -0,0 +1,307 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: identification_server.py
+Description: A long-running identification server. The fingerprint database
+             is loaded once, and queries are answered over a Unix socket for
+             as long as the server runs. Hashes are extracted from query
+             audio in a pool of processes, so many requests can be served at
+             once. Can be called directly as a script to start a server.
+
+             Each request is a line of JSON, holding either the "path" of an
+             audio file readable by the server, or the "n_bytes" of an audio
+             file sent straight after the line, along with an optional
+             "top_k". The reply is a line of JSON listing the top_k matches'
+             "name", "score" and "offset" in seconds, or an "error". A request
+             of {"command": "stats"} instead replies with percentiles of the
+             latencies of recent requests.
+"""
+from argparse import ArgumentParser
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import io
+import json
+import os
+import signal
+import time
+
+import numpy as np
+import soundfile
+
+from audio_identification import get_query_hashes, rank_documents, N_GUESSES
+from fingerprint_builder import pair_hash_layout, check_feature_version,\
+    SAMPLE_RATE, HOP_LENGTH
+from fingerprint_db import load_fingerprint_db, doc_name
+from print_status import print_status
+
+# number of recent requests whose latencies are kept for reporting
+LATENCY_WINDOW = 10000
+LATENCY_PERCENTILES = [50, 90, 99, 99.9]
+
+# length of the clip each worker extracts hashes from before the server takes
+# requests
+WARM_UP_SECONDS = 1.0
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("path_to_fingerprints")
+    parser.add_argument("socket_path")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+
+    return parser.parse_args()
+
+
+def extract_query_hashes(
+        source,
+        peak_picking_options={},
+        pair_searching_options={},
+        cache_options={},
+        decoding_options={}):
+    """
+    Extract the hashes of a query sent to the server. Run in the server's
+    process pool.
+
+    Arguments:
+        source {str or bytes} -- Path to query audio, or the contents of an
+                                 audio file
+
+    Keyword Arguments:
+        As for get_query_hashes. Audio sent as bytes isn't cached, as the
+        cache is keyed on files.
+
+    Returns:
+        NumPy Array -- Hashes and offsets present in the query
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+        cache_options = {}
+    return get_query_hashes(
+        source,
+        peak_picking_options,
+        pair_searching_options,
+        cache_options,
+        decoding_options)
+
+
+def warm_up_audio():
+    """
+    The contents of a short WAV file of noise, to warm the workers up with.
+    """
+    audio = io.BytesIO()
+    soundfile.write(
+        audio,
+        np.random.default_rng(0).normal(
+            0, 0.1, int(WARM_UP_SECONDS * SAMPLE_RATE)).astype(np.float32),
+        SAMPLE_RATE,
+        format="WAV")
+    return audio.getvalue()
+
+
+def start_server_state(
+        path_to_fingerprints,
+        peak_picking_options={},
+        pair_searching_options={},
+        cache_options={},
+        decoding_options={},
+        workers=1):
+    """
+    Load the fingerprint database and start the process pool that a server
+    answers requests with.
+
+    Arguments:
+        path_to_fingerprints {str} -- Path to fingerprint database file
+
+    Keyword Arguments:
+        peak_picking_options {dict} -- Optional dict of keyword args to peak
+                                       picking algorithm (default: {{}})
+        pair_searching_options {dict} -- Optional dict of keyword args to pair
+                                         searching algorithm (default: {{}})
+        cache_options {dict} -- Optional dict of feature cache options, as
+                                taken by extract_spectral_peaks
+                                (default: {{}})
+        decoding_options {dict} -- Optional dict of audio decoding options,
+                                   as taken by extract_spectral_peaks
+                                   (default: {{}})
+        workers {int} -- Number of processes to extract hashes with
+                         (default: {1})
+
+    Returns:
+        dict -- The server's state, to be passed to serve
+    """
+    # there's no screen to draw on
+    print_status.screen = None
+
+    hash_layout = pair_hash_layout(pair_searching_options)
+    fingerprints = load_fingerprint_db(path_to_fingerprints, hash_layout)
+    if fingerprints["hash_layout"] != hash_layout:
+        raise ValueError(
+            "Pair searching options don't match those %s was built with"
+            % path_to_fingerprints)
+    check_feature_version(fingerprints, path_to_fingerprints)
+
+    state = {
+        "fingerprints": fingerprints,
+        "extract": partial(
+            extract_query_hashes,
+            peak_picking_options=peak_picking_options,
+            pair_searching_options=pair_searching_options,
+            cache_options=cache_options,
+            decoding_options=decoding_options),
+        "executor": ProcessPoolExecutor(workers),
+        "latencies": deque(maxlen=LATENCY_WINDOW),
+        "n_requests": 0
+    }
+
+    # the first query each worker extracts pays for librosa's lazy imports
+    # and compilation, which took several seconds — so pay for them before
+    # any real request has to
+    list(state["executor"].map(
+        state["extract"], [warm_up_audio()] * workers))
+
+    return state
+
+
+async def identify_request(state, request, audio_bytes=None):
+    """
+    Identify the audio of a single request.
+
+    Arguments:
+        state {dict} -- The server's state
+        request {dict} -- The request, with the "path" of the audio file if
+                          it isn't sent as bytes, and an optional "top_k"
+
+    Keyword Arguments:
+        audio_bytes {bytes} -- Contents of the audio file, if sent
+                               (default: {None})
+
+    Returns:
+        dict -- The reply
+    """
+    start_time = time.perf_counter()
+    loop = asyncio.get_running_loop()
+
+    source = audio_bytes if audio_bytes is not None else request["path"]
+    query_hashes = await loop.run_in_executor(
+        state["executor"], state["extract"], source)
+    extract_time = time.perf_counter() - start_time
+
+    # matching only reads the database, so it can run in a thread while the
+    # event loop carries on with other requests
+    ranked_docs, scores, offsets = await loop.run_in_executor(
+        None,
+        partial(
+            rank_documents,
+            query_hashes,
+            state["fingerprints"],
+            return_offsets=True))
+
+    top_k = int(request.get("top_k", N_GUESSES))
+    latency = time.perf_counter() - start_time
+    state["latencies"].append(latency)
+
+    return {
+        "matches": [
+            {
+                "name": doc_name(state["fingerprints"], doc_id),
+                "score": score,
+                "offset": offset * HOP_LENGTH / SAMPLE_RATE
+            } for doc_id, score, offset in zip(
+                ranked_docs[:top_k].tolist(),
+                scores[:top_k].tolist(),
+                offsets[:top_k].tolist())],
+        "n_hashes": len(query_hashes),
+        "extract_time": extract_time,
+        "latency": latency
+    }
+
+
+def latency_report(state):
+    """
+    Percentiles of the latencies of the server's recent requests, in seconds.
+    """
+    latencies = np.array(state["latencies"])
+    return {
+        "n_requests": state["n_requests"],
+        "latency_percentiles": {
+            str(percentile): value for percentile, value in zip(
+                LATENCY_PERCENTILES,
+                np.percentile(latencies, LATENCY_PERCENTILES).tolist()
+                if len(latencies) > 0 else [None] * len(LATENCY_PERCENTILES))
+        }
+    }
+
+
+async def handle_connection(state, reader, writer):
+    """
+    Answer requests on a client's connection until it closes.
+    """
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            try:
+                request = json.loads(line)
+                if request.get("command") == "stats":
+                    reply = latency_report(state)
+                else:
+                    audio_bytes = await reader.readexactly(
+                        request["n_bytes"]) if "n_bytes" in request else None
+                    state["n_requests"] += 1
+                    reply = await identify_request(state, request, audio_bytes)
+            except asyncio.IncompleteReadError:
+                break
+            except Exception as error:
+                # a bad request shouldn't bring down the connection, let alone
+                # the server
+                reply = {"error": "%s: %s" % (type(error).__name__, error)}
+
+            writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(state, socket_path):
+    """
+    Serve requests on a Unix socket until cancelled.
+
+    Arguments:
+        state {dict} -- The server's state, as returned by start_server_state
+        socket_path {str} -- Path to create the socket at
+    """
+    # a socket left behind by a server that didn't shut down cleanly
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = await asyncio.start_unix_server(
+        partial(handle_connection, state), path=socket_path)
+    # stop cleanly, removing the socket, when asked to terminate
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        state["executor"].shutdown()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    state = start_server_state(args.path_to_fingerprints, workers=args.workers)
+    try:
+        asyncio.run(serve(state, args.socket_path))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
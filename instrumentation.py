@@ -0,0 +1,221 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: instrumentation.py
+Description: Per-stage timers and counters for profiling the pipeline, and
+             exporters that write what they measure as JSON lines or as a
+             Prometheus textfile, so that runs can be profiled without a
+             terminal to draw status on.
+
+             Metrics are recorded into whichever collector the same thread
+             most recently opened with collect_metrics, and dropped if none
+             is open. A query or file's metrics are collected on their own,
+             in whichever process handles it, and handed back to be merged
+             into the run's.
+"""
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+# collectors opened by collect_metrics in each thread, innermost last, so that
+# threads matching at once (as in identification_server.py) don't mix up
+# their metrics
+local = threading.local()
+
+# prefix of the names of exported Prometheus metrics
+PROMETHEUS_PREFIX = "fingerprinter"
+
+
+def new_metrics():
+    """
+    An empty set of metrics: the number of calls to and total seconds spent
+    in each stage, and the total of each counter.
+    """
+    return {"stages": {}, "counters": {}}
+
+
+@contextmanager
+def collect_metrics():
+    """
+    Collect the metrics recorded within a block, until a collector is opened
+    inside it.
+
+    Yields:
+        dict -- The metrics collected, as created by new_metrics
+    """
+    metrics = new_metrics()
+    collectors().append(metrics)
+    try:
+        yield metrics
+    finally:
+        collectors().remove(metrics)
+
+
+def collectors():
+    if not hasattr(local, "collectors"):
+        local.collectors = []
+    return local.collectors
+
+
+def innermost_collector():
+    return collectors()[-1] if len(collectors()) > 0 else None
+
+
+def add_stage_time(stage, seconds, calls=1):
+    metrics = innermost_collector()
+    if metrics is None:
+        return
+    timer = metrics["stages"].setdefault(
+        stage, {"calls": 0, "seconds": 0.0})
+    timer["calls"] += calls
+    timer["seconds"] += seconds
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Time a block as a stage of the pipeline.
+
+    Arguments:
+        stage {str} -- Name of the stage, e.g. "decode" or "lookup"
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(stage, time.perf_counter() - start_time)
+
+
+def count(name, n=1):
+    """
+    Add n to a counter, e.g. of the postings touched by lookups.
+    """
+    metrics = innermost_collector()
+    if metrics is None:
+        return
+    counters = metrics["counters"]
+    counters[name] = counters.get(name, 0) + n
+
+
+def merge_metrics(metrics, other, scale=1.0):
+    """
+    Add one set of metrics into another.
+
+    Arguments:
+        metrics {dict} -- Metrics to add to
+        other {dict} -- Metrics to add
+
+    Keyword Arguments:
+        scale {float} -- Factor to scale the added stage times and counters
+                         by, e.g. to share a batch's metrics between its
+                         files (default: {1.0})
+
+    Returns:
+        dict -- metrics, updated
+    """
+    def scaled(value):
+        # keep whole numbers whole unless they're being shared out
+        return value * scale if scale != 1 else value
+
+    for stage, timer in other["stages"].items():
+        total = metrics["stages"].setdefault(
+            stage, {"calls": 0, "seconds": 0.0})
+        total["calls"] += scaled(timer["calls"])
+        total["seconds"] += scaled(timer["seconds"])
+    for name, value in other["counters"].items():
+        metrics["counters"][name] =\
+            metrics["counters"].get(name, 0) + scaled(value)
+    return metrics
+
+
+def export_event(metrics_options, event):
+    """
+    Append an event, such as a query having been identified, to the JSON
+    lines file named by metrics_options["json_lines"], if any.
+
+    Arguments:
+        metrics_options {dict} -- Optional "json_lines" and "prometheus"
+                                  paths to export metrics to
+        event {dict} -- The event
+    """
+    if "json_lines" not in metrics_options:
+        return
+    with open(metrics_options["json_lines"], "a") as f:
+        f.write(json.dumps(event) + "\n")
+
+
+def prometheus_textfile(metrics, labels={}, gauges={}):
+    """
+    Format metrics in Prometheus' text exposition format.
+
+    Arguments:
+        metrics {dict} -- The metrics
+
+    Keyword Arguments:
+        labels {dict} -- Labels to give every sample (default: {{}})
+        gauges {dict} -- Further values to export as gauges, by name
+                         (default: {{}})
+
+    Returns:
+        str -- The textfile's contents
+    """
+    def sample(name, value, extra_labels={}):
+        all_labels = dict(labels, **extra_labels)
+        label_text = ",".join(
+            '%s="%s"' % (key, str(value).replace('"', '\\"'))
+            for key, value in sorted(all_labels.items()))
+        return "%s_%s{%s} %r" % (
+            PROMETHEUS_PREFIX, name, label_text, float(value))
+
+    lines = [
+        "# TYPE %s_stage_seconds_total counter" % PROMETHEUS_PREFIX]
+    lines.extend(
+        sample("stage_seconds_total", timer["seconds"], {"stage": stage})
+        for stage, timer in sorted(metrics["stages"].items()))
+    lines.append("# TYPE %s_stage_calls_total counter" % PROMETHEUS_PREFIX)
+    lines.extend(
+        sample("stage_calls_total", timer["calls"], {"stage": stage})
+        for stage, timer in sorted(metrics["stages"].items()))
+    for name, value in sorted(metrics["counters"].items()):
+        lines.append("# TYPE %s_%s_total counter" % (PROMETHEUS_PREFIX, name))
+        lines.append(sample("%s_total" % name, value))
+    for name, value in sorted(gauges.items()):
+        lines.append("# TYPE %s_%s gauge" % (PROMETHEUS_PREFIX, name))
+        lines.append(sample(name, value))
+
+    return "\n".join(lines) + "\n"
+
+
+def export_run_metrics(metrics_options, run, metrics, gauges={}):
+    """
+    Export the metrics of a whole run: appended as a summary event to the
+    JSON lines file, if any, and written to the Prometheus textfile named by
+    metrics_options["prometheus"], if any.
+
+    Arguments:
+        metrics_options {dict} -- Optional "json_lines" and "prometheus"
+                                  paths to export metrics to
+        run {str} -- Kind of run, e.g. "identification"
+        metrics {dict} -- The run's metrics
+
+    Keyword Arguments:
+        gauges {dict} -- Further values describing the run, by name
+                         (default: {{}})
+    """
+    export_event(
+        metrics_options,
+        dict({"event": "run", "run": run}, **metrics, **gauges))
+
+    if "prometheus" not in metrics_options:
+        return
+    # write then move into place, so the collector never reads half a file
+    path = metrics_options["prometheus"]
+    with open(path + ".tmp", "w") as f:
+        f.write(prometheus_textfile(metrics, {"run": run}, gauges))
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,243 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: jit_kernels.py
+Description: Numba compiled versions of the pipeline's tightest loops: the
+             window argmax of peak picking, the pairing of anchors with
+             their target zones, and the per-document offset histograms of
+             scoring. Each gives exactly the output of the NumPy code it
+             stands in for, without building the large temporary arrays that
+             code needs. Numba is optional. When it isn't installed, use_jit
+             is False and callers run their NumPy code instead.
+
+             Kernels are compiled the first time they're called and cached
+             next to this file, so later processes, such as pool workers,
+             load them from disk rather than compiling them again.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# whether callers should use these kernels. Set it to False to run the NumPy
+# code even when Numba is installed, e.g. to compare the two
+use_jit = numba is not None
+
+
+def jit(func):
+    """
+    Compile a kernel in nopython mode if Numba is installed, caching it on
+    disk. Without Numba the kernel is left as plain (and unused) Python.
+    """
+    if numba is None:
+        return func
+    return numba.njit(cache=True, nogil=True)(func)
+
+
+@jit
+def beats(value, best):
+    """
+    Whether value should replace best as the maximum so far, as np.argmax
+    would decide: strictly greater values win, and the first NaN wins outright.
+    """
+    return value > best or (value != value and best == best)
+
+
+@jit
+def hopped_window_argmax(values, width, hop, n_windows):
+    """
+    Find the first maximum of each of n_windows windows of values, width
+    long and hop apart. Each window is a run of whole blocks hop long plus
+    the start of one more, so rather than scanning every window in full, the
+    argmax of each block is found once and shared by every window holding it.
+
+    Returns:
+        NumPy Array -- Position in values of each window's maximum
+    """
+    n_blocks = width // hop
+    remainder = width - n_blocks * hop
+    block_argmax = np.empty(
+        n_windows + n_blocks - 1 if n_blocks > 0 else 0, dtype=np.intp)
+    for block in range(len(block_argmax)):
+        best = block * hop
+        for i in range(best + 1, best + hop):
+            if beats(values[i], values[best]):
+                best = i
+        block_argmax[block] = best
+
+    window_argmax = np.empty(n_windows, dtype=np.intp)
+    for window in range(n_windows):
+        best = -1
+        for block in range(window, window + n_blocks):
+            i = block_argmax[block]
+            if best < 0 or beats(values[i], values[best]):
+                best = i
+        partial_start = (window + n_blocks) * hop
+        for i in range(partial_start, partial_start + remainder):
+            if best < 0 or beats(values[i], values[best]):
+                best = i
+        window_argmax[window] = best
+
+    return window_argmax
+
+
+@jit
+def window_peak_kernel(
+        spectrogram, tau, kappa, hop_tau, hop_kappa, n_freq_steps,
+        n_time_steps):
+    """
+    Find the location of the maximum in every hopped window of a
+    spectrogram, as window_peak_coordinates does: the argmax of each
+    frequency bin across each time window, then of those row maxima across
+    each frequency window. Ties go to the first occurrence in both passes.
+
+    Returns:
+        tuple -- Arrays of shape (n_freq_steps, n_time_steps) holding the
+                 frequency and time indices of the peak in each window
+    """
+    n_rows = (n_freq_steps - 1) * hop_kappa + 2 * kappa
+    time_argmax = np.empty((n_rows, n_time_steps), dtype=np.intp)
+    # kept time-major, so that each frequency pass reads contiguous memory
+    row_maxima = np.empty((n_time_steps, n_rows), dtype=spectrogram.dtype)
+    for freq in range(n_rows):
+        time_argmax[freq] = hopped_window_argmax(
+            spectrogram[freq], 2 * tau, hop_tau, n_time_steps)
+        for step in range(n_time_steps):
+            row_maxima[step, freq] = spectrogram[freq, time_argmax[freq, step]]
+
+    peak_freqs = np.empty((n_freq_steps, n_time_steps), dtype=np.intp)
+    peak_times = np.empty((n_freq_steps, n_time_steps), dtype=np.intp)
+    for step in range(n_time_steps):
+        freq_argmax = hopped_window_argmax(
+            row_maxima[step], 2 * kappa, hop_kappa, n_freq_steps)
+        for freq_step in range(n_freq_steps):
+            peak_freqs[freq_step, step] = freq_argmax[freq_step]
+            peak_times[freq_step, step] =\
+                time_argmax[freq_argmax[freq_step], step]
+
+    return peak_freqs, peak_times
+
+
+@jit
+def pair_candidates_kernel(
+        peak_freqs,
+        zone_lo,
+        zone_hi,
+        target_freq_height,
+        max_pairs_per_anchor,
+        peak_magnitudes):
+    """
+    Pair each anchor with the peaks of its target zone that fall inside the
+    zone's frequency extent, as find_peak_pair_array does before putting the
+    pairs in order. A negative max_pairs_per_anchor means no limit;
+    otherwise only each anchor's strongest targets are kept.
+
+    Returns:
+        tuple -- Arrays of the indices of the anchor and target of each pair,
+                 by anchor and then target
+    """
+    n_peaks = len(peak_freqs)
+    n_pairs = np.zeros(n_peaks, dtype=np.int64)
+    longest_zone = 0
+    for anchor in range(n_peaks):
+        low = peak_freqs[anchor] - target_freq_height
+        high = peak_freqs[anchor] + target_freq_height
+        for target in range(zone_lo[anchor], zone_hi[anchor]):
+            if low <= peak_freqs[target] < high:
+                n_pairs[anchor] += 1
+        longest_zone = max(longest_zone, n_pairs[anchor])
+        if max_pairs_per_anchor >= 0:
+            n_pairs[anchor] = min(n_pairs[anchor], max_pairs_per_anchor)
+
+    anchors = np.empty(np.sum(n_pairs), dtype=np.int64)
+    targets = np.empty(np.sum(n_pairs), dtype=np.int64)
+    in_zone = np.empty(longest_zone, dtype=np.int64)
+    position = 0
+    for anchor in range(n_peaks):
+        low = peak_freqs[anchor] - target_freq_height
+        high = peak_freqs[anchor] + target_freq_height
+        n_in_zone = 0
+        for target in range(zone_lo[anchor], zone_hi[anchor]):
+            if low <= peak_freqs[target] < high:
+                in_zone[n_in_zone] = target
+                n_in_zone += 1
+
+        keep = np.ones(n_in_zone, dtype=np.bool_)
+        if n_in_zone > n_pairs[anchor]:
+            # a stable sort, loudest first, breaks ties as strongest_in_groups
+            strongest = np.argsort(
+                -peak_magnitudes[in_zone[:n_in_zone]], kind="mergesort")
+            keep[:] = False
+            keep[strongest[:n_pairs[anchor]]] = True
+
+        for i in range(n_in_zone):
+            if keep[i]:
+                anchors[position] = anchor
+                targets[position] = in_zone[i]
+                position += 1
+
+    return anchors, targets
+
+
+@jit
+def histogram_scores_kernel(doc_ids, deltas, query_positions):
+    """
+    Score each document by the range of the histogram of its offset time
+    deltas, as histogram_scores does, given postings sorted by document and
+    then delta.
+
+    Returns:
+        tuple -- Arrays of each document's ID, score, first matching query
+                 position, and the delta of its first tallest histogram bin
+    """
+    n_postings = len(doc_ids)
+    n_docs = 0
+    for i in range(n_postings):
+        if i == 0 or doc_ids[i] != doc_ids[i - 1]:
+            n_docs += 1
+
+    unique_docs = np.empty(n_docs, dtype=np.int64)
+    scores = np.empty(n_docs, dtype=np.int64)
+    first_matches = np.empty(n_docs, dtype=np.int64)
+    offsets = np.empty(n_docs, dtype=np.int64)
+
+    doc_start = 0
+    for doc in range(n_docs):
+        doc_end = doc_start + 1
+        while doc_end < n_postings and doc_ids[doc_end] == doc_ids[doc_start]:
+            doc_end += 1
+
+        # walk the document's runs of equal delta, i.e. its histogram's
+        # non-empty bins
+        max_count = 0
+        min_count = n_postings
+        n_bins = 0
+        first_match = query_positions[doc_start]
+        bin_start = doc_start
+        for i in range(doc_start, doc_end):
+            first_match = min(first_match, query_positions[i])
+            if i + 1 == doc_end or deltas[i + 1] != deltas[i]:
+                count = i + 1 - bin_start
+                if count > max_count:
+                    max_count = count
+                    offsets[doc] = deltas[bin_start]
+                min_count = min(min_count, count)
+                n_bins += 1
+                bin_start = i + 1
+
+        # unless every delta in between occurs, the least populated bin is 0
+        if n_bins != deltas[doc_end - 1] - deltas[doc_start] + 1:
+            min_count = 0
+
+        unique_docs[doc] = doc_ids[doc_start]
+        scores[doc] = max_count - min_count
+        first_matches[doc] = first_match
+        doc_start = doc_end
+
+    return unique_docs, scores, first_matches, offsets
@@ -1,5 +1,6 @@
 import curses
 import json
+import sys
 
 statuses = {
     "id_blank_status": {
@@ -14,6 +15,7 @@ statuses = {
 
 
 
+
 --------------------------------------------------------------------
 
 ====================================================================
@@ -32,6 +34,7 @@ Guess #2:                   {guess_2}
 Guess #3:                   {guess_3}
 Time to extract hashes:     {time_to_hashes} seconds
 Time to look up in DB:      {time_to_db} seconds
+Hashes looked up:           {hashes_used} of {num_hashes}
 Time elapsed so far:        {total_time} seconds
 --------------------------------------------------------------------
 
@@ -42,17 +45,17 @@ Time elapsed so far:        {total_time} seconds
     },
     "id_analysing_file": {
         "text": "Now identifying:            {now_analysing}",
-        "y": 12,
+        "y": 13,
         "x": 0
     },
     "id_searching_db": {
         "text": "Searching DB for matches to {now_analysing}...",
-        "y": 12,
+        "y": 13,
         "x": 0
     },
     "id_loading_db": {
         "text": "Loading fingerprint database {db_file} from disk...",
-        "y": 12,
+        "y": 13,
         "x": 0
     },
     "fp_blank_status": {
@@ -126,6 +129,9 @@ def enable_printing(func):
     """
     A function decorator wrapping it in the curses.wrapper function allowing
     advanced console printing without totally breaking the host terminal.
+    The decorated function takes an extra keyword argument, headless, which
+    skips curses and prints no status at all, as does running without a
+    terminal. Either way the function's result is returned.
     
     Arguments:
         func {function} -- Function to be wrapped
@@ -136,9 +142,12 @@ def enable_printing(func):
     def intermediate(screen, func, args, kwargs):
         print_status.screen = screen
         curses.use_default_colors()
-        func(*args, **kwargs)
+        return func(*args, **kwargs)
 
-    def wrapper(*args, **kwargs):
-        curses.wrapper(intermediate, func, args, kwargs)
+    def wrapper(*args, headless=False, **kwargs):
+        if headless or not sys.stdout.isatty():
+            print_status.screen = None
+            return func(*args, **kwargs)
+        return curses.wrapper(intermediate, func, args, kwargs)
     
     return wrapper
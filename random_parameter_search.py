@@ -9,22 +9,49 @@ File: random_parameter_search.py
 Description: A simple script for performing a random parameter search across
              the parameter space of the fingerprinting and identification
              algorithms.
-             
+
+             Trials run concurrently in a pool of processes, and are pruned
+             by successive halving: every trial is first scored on a small
+             subset of the queries, and only the best fraction of them are
+             promoted to be scored on a larger one, until the survivors are
+             scored on every query. Each peak picking configuration is tried
+             with several pair searching configurations, and its peaks are
+             computed once into the feature cache and shared between them.
+             Every result is checkpointed as it arrives, so an interrupted
+             search picks up where it stopped when run again on the same
+             output folder. The trials that make the best trade-off between
+             score and time are reported at the end, each trial's time
+             including the spectrograms and peaks computed for it ahead of
+             time.
 """
 from argparse import ArgumentParser
+from functools import partial
 import json
+from math import ceil
+from multiprocessing import Pool
+import os
 import time
 
 import numpy as np
-from numpy import argmax, argmin
-from numpy.random import randint
 
-from fingerprint_builder import fingerprintBuilder
+from fingerprint_builder import fingerprintBuilder,\
+    extract_spectral_peaks_batch, DEFAULT_BATCH_SIZE
 from audio_identification import audioIdentification
-from evaluation import parse_id_file, mean_avg_precision
+from evaluation import evaluate_id_file
+from instrumentation import collect_metrics
 
 N_ATTEMPTS = 100
 
+# each peak picking configuration is tried with this many pair searching
+# configurations, which share its peaks
+PAIR_CONFIGS_PER_PEAK_CONFIG = 4
+
+# number of queries every trial is first scored on
+DEFAULT_MIN_QUERIES = 10
+# at each rung of successive halving only the best 1 / HALVING_RATE of the
+# trials are promoted, and they're scored on HALVING_RATE times the queries
+DEFAULT_HALVING_RATE = 3
+
 
 available_parameters = {
     "peak_picking": {
@@ -65,89 +92,556 @@ available_parameters = {
 def parse_args():
     parser = ArgumentParser()
     parser.add_argument("output_folder", default="param_search")
-    return parser.parse_args()
+    parser.add_argument("--docs", default="data/clean_subset")
+    parser.add_argument("--queries", default="data/query_subset")
+    parser.add_argument("--n_trials", type=int, default=N_ATTEMPTS)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--min_queries", type=int, default=DEFAULT_MIN_QUERIES)
+    parser.add_argument(
+        "--halving_rate", type=int, default=DEFAULT_HALVING_RATE)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
 
+    try:
+        check_halving_settings(args.min_queries, args.halving_rate)
+    except ValueError as error:
+        parser.error(str(error))
+    return args
 
-if __name__ == "__main__":
-    args = parse_args()
-    performance = []
-    times = []
-    for n in range(N_ATTEMPTS):
-        print("########### RANDOM SEARCH ATTEMPT %d ###########" % (n))
-        peak_picking_options = {
-            key: randint(
-                available_parameters["peak_picking"][key]["min"],
-                available_parameters["peak_picking"][key]["max"] + 1)
-            for key in available_parameters["peak_picking"] 
+
+def check_halving_settings(min_queries, halving_rate):
+    """
+    Raise a ValueError unless successive halving's settings let the rungs
+    grow: trials must first be scored on at least one query, and the number
+    of queries must at least double at each rung.
+    """
+    if min_queries < 1:
+        raise ValueError(
+            "min_queries must be at least 1, not %r" % min_queries)
+    if halving_rate < 2:
+        raise ValueError(
+            "halving_rate must be at least 2, not %r" % halving_rate)
+
+
+def sample_peak_picking_options(rng):
+    parameters = available_parameters["peak_picking"]
+    peak_picking_options = {
+        key: int(rng.integers(
+            parameters[key]["min"], parameters[key]["max"] + 1))
+        for key in parameters
+    }
+    # hops much longer than the windows would skip over peaks altogether
+    peak_picking_options["hop_kappa"] = int(rng.integers(
+        parameters["hop_kappa"]["min"],
+        min(parameters["hop_kappa"]["max"], peak_picking_options["kappa"] * 2)
+    ))
+    peak_picking_options["hop_tau"] = int(rng.integers(
+        parameters["hop_tau"]["min"],
+        min(parameters["hop_tau"]["max"], peak_picking_options["tau"] * 2)
+    ))
+    return peak_picking_options
+
+
+def sample_pair_searching_options(rng):
+    parameters = available_parameters["pair_searching"]
+    return {
+        key: int(rng.integers(
+            parameters[key]["min"], parameters[key]["max"] + 1))
+        for key in parameters
+    }
+
+
+def plan_trials(n_trials, seed=0):
+    """
+    Draw the configurations to try, each peak picking configuration paired
+    with PAIR_CONFIGS_PER_PEAK_CONFIG pair searching configurations.
+
+    Arguments:
+        n_trials {int} -- Number of trials
+
+    Keyword Arguments:
+        seed {int} -- Seed of the random generator (default: {0})
+
+    Returns:
+        list -- Each trial's number and options
+    """
+    rng = np.random.default_rng(seed)
+    trials = []
+    for n in range(n_trials):
+        if n % PAIR_CONFIGS_PER_PEAK_CONFIG == 0:
+            peak_picking_options = sample_peak_picking_options(rng)
+        trials.append({
+            "trial": n,
+            "peak_picking_options": peak_picking_options,
+            "pair_searching_options": sample_pair_searching_options(rng)
+        })
+    return trials
+
+
+def rung_sizes(n_queries, min_queries, halving_rate):
+    """
+    Number of queries trials are scored on at each rung of successive
+    halving, growing by halving_rate up to every query.
+    """
+    check_halving_settings(min_queries, halving_rate)
+    sizes = []
+    size = min(min_queries, n_queries)
+    while size < n_queries:
+        sizes.append(size)
+        size *= halving_rate
+    return sizes + [n_queries]
+
+
+def wav_paths(folder):
+    return sorted(
+        entry.path for entry in os.scandir(folder)
+        if os.path.splitext(entry.name)[1] == ".wav")
+
+
+def make_query_subset(output_folder, rung, query_paths):
+    """
+    Link a subset of the queries into a folder of their own, for
+    audioIdentification to search.
+
+    Returns:
+        str -- The folder
+    """
+    folder = os.path.join(output_folder, "queries_rung_%d" % rung)
+    os.makedirs(folder, exist_ok=True)
+    for path in query_paths:
+        link = os.path.join(folder, os.path.basename(path))
+        if not os.path.lexists(link):
+            os.symlink(os.path.abspath(path), link)
+    return folder
+
+
+def start_search(output_folder, settings):
+    """
+    Plan a new search, or load the plan of one already started in the output
+    folder along with the results and peak computations it had checkpointed.
+
+    Arguments:
+        output_folder {str} -- Folder the search writes to
+        settings {dict} -- "n_trials", "seed", "min_queries" and
+                           "halving_rate" of the search, used if it's new
+
+    Returns:
+        tuple -- The search's settings, its trials, the results so far, and
+                 the timed batches of peaks computed so far
+    """
+    plan_path = os.path.join(output_folder, "search.json")
+
+    if os.path.exists(plan_path):
+        with open(plan_path) as f:
+            plan = json.load(f)
+        print("Resuming search in %s" % output_folder)
+    else:
+        plan = {
+            "settings": settings,
+            "trials": plan_trials(settings["n_trials"], settings["seed"])
         }
-        peak_picking_options["hop_kappa"] =\
-            randint(
-                available_parameters["peak_picking"]["hop_kappa"]["min"],
-                min(
-                    available_parameters["peak_picking"]["hop_kappa"]["max"],
-                    peak_picking_options["kappa"] * 2
-                )
-            )
-        peak_picking_options["hop_tau"] =\
-            randint(
-                available_parameters["peak_picking"]["hop_tau"]["min"],
-                min(
-                    available_parameters["peak_picking"]["hop_tau"]["max"],
-                    peak_picking_options["tau"] * 2
+        os.makedirs(output_folder, exist_ok=True)
+        with open(plan_path + ".tmp", "w") as f:
+            json.dump(plan, f, indent=4)
+        os.replace(plan_path + ".tmp", plan_path)
+        for trial in plan["trials"]:
+            with open(
+                    "%s/params_%d.json" % (output_folder, trial["trial"]),
+                    "w") as f:
+                json.dump({
+                        "peak_picking_options":
+                            trial["peak_picking_options"],
+                        "pair_searching_options":
+                            trial["pair_searching_options"]
+                    },
+                    f
                 )
-            )
 
-        pair_searching_options = {
-            key: randint(
-                available_parameters["pair_searching"][key]["min"],
-                available_parameters["pair_searching"][key]["max"] + 1)
-            for key in available_parameters["pair_searching"] 
-        }
-        print(json.dumps(peak_picking_options, indent=4))
-        print(json.dumps(pair_searching_options, indent=4))
+    return (
+        plan["settings"],
+        plan["trials"],
+        read_checkpoints(os.path.join(output_folder, "results.jsonl")),
+        read_checkpoints(os.path.join(output_folder, "warm_ups.jsonl")))
+
+
+def read_checkpoints(path):
+    records = []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # a line cut short when the search was interrupted
+                    pass
+    return records
+
+
+def checkpoint(path, record):
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def config_key(peak_picking_options):
+    return json.dumps(peak_picking_options, sort_keys=True)
+
+
+def warm_peaks(task, cache_options):
+    """
+    Compute the peaks of a batch of files into the feature cache, timing the
+    spectrograms and the peaks apart.
+    """
+    peak_picking_options, batch, paths = task
+    with collect_metrics() as metrics:
+        extract_spectral_peaks_batch(
+            paths, peak_picking_options, cache_options)
 
-        db_name = "%s/fingerprint_db_%d.db" % (args.output_folder, n)
-        output_name = "%s/identified_tracks_%d.txt" % (args.output_folder, n)
+    def seconds(stage):
+        return metrics["stages"].get(stage, {"seconds": 0.0})["seconds"]
 
+    return {
+        "peak_picking_options": peak_picking_options,
+        "batch": batch,
+        "spectrogram_seconds": seconds("decode") + seconds("stft"),
+        "peak_seconds": seconds("peaks")
+    }
+
+
+def warm_peak_cache(pool, trials, paths, rung, output_folder, warm_ups,
+                    cache_options):
+    """
+    Compute the peaks of every file for each peak picking configuration of a
+    set of trials, so that trials sharing a configuration find them cached
+    rather than all computing them at once. Each batch is timed and
+    checkpointed, and batches a resumed search had already timed are skipped.
+
+    Arguments:
+        pool {Pool} -- Processes to compute peaks in
+        trials {list} -- Trials whose peaks to compute
+        paths {list} -- Paths to audio files
+        rung {int} -- Rung of successive halving being run
+        output_folder {str} -- Folder the search writes to
+        warm_ups {list} -- Timed batches so far, which new ones are added to
+        cache_options {dict} -- Feature cache options
+    """
+    peak_configs = []
+    for trial in trials:
+        if trial["peak_picking_options"] not in peak_configs:
+            peak_configs.append(trial["peak_picking_options"])
+
+    done = set(
+        (config_key(warm_up["peak_picking_options"]), warm_up["batch"])
+        for warm_up in warm_ups if warm_up["rung"] == rung)
+    batches = [
+        paths[start:start + DEFAULT_BATCH_SIZE]
+        for start in range(0, len(paths), DEFAULT_BATCH_SIZE)]
+    tasks = [
+        [(config, n, batch) for n, batch in enumerate(batches)
+         if (config_key(config), n) not in done]
+        for config in peak_configs]
+
+    warm = partial(warm_peaks, cache_options=cache_options)
+    # the first configuration caches the spectrograms, which the others then
+    # share
+    for phase in [tasks[:1], tasks[1:]]:
+        phase_tasks = [task for config_tasks in phase for task in config_tasks]
+        for warm_up in pool.imap_unordered(warm, phase_tasks):
+            warm_up = dict(warm_up, rung=rung)
+            checkpoint(
+                os.path.join(output_folder, "warm_ups.jsonl"), warm_up)
+            warm_ups.append(warm_up)
+
+
+def run_trial(
+        trial,
+        rung,
+        path_to_docs,
+        path_to_queries,
+        output_folder,
+        cache_options):
+    """
+    Score a trial on a folder of queries, building its fingerprint database
+    first unless an earlier rung already has.
+
+    Arguments:
+        trial {dict} -- The trial's number and options
+        rung {int} -- Rung of successive halving being run
+        path_to_docs {str} -- Folder of documents to fingerprint
+        path_to_queries {str} -- Folder of queries to score the trial on
+        output_folder {str} -- Folder the search writes to
+        cache_options {dict} -- Feature cache options
+
+    Returns:
+        dict -- The trial's number, rung, number of queries and score, and
+                the seconds taken to build its database at rung 0, to
+                rebuild it at a later rung (if its database was removed, as
+                by a resumed search promoting a trial it had pruned), and to
+                identify the queries
+    """
+    n = trial["trial"]
+    db_name = "%s/fingerprint_db_%d.db" % (output_folder, n)
+    output_name = "%s/identified_tracks_%d_rung_%d.txt" % (
+        output_folder, n, rung)
+
+    build_seconds = None
+    rebuild_seconds = None
+    if rung == 0 or not os.path.exists(db_name):
         start_time = time.perf_counter()
         fingerprintBuilder(
-            "data/clean_subset",
-            db_name,
-            peak_picking_options,
-            pair_searching_options)
-        audioIdentification(
-            "data/query_subset",
+            path_to_docs,
             db_name,
-            output_name,
-            peak_picking_options=peak_picking_options,
-            pair_searching_options=pair_searching_options)
-        end_time = time.perf_counter()
-        
-        relevances = parse_id_file(output_name)
-        score = mean_avg_precision(relevances)
-
-        performance.append(score)
-        times.append(end_time - start_time)
-
-        with open("%s/params_%d.json" % (args.output_folder, n), "w") as f:
-            json.dump({
-                    "peak_picking_options": peak_picking_options,
-                    "pair_searching_options": pair_searching_options
-                },
-                f
-            )
-        print("########### FINISHED RANDOM SEARCH ATTEMPT %d ###########" % (n))
-        print("########### SCORE %.3f ###########" % score)
-        print("########### TIME  %.3f ###########" % (end_time - start_time))
-    
+            trial["peak_picking_options"],
+            trial["pair_searching_options"],
+            cache_options=cache_options,
+            headless=True)
+        # a rebuild finds more of its features cached than the first build,
+        # so is kept apart rather than standing in for its time
+        if rung == 0:
+            build_seconds = time.perf_counter() - start_time
+        else:
+            rebuild_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    audioIdentification(
+        path_to_queries,
+        db_name,
+        output_name,
+        peak_picking_options=trial["peak_picking_options"],
+        pair_searching_options=trial["pair_searching_options"],
+        cache_options=cache_options,
+        headless=True)
+    identify_seconds = time.perf_counter() - start_time
+
+    report = evaluate_id_file(output_name)
+    return {
+        "trial": n,
+        "rung": rung,
+        "n_queries": report["n_queries"],
+        "score": report["mean"]["avg_precision"],
+        "build_seconds": build_seconds,
+        "rebuild_seconds": rebuild_seconds,
+        "identify_seconds": identify_seconds
+    }
+
+
+def promote(rung_results, halving_rate):
+    """
+    The trials to promote from a rung: the best scoring 1 / halving_rate of
+    them, ties going to the fastest.
+    """
+    ranked = sorted(
+        rung_results,
+        key=lambda result: (
+            -result["score"], result["identify_seconds"], result["trial"]))
+    n_promoted = ceil(len(ranked) / halving_rate)
+    return [result["trial"] for result in ranked[:n_promoted]]
+
+
+def pareto_front(final_results):
+    """
+    The trials that no other trial beats on both score and time.
+
+    Arguments:
+        final_results {list} -- Results of trials scored on every query,
+                                with their total "seconds"
+
+    Returns:
+        list -- The results on the front, fastest first
+    """
+    front = []
+    best_score = -np.inf
+    for result in sorted(
+            final_results,
+            key=lambda result: (result["seconds"], -result["score"])):
+        if result["score"] > best_score:
+            front.append(result)
+            best_score = result["score"]
+    return front
+
+
+def search(
+        output_folder,
+        path_to_docs,
+        path_to_queries,
+        n_trials=N_ATTEMPTS,
+        workers=1,
+        min_queries=DEFAULT_MIN_QUERIES,
+        halving_rate=DEFAULT_HALVING_RATE,
+        seed=0):
+    """
+    Run a parameter search, or resume an interrupted one, with successive
+    halving.
+
+    Arguments:
+        output_folder {str} -- Folder to write databases, results and the
+                               checkpoint to
+        path_to_docs {str} -- Folder of documents to fingerprint
+        path_to_queries {str} -- Folder of queries to score trials on
+
+    Keyword Arguments:
+        n_trials {int} -- Number of trials (default: {100})
+        workers {int} -- Number of trials to run at once (default: {1})
+        min_queries {int} -- Number of queries every trial is first scored
+                             on (default: {10})
+        halving_rate {int} -- Factor by which trials are cut and queries
+                              grown at each rung (default: {3})
+        seed {int} -- Seed of the random generator (default: {0})
+
+    Returns:
+        list -- Results of the trials scored on every query, with the
+                "spectrogram_seconds" shared by every trial, the
+                "peak_seconds" taken to pick the peaks of the trial's
+                configuration, and the total "seconds" of those and building
+                their database and identifying them
+    """
+    check_halving_settings(min_queries, halving_rate)
+    settings, trials, results, warm_ups = start_search(
+        output_folder,
+        {
+            "n_trials": n_trials,
+            "seed": seed,
+            "min_queries": min_queries,
+            "halving_rate": halving_rate
+        })
+    # every trial analyses the same audio, so share decoded spectrograms, and
+    # peaks between trials with the same peak picking options
+    cache_options = {"path": "%s/feature_cache" % output_folder}
+
+    # the queries are shuffled once, and each rung scores on a longer prefix
+    # of them, so promoted trials are scored on the queries they were before
+    query_paths = wav_paths(path_to_queries)
+    query_paths = [
+        query_paths[n] for n in
+        np.random.default_rng(settings["seed"]).permutation(len(query_paths))]
+    doc_paths = wav_paths(path_to_docs)
+    sizes = rung_sizes(
+        len(query_paths), settings["min_queries"], settings["halving_rate"])
+
+    survivors = [trial["trial"] for trial in trials]
+    with Pool(workers) as pool:
+        for rung, n_queries in enumerate(sizes):
+            rung_folder = make_query_subset(
+                output_folder, rung, query_paths[:n_queries])
+            done = {
+                result["trial"]: result for result in results
+                if result["rung"] == rung}
+            pending = [
+                trials[n] for n in survivors if n not in done]
+            print("########### RUNG %d: %d TRIALS ON %d QUERIES (%d DONE) "
+                  "###########" % (
+                      rung, len(survivors), n_queries, len(done)))
+
+            warm_peak_cache(
+                pool,
+                pending,
+                (doc_paths if rung == 0 else []) + query_paths[:n_queries],
+                rung,
+                output_folder,
+                warm_ups,
+                cache_options)
+            for result in pool.imap_unordered(
+                    partial(
+                        run_trial,
+                        rung=rung,
+                        path_to_docs=path_to_docs,
+                        path_to_queries=rung_folder,
+                        output_folder=output_folder,
+                        cache_options=cache_options),
+                    pending):
+                checkpoint(
+                    os.path.join(output_folder, "results.jsonl"), result)
+                results.append(result)
+                done[result["trial"]] = result
+                print("Trial #%d — Score: %.3f, Time: %.3f" % (
+                    result["trial"],
+                    result["score"],
+                    result["identify_seconds"]))
+
+            if rung == len(sizes) - 1:
+                break
+            promoted = promote(
+                [done[n] for n in survivors], settings["halving_rate"])
+            # the databases of pruned trials won't be searched again
+            for n in set(survivors) - set(promoted):
+                db_name = "%s/fingerprint_db_%d.db" % (output_folder, n)
+                if os.path.exists(db_name):
+                    os.remove(db_name)
+            survivors = promoted
+
+    # trials ran side by side, so their times are comparable with each other
+    # but slower than a trial run alone
+    build_seconds = {
+        result["trial"]: result["build_seconds"] for result in results
+        if result["rung"] == 0}
+    # a trial built and identified from cached peaks, so it's charged with
+    # computing them too: the spectrograms every trial shares, and the peaks
+    # of its configuration. Later rungs find earlier rungs' files cached, so
+    # summing every rung counts each file once
+    spectrogram_seconds = sum(
+        warm_up["spectrogram_seconds"] for warm_up in warm_ups)
+    peak_seconds = {}
+    for warm_up in warm_ups:
+        key = config_key(warm_up["peak_picking_options"])
+        peak_seconds[key] = peak_seconds.get(key, 0.0) +\
+            warm_up["peak_seconds"]
+
+    final_results = []
+    for result in results:
+        if result["rung"] != len(sizes) - 1 or\
+                result["trial"] not in survivors:
+            continue
+        trial_peak_seconds = peak_seconds.get(
+            config_key(trials[result["trial"]]["peak_picking_options"]), 0.0)
+        final_results.append(dict(
+            result,
+            spectrogram_seconds=spectrogram_seconds,
+            peak_seconds=trial_peak_seconds,
+            seconds=spectrogram_seconds + trial_peak_seconds
+            + build_seconds.get(result["trial"], 0.0)
+            + result["identify_seconds"]))
+    return final_results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    final_results = search(
+        args.output_folder,
+        args.docs,
+        args.queries,
+        args.n_trials,
+        args.workers,
+        args.min_queries,
+        args.halving_rate,
+        args.seed)
+    performance = [result["score"] for result in final_results]
+    times = [result["seconds"] for result in final_results]
     ratio = np.array(performance) / np.array(times)
-    
+
     with open("%s/output.txt" % args.output_folder, "w") as f:
-        for n, (sc, t) in enumerate(zip(performance, times)):
-            line = "Attempt #%d — Score: %.3f, Time: %.3f" % (n, sc, t)
-            f.write(line)
+        for result in final_results:
+            line = "Attempt #%d — Score: %.3f, Time: %.3f" % (
+                result["trial"], result["score"], result["seconds"])
+            f.write(line + "\n")
             print(line)
 
-    print ("Finished: %dth attempt best" % (argmax(performance)))
-    print ("Finished: %dth attempt fastest" % (argmin(times)))
-    print ("Finished: %dth attempt best ratio" % (argmax(ratio)))
\ No newline at end of file
+    if len(final_results) == 0:
+        print("Finished: no trials completed")
+    else:
+        print("Finished: %dth attempt best"
+              % final_results[int(np.argmax(performance))]["trial"])
+        print("Finished: %dth attempt fastest"
+              % final_results[int(np.argmin(times))]["trial"])
+        print("Finished: %dth attempt best ratio"
+              % final_results[int(np.argmax(ratio))]["trial"])
+
+    front = pareto_front(final_results)
+    with open("%s/pareto_front.json" % args.output_folder, "w") as f:
+        json.dump(front, f, indent=4)
+    print("Pareto front of score against time:")
+    for result in front:
+        print("    Attempt #%d — Score: %.3f, Time: %.3f" % (
+            result["trial"], result["score"], result["seconds"]))
@@ -0,0 +1,395 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: streaming_identification.py
+Description: Identifies audio as it arrives, chunk by chunk, rather than from
+             a complete file. Keeps a rolling STFT and peak picking state,
+             hashes peak pairs as soon as their target zones are complete,
+             and stops as soon as one document clearly outscores the rest.
+             Can also be called directly as a script to simulate a live
+             stream from an audio file.
+"""
+from argparse import ArgumentParser
+
+import librosa
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from audio_identification import gather_offset_evidence
+from fingerprint_builder import\
+    frame_magnitudes, window_peak_coordinates, peak_list, limit_peak_density,\
+    find_peak_pair_array, encode_hashes, hash_record_dtype, pair_hash_layout,\
+    PEAK_DTYPE, SAMPLE_RATE, N_FFT, HOP_LENGTH, DEFAULT_KAPPA, DEFAULT_TAU,\
+    DEFAULT_HOP_KAPPA, DEFAULT_HOP_TAU,\
+    DEFAULT_TARGET_TIME_OFFSET, DEFAULT_TARGET_TIME_WIDTH,\
+    DEFAULT_TARGET_FREQ_HEIGHT
+from fingerprint_db import load_fingerprint_db, doc_name
+
+# a document is declared a match once its histogram peak beats every other
+# document's by this many hashes, and has at least DEFAULT_MIN_SCORE hashes
+DEFAULT_MARGIN = 10
+DEFAULT_MIN_SCORE = 15
+
+# length of the chunks a file is fed in when simulating a stream
+DEFAULT_CHUNK_SECONDS = 0.5
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("query_file")
+    parser.add_argument("path_to_fingerprints")
+    parser.add_argument(
+        "--chunk_seconds", type=float, default=DEFAULT_CHUNK_SECONDS)
+    parser.add_argument("--margin", type=int, default=DEFAULT_MARGIN)
+    parser.add_argument("--min_score", type=int, default=DEFAULT_MIN_SCORE)
+
+    return parser.parse_args()
+
+
+def start_stream(
+        fingerprints,
+        peak_picking_options={},
+        pair_searching_options={},
+        margin=DEFAULT_MARGIN,
+        min_score=DEFAULT_MIN_SCORE):
+    """
+    Create the state for identifying a new stream of audio.
+
+    Arguments:
+        fingerprints {dict} -- Fingerprint database to search
+
+    Keyword Arguments:
+        peak_picking_options {dict} -- Optional dict of keyword args to peak
+                                       picking algorithm. Only the window
+                                       method can be streamed. (default: {{}})
+        pair_searching_options {dict} -- Optional dict of keyword args to pair
+                                         searching algorithm (default: {{}})
+        margin {int} -- How many more hashes the best document's histogram
+                        peak needs than the runner up's to be declared a
+                        match (default: {10})
+        min_score {int} -- Fewest hashes in the best document's histogram
+                           peak to be declared a match (default: {15})
+
+    Returns:
+        dict -- The stream's state, to be passed to feed_stream
+    """
+    if peak_picking_options.get("method", "window") != "window":
+        raise ValueError("Only window peak picking can be streamed")
+
+    hash_layout = pair_hash_layout(pair_searching_options)
+    if fingerprints["hash_layout"] != hash_layout:
+        raise ValueError(
+            "Pair searching options don't match those the database was "
+            "built with")
+
+    return {
+        "fingerprints": fingerprints,
+        "peak_picking_options": {
+            "tau": peak_picking_options.get("tau", DEFAULT_TAU),
+            "kappa": peak_picking_options.get("kappa", DEFAULT_KAPPA),
+            "hop_tau": peak_picking_options.get("hop_tau", DEFAULT_HOP_TAU),
+            "hop_kappa":
+                peak_picking_options.get("hop_kappa", DEFAULT_HOP_KAPPA)
+        },
+        "peak_density_options": {
+            "max_peaks_per_frame":
+                peak_picking_options.get("max_peaks_per_frame"),
+            "min_magnitude": peak_picking_options.get("min_magnitude")
+        },
+        "pair_searching_options": {
+            "target_time_offset": pair_searching_options.get(
+                "target_time_offset", DEFAULT_TARGET_TIME_OFFSET),
+            "target_time_width": pair_searching_options.get(
+                "target_time_width", DEFAULT_TARGET_TIME_WIDTH),
+            "target_freq_height": pair_searching_options.get(
+                "target_freq_height", DEFAULT_TARGET_FREQ_HEIGHT),
+            "max_pairs_per_anchor":
+                pair_searching_options.get("max_pairs_per_anchor")
+        },
+        "hash_layout": hash_layout,
+        "margin": margin,
+        "min_score": min_score,
+        # samples not yet consumed by a full STFT frame. The stream is centred
+        # like librosa's STFT, by padding its start with zeros
+        "samples": np.zeros(N_FFT // 2, dtype=np.float32),
+        "samples_start": 0,
+        "n_samples": 0,
+        "n_frames": 0,
+        # frames not yet covered by a complete peak picking window
+        "spectrogram": np.zeros((1 + N_FFT // 2, 0), dtype=np.float32),
+        "spectrogram_start": 0,
+        "next_window": 0,
+        # peaks that might still be part of a pair, sorted by time then
+        # frequency
+        "peaks": np.zeros(0, dtype=PEAK_DTYPE),
+        # anchors before this frame have already been paired
+        "paired_until": 0,
+        "n_hashes": 0,
+        # per document offset histograms, and each one's tallest bin
+        "histograms": {},
+        "peak_bins": {},
+        "match": None
+    }
+
+
+def update_spectrogram(state, samples):
+    """
+    Append samples to the stream and compute every STFT frame they complete.
+    """
+    state["samples"] = np.concatenate(
+        (state["samples"], np.asarray(samples, dtype=np.float32)))
+    state["n_samples"] += len(samples)
+
+    # frame n covers padded samples [n * HOP_LENGTH, n * HOP_LENGTH + N_FFT)
+    samples_end = state["samples_start"] + len(state["samples"])
+    n_complete = (samples_end - N_FFT) // HOP_LENGTH + 1\
+        if samples_end >= N_FFT else 0
+    n_new = n_complete - state["n_frames"]
+    if n_new <= 0:
+        return
+
+    first = state["n_frames"] * HOP_LENGTH - state["samples_start"]
+    frames = sliding_window_view(
+        state["samples"][first:], N_FFT)[::HOP_LENGTH][:n_new]
+    magnitudes = frame_magnitudes(frames).T
+
+    state["spectrogram"] = np.concatenate(
+        (state["spectrogram"], magnitudes), axis=1)
+    state["n_frames"] = n_complete
+
+    # drop samples no later frame will need
+    consumed = n_complete * HOP_LENGTH - state["samples_start"]
+    state["samples"] = state["samples"][consumed:]
+    state["samples_start"] += consumed
+
+
+def update_peaks(state):
+    """
+    Pick peaks in every peak picking window the spectrogram now completes.
+    Windows are laid out exactly as in pick_peaks.
+    """
+    options = state["peak_picking_options"]
+    window_start = state["next_window"] * options["hop_tau"]
+    peak_freqs, peak_times = window_peak_coordinates(
+        state["spectrogram"][:, window_start - state["spectrogram_start"]:],
+        **options)
+    if peak_times.size == 0:
+        return
+
+    state["next_window"] += peak_times.shape[1]
+    peak_times = peak_times + window_start
+    peak_magnitudes = state["spectrogram"][
+        peak_freqs, peak_times - state["spectrogram_start"]]
+
+    # overlapping windows find the same peaks, so keep one of each
+    peaks = state["peaks"]
+    state["peaks"] = peak_list(
+        np.concatenate((peaks["freq"], peak_freqs.ravel())),
+        np.concatenate((peaks["time"], peak_times.ravel())),
+        np.concatenate((peaks["magnitude"], peak_magnitudes.ravel())),
+        state["spectrogram"].shape[0])
+
+    # drop frames no later window will need
+    next_start = state["next_window"] * options["hop_tau"]
+    state["spectrogram"] = state["spectrogram"][
+        :, next_start - state["spectrogram_start"]:]
+    state["spectrogram_start"] = next_start
+
+
+def update_hashes(state):
+    """
+    Hash every anchor peak whose target zone is now complete.
+
+    Returns:
+        NumPy Array -- Hashes and offsets of the new peak pairs
+    """
+    options = state["pair_searching_options"]
+
+    # later windows can only find peaks at or after where they start, so
+    # peaks before the next window are final
+    final_until = state["next_window"]\
+        * state["peak_picking_options"]["hop_tau"]
+    paired_until = max(
+        state["paired_until"],
+        final_until
+        - options["target_time_offset"]
+        - options["target_time_width"] + 1)
+
+    hashes = np.zeros(0, dtype=hash_record_dtype(state["hash_layout"]))
+    if paired_until == state["paired_until"]:
+        return hashes
+
+    # peak density limits are per frame, so can be applied to final peaks.
+    # Applying them again to peaks already limited changes nothing
+    final = state["peaks"]["time"] < final_until
+    keep = np.ones(len(final), dtype=bool)
+    keep[final] = limit_peak_density(
+        state["peaks"]["freq"][final],
+        state["peaks"]["time"][final],
+        state["peaks"]["magnitude"][final],
+        **state["peak_density_options"])
+    state["peaks"] = state["peaks"][keep]
+    final_peaks = state["peaks"][final[keep]]
+
+    pairs = find_peak_pair_array(
+        final_peaks["freq"],
+        final_peaks["time"],
+        peak_magnitudes=final_peaks["magnitude"],
+        **options)
+    pairs = pairs[
+        (pairs["anchor_time"] >= state["paired_until"])
+        & (pairs["anchor_time"] < paired_until)]
+
+    hashes = np.empty(len(pairs), dtype=hashes.dtype)
+    hashes["hash"] = encode_hashes(
+        pairs["anchor_freq"],
+        pairs["target_freq"],
+        pairs["dt"],
+        state["hash_layout"])
+    hashes["offset"] = pairs["anchor_time"]
+
+    # targets always come after their anchors, so peaks before the paired
+    # anchors can't be part of any more pairs
+    state["peaks"] = state["peaks"][state["peaks"]["time"] >= paired_until]
+    state["paired_until"] = paired_until
+    state["n_hashes"] += len(hashes)
+
+    return hashes
+
+
+def update_histograms(state, hashes):
+    """
+    Add the database postings matching new hashes to each document's
+    histogram of offset time deltas.
+    """
+    doc_ids, deltas, _ = gather_offset_evidence(hashes, state["fingerprints"])
+    if len(doc_ids) == 0:
+        return
+
+    bins = np.unique(np.stack((doc_ids, deltas)), axis=1, return_counts=True)
+    for (doc_id, delta), count in zip(bins[0].T.tolist(), bins[1].tolist()):
+        histogram = state["histograms"].setdefault(doc_id, {})
+        histogram[delta] = histogram.get(delta, 0) + count
+        if histogram[delta] > state["peak_bins"].get(doc_id, (0, 0))[0]:
+            state["peak_bins"][doc_id] = (histogram[delta], delta)
+
+
+def stream_matches(state, n_matches=3):
+    """
+    The best matching documents for the stream so far.
+
+    Arguments:
+        state {dict} -- The stream's state
+
+    Keyword Arguments:
+        n_matches {int} -- Number of matches to return (default: {3})
+
+    Returns:
+        list -- A dict for each match, best first, of the document's "name",
+                its "score" (the height of its histogram's tallest bin), and
+                the "offset" into the document in seconds where the stream
+                began
+    """
+    ranked = sorted(
+        state["peak_bins"].items(), key=lambda item: -item[1][0])
+    return [
+        {
+            "name": doc_name(state["fingerprints"], doc_id),
+            "score": score,
+            "offset": delta * HOP_LENGTH / SAMPLE_RATE
+        } for doc_id, (score, delta) in ranked[:n_matches]]
+
+
+def feed_stream(state, samples):
+    """
+    Feed the next chunk of a stream's audio to the identifier.
+
+    Arguments:
+        state {dict} -- The stream's state, as returned by start_stream
+        samples {NumPy Array} -- Mono audio at SAMPLE_RATE
+
+    Returns:
+        dict -- Once a document has been confidently identified, the best
+                match as returned by stream_matches, along with how many
+                "hashes" and "seconds" of audio it took. Otherwise None.
+    """
+    if state["match"] is not None:
+        return state["match"]
+
+    update_spectrogram(state, samples)
+    update_peaks(state)
+    update_histograms(state, update_hashes(state))
+
+    matches = stream_matches(state, 2)
+    if len(matches) == 0 or matches[0]["score"] < state["min_score"]:
+        return None
+    runner_up_score = matches[1]["score"] if len(matches) > 1 else 0
+    if matches[0]["score"] - runner_up_score < state["margin"]:
+        return None
+
+    state["match"] = dict(
+        matches[0],
+        runner_up_score=runner_up_score,
+        hashes=state["n_hashes"],
+        seconds=state["n_samples"] / SAMPLE_RATE)
+    return state["match"]
+
+
+def identify_stream(
+        chunks,
+        fingerprints,
+        peak_picking_options={},
+        pair_searching_options={},
+        margin=DEFAULT_MARGIN,
+        min_score=DEFAULT_MIN_SCORE):
+    """
+    Identify a stream of audio chunks, stopping as soon as a match is found.
+
+    Arguments:
+        chunks {iterable} -- Chunks of mono audio at SAMPLE_RATE
+        fingerprints {dict} -- Fingerprint database to search
+
+    Keyword Arguments:
+        As for start_stream
+
+    Returns:
+        dict -- The match, as returned by feed_stream, or None if the stream
+                ended without a confident match
+    """
+    state = start_stream(
+        fingerprints,
+        peak_picking_options,
+        pair_searching_options,
+        margin,
+        min_score)
+    for chunk in chunks:
+        match = feed_stream(state, chunk)
+        if match is not None:
+            return match
+    return None
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    x, _ = librosa.load(args.query_file, sr=SAMPLE_RATE)
+    chunk_length = int(args.chunk_seconds * SAMPLE_RATE)
+    chunks = (
+        x[start:start + chunk_length]
+        for start in range(0, len(x), chunk_length))
+
+    fingerprints = load_fingerprint_db(
+        args.path_to_fingerprints, pair_hash_layout())
+    match = identify_stream(
+        chunks, fingerprints, margin=args.margin, min_score=args.min_score)
+
+    if match is None:
+        print("No confident match")
+    else:
+        print("Matched %s at %.1f seconds after %.1f seconds of audio" % (
+            match["name"], match["offset"], match["seconds"]))
@@ -0,0 +1,204 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: synthetic_corpus.py
+Description: Synthesises a reproducible corpus of audio documents, mixtures
+             of tones, chirps and bursts of noise, along with noisy, cropped
+             queries of them named as in the GTZAN dataset, so that the
+             pipeline can be benchmarked without any real audio. Can be
+             called directly as a script to write a corpus to a folder.
+"""
+from argparse import ArgumentParser
+import os
+
+import numpy as np
+from scipy.signal import chirp
+import soundfile
+
+from fingerprint_builder import SAMPLE_RATE
+
+DEFAULT_N_TRACKS = 20
+DEFAULT_TRACK_SECONDS = 30.0
+DEFAULT_QUERIES_PER_TRACK = 2
+DEFAULT_QUERY_SECONDS = 10.0
+# signal to noise ratio of the noise added to queries
+DEFAULT_QUERY_SNR_DB = 10.0
+
+# number of each kind of event per second of a track
+TONES_PER_SECOND = 2.0
+CHIRPS_PER_SECOND = 0.5
+NOISE_BURSTS_PER_SECOND = 0.25
+# range of frequencies events are drawn from, in Hz
+MIN_FREQ = 80.0
+MAX_FREQ = 5000.0
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument("corpus_folder")
+    parser.add_argument("--n_tracks", type=int, default=DEFAULT_N_TRACKS)
+    parser.add_argument(
+        "--track_seconds", type=float, default=DEFAULT_TRACK_SECONDS)
+    parser.add_argument(
+        "--queries_per_track", type=int, default=DEFAULT_QUERIES_PER_TRACK)
+    parser.add_argument(
+        "--query_seconds", type=float, default=DEFAULT_QUERY_SECONDS)
+    parser.add_argument(
+        "--query_snr_db", type=float, default=DEFAULT_QUERY_SNR_DB)
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args()
+
+
+def random_events(rng, n_samples, events_per_second):
+    """
+    Draw the start and length in samples of a random number of events
+    spread over a track, each lasting between a tenth of a second and two
+    seconds, or until the end of the track.
+    """
+    min_length = SAMPLE_RATE // 10
+    n_events = rng.poisson(events_per_second * n_samples / SAMPLE_RATE)
+    lengths = rng.integers(min_length, 2 * SAMPLE_RATE, n_events)
+    starts = rng.integers(0, max(n_samples - min_length, 1), n_events)
+    lengths = np.minimum(lengths, n_samples - starts)
+    return zip(starts.tolist(), lengths.tolist())
+
+
+def synthesise_track(rng, seconds):
+    """
+    Synthesise a track of random tones, linear chirps and bursts of white
+    noise, each with a random amplitude and a short fade in and out.
+
+    Arguments:
+        rng {NumPy Generator} -- Source of randomness
+        seconds {float} -- Length of the track
+
+    Returns:
+        NumPy Array -- Mono audio at SAMPLE_RATE, peaking at 0.9
+    """
+    n_samples = int(seconds * SAMPLE_RATE)
+    x = np.zeros(n_samples)
+
+    def add_event(start, event):
+        # fade in and out over 10ms to avoid clicks, which would smear
+        # energy across every frequency
+        fade = min(SAMPLE_RATE // 100, len(event) // 2)
+        envelope = np.ones(len(event))
+        envelope[:fade] = np.linspace(0, 1, fade)
+        envelope[len(event) - fade:] = np.linspace(1, 0, fade)
+        x[start:start + len(event)] += rng.uniform(0.1, 0.5) * envelope * event
+
+    for start, length in random_events(rng, n_samples, TONES_PER_SECOND):
+        t = np.arange(length) / SAMPLE_RATE
+        add_event(start, np.sin(
+            2 * np.pi * rng.uniform(MIN_FREQ, MAX_FREQ) * t
+            + rng.uniform(0, 2 * np.pi)))
+
+    for start, length in random_events(rng, n_samples, CHIRPS_PER_SECOND):
+        t = np.arange(length) / SAMPLE_RATE
+        add_event(start, chirp(
+            t,
+            rng.uniform(MIN_FREQ, MAX_FREQ),
+            t[-1],
+            rng.uniform(MIN_FREQ, MAX_FREQ)))
+
+    for start, length in random_events(
+            rng, n_samples, NOISE_BURSTS_PER_SECOND):
+        add_event(start, 0.5 * rng.standard_normal(length))
+
+    return (0.9 * x / max(np.max(np.abs(x)), 1e-9)).astype(np.float32)
+
+
+def make_query(rng, track, seconds, snr_db):
+    """
+    Crop a random region from a track and bury it in white noise.
+
+    Arguments:
+        rng {NumPy Generator} -- Source of randomness
+        track {NumPy Array} -- The track's audio
+        seconds {float} -- Length of the query
+        snr_db {float} -- Signal to noise ratio of the query in decibels
+
+    Returns:
+        NumPy Array -- The query's audio
+    """
+    n_samples = min(int(seconds * SAMPLE_RATE), len(track))
+    start = int(rng.integers(0, len(track) - n_samples + 1))
+    query = track[start:start + n_samples].astype(np.float64)
+
+    noise = rng.standard_normal(n_samples)
+    noise *= np.sqrt(
+        np.mean(query ** 2) / (10 ** (snr_db / 10)) / np.mean(noise ** 2))
+    query += noise
+
+    return (query / max(np.max(np.abs(query)), 1.0)).astype(np.float32)
+
+
+def generate_corpus(
+        corpus_folder,
+        n_tracks=DEFAULT_N_TRACKS,
+        track_seconds=DEFAULT_TRACK_SECONDS,
+        queries_per_track=DEFAULT_QUERIES_PER_TRACK,
+        query_seconds=DEFAULT_QUERY_SECONDS,
+        query_snr_db=DEFAULT_QUERY_SNR_DB,
+        seed=0):
+    """
+    Write a synthetic corpus to a folder: WAV files of documents to
+    fingerprint in its "docs" subfolder, and queries of them in its "queries"
+    subfolder. The same arguments always give the same corpus.
+
+    Arguments:
+        corpus_folder {str} -- Folder to write the corpus to
+
+    Keyword Arguments:
+        n_tracks {int} -- Number of documents (default: {20})
+        track_seconds {float} -- Length of each document (default: {30.0})
+        queries_per_track {int} -- Number of queries cut from each document
+                                   (default: {2})
+        query_seconds {float} -- Length of each query (default: {10.0})
+        query_snr_db {float} -- Signal to noise ratio of the queries
+                                (default: {10.0})
+        seed {int} -- Seed of the random generator (default: {0})
+
+    Returns:
+        tuple -- Paths of the documents and queries folders
+    """
+    rng = np.random.default_rng(seed)
+    docs_folder = os.path.join(corpus_folder, "docs")
+    queries_folder = os.path.join(corpus_folder, "queries")
+    os.makedirs(docs_folder, exist_ok=True)
+    os.makedirs(queries_folder, exist_ok=True)
+
+    for n in range(n_tracks):
+        track = synthesise_track(rng, track_seconds)
+        # queries are named for their document as in GTZAN, so that
+        # doc_matches_query can tell if they were identified correctly
+        doc_name = "synthetic%04d" % n
+        soundfile.write(
+            os.path.join(docs_folder, doc_name + ".wav"), track, SAMPLE_RATE)
+        for m in range(queries_per_track):
+            query = make_query(rng, track, query_seconds, query_snr_db)
+            soundfile.write(
+                os.path.join(queries_folder, "%s-%d.wav" % (doc_name, m)),
+                query,
+                SAMPLE_RATE)
+
+    return docs_folder, queries_folder
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    generate_corpus(
+        args.corpus_folder,
+        args.n_tracks,
+        args.track_seconds,
+        args.queries_per_track,
+        args.query_seconds,
+        args.query_snr_db,
+        args.seed)
@@ -0,0 +1,29 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: tests/conftest.py
+Description: Shared setup for the tests. The modules under test live in the
+             repository root, which is put on the import path, and the
+             use_jit fixture runs a test once with the Numba kernels and once
+             with the NumPy code.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jit_kernels
+
+
+@pytest.fixture(params=[False, True], ids=["numpy", "jit"])
+def use_jit(request, monkeypatch):
+    # without Numba the kernels run as plain Python, which still checks them
+    monkeypatch.setattr(jit_kernels, "use_jit", request.param)
+    return request.param
@@ -0,0 +1,75 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: tests/test_audio_decoding.py
+Description: Checks that the peaks of audio decoded by the fast path agree
+             with those of audio decoded by librosa, on WAV and FLAC files of
+             a synthetic corpus at several sample rates.
+"""
+import os
+
+import numpy as np
+import pytest
+from scipy.signal import resample_poly
+import soundfile
+
+from benchmark import peak_mask, DECODING_PEAK_TOLERANCE
+from fingerprint_builder import compute_spectrogram, pick_peaks, SAMPLE_RATE
+from synthetic_corpus import generate_corpus
+
+# sample rates the documents are written at, in addition to SAMPLE_RATE
+OTHER_SAMPLE_RATES = [44100, 48000]
+# the synthetic tracks fall silent between events, where peaks are picked
+# from nothing but each resampler's rounding, so quieter ones are ignored
+MIN_PEAK_MAGNITUDE = 0.01
+
+
+@pytest.fixture(scope="module")
+def audio_files(tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp("corpus"))
+    docs_folder, _ = generate_corpus(
+        folder, n_tracks=2, track_seconds=8.0, queries_per_track=0)
+
+    paths = []
+    for name in sorted(os.listdir(docs_folder)):
+        path = os.path.join(docs_folder, name)
+        paths.append(path)
+        x, _ = soundfile.read(path)
+        for sample_rate in OTHER_SAMPLE_RATES:
+            resampled = resample_poly(x, sample_rate, SAMPLE_RATE)
+            for extension in ["wav", "flac"]:
+                paths.append("%s_%d.%s" % (
+                    os.path.splitext(path)[0], sample_rate, extension))
+                soundfile.write(
+                    paths[-1], np.clip(resampled, -1, 1), sample_rate)
+    return paths
+
+
+def decoded_peaks(path, decoding_options):
+    X = compute_spectrogram(path, decoding_options)
+    return peak_mask(
+        pick_peaks(X, min_magnitude=MIN_PEAK_MAGNITUDE), X.shape)
+
+
+@pytest.mark.parametrize("window", [
+    {},
+    {"offset": 1.5},
+    {"duration": 4.0},
+    {"offset": 2.25, "duration": 3.0}
+])
+def test_fast_decoding_keeps_peaks(audio_files, window):
+    for path in audio_files:
+        expected = decoded_peaks(path, dict(window, method="librosa"))
+        actual = decoded_peaks(path, dict(window, method="fast"))
+        assert expected.shape == actual.shape
+
+        overlap = np.sum(expected & actual) / max(
+            np.sum(expected | actual), 1)
+        assert overlap >= DECODING_PEAK_TOLERANCE, path
+        if soundfile.info(path).samplerate == SAMPLE_RATE:
+            # nothing to resample, so nothing to differ
+            assert np.array_equal(expected, actual), path
@@ -0,0 +1,95 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: tests/test_jit_kernels.py
+Description: Checks that the compiled kernels give exactly the output of the
+             NumPy code they stand in for, on random input full of ties.
+"""
+import numpy as np
+import pytest
+
+import jit_kernels
+from fingerprint_builder import window_peak_coordinates, find_peak_pair_array,\
+    pick_peaks
+from audio_identification import score_offset_evidence
+
+
+def with_and_without_jit(monkeypatch, func, *args, **kwargs):
+    results = []
+    for use_jit in [False, True]:
+        monkeypatch.setattr(jit_kernels, "use_jit", use_jit)
+        results.append(func(*args, **kwargs))
+    return results
+
+
+def assert_equal_results(a, b):
+    assert type(a) == type(b)
+    if isinstance(a, tuple):
+        assert len(a) == len(b)
+        for x, y in zip(a, b):
+            assert_equal_results(x, y)
+    else:
+        assert np.array_equal(a, b, equal_nan=a.dtype.kind == "f")
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("options", [
+    {"tau": 29, "kappa": 66, "hop_tau": 6, "hop_kappa": 17},
+    {"tau": 5, "kappa": 7, "hop_tau": 3, "hop_kappa": 11},
+    {"tau": 4, "kappa": 3, "hop_tau": 9, "hop_kappa": 1}
+])
+def test_window_peak_coordinates(monkeypatch, seed, options):
+    rng = np.random.default_rng(seed)
+    X = rng.integers(0, 3, size=(301, 211)).astype(np.float32)
+    X[rng.random(X.shape) < 0.005] = np.nan
+
+    numpy, jit = with_and_without_jit(
+        monkeypatch, window_peak_coordinates, X, **options)
+    assert_equal_results(numpy, jit)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("max_pairs_per_anchor", [None, 1, 3])
+def test_find_peak_pair_array(monkeypatch, seed, max_pairs_per_anchor):
+    rng = np.random.default_rng(seed)
+    # peaks picked from a spectrogram of few levels have many equal
+    # magnitudes to choose between
+    X = rng.integers(0, 4, size=(200, 400)).astype(np.float32)
+    peaks = pick_peaks(X, tau=4, kappa=4, hop_tau=3, hop_kappa=3)
+
+    numpy, jit = with_and_without_jit(
+        monkeypatch,
+        find_peak_pair_array,
+        peaks["freq"],
+        peaks["time"],
+        target_time_offset=2,
+        target_time_width=20,
+        target_freq_height=30,
+        max_pairs_per_anchor=max_pairs_per_anchor,
+        peak_magnitudes=peaks["magnitude"])
+    assert len(numpy) > 0
+    assert np.array_equal(numpy, jit)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("return_offsets", [False, True])
+def test_histogram_scores(monkeypatch, seed, return_offsets):
+    rng = np.random.default_rng(seed)
+    n_postings = 5000
+    # few documents and deltas, so scores and first matches tie often
+    doc_ids = rng.integers(0, 40, size=n_postings)
+    deltas = rng.integers(-20, 20, size=n_postings)
+    query_positions = rng.integers(0, 50, size=n_postings)
+
+    numpy, jit = with_and_without_jit(
+        monkeypatch,
+        score_offset_evidence,
+        doc_ids,
+        deltas,
+        query_positions,
+        return_offsets)
+    assert_equal_results(numpy, jit)
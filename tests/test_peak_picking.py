@@ -0,0 +1,63 @@
+"""
+Ben Hayes 2020
+
+ECS7006P Music Informatics
+
+Coursework 2: Audio Identification
+
+File: tests/test_peak_picking.py
+Description: Checks that pick_peaks finds exactly the constellation of the
+             original window-by-window loop, on generated spectrograms.
+"""
+import numpy as np
+import pytest
+
+from benchmark import reference_pick_peaks, peak_mask
+from fingerprint_builder import pick_peaks
+
+PEAK_PICKING_OPTIONS = [
+    {"tau": 29, "kappa": 66, "hop_tau": 6, "hop_kappa": 17},
+    {"tau": 8, "kappa": 8, "hop_tau": 4, "hop_kappa": 4},
+    {"tau": 5, "kappa": 7, "hop_tau": 3, "hop_kappa": 11},
+    {"tau": 4, "kappa": 3, "hop_tau": 9, "hop_kappa": 1},
+    {"tau": 100, "kappa": 100, "hop_tau": 100, "hop_kappa": 100}
+]
+
+
+def spectrogram(seed, shape, kind, dtype=np.float32):
+    rng = np.random.default_rng(seed)
+    if kind == "ties":
+        # a handful of levels, so most windows hold several maxima
+        X = rng.integers(0, 4, size=shape).astype(dtype)
+    elif kind == "silence":
+        X = np.zeros(shape, dtype=dtype)
+    else:
+        X = rng.random(shape).astype(dtype)
+    if kind == "nan":
+        X[rng.random(shape) < 0.01] = np.nan
+    return X
+
+
+def assert_same_peaks(X, options):
+    expected = reference_pick_peaks(X, **options) != 0
+    actual = peak_mask(pick_peaks(X, **options), X.shape)
+    assert np.array_equal(expected, actual)
+
+
+@pytest.mark.parametrize("options", PEAK_PICKING_OPTIONS)
+@pytest.mark.parametrize("kind", ["random", "ties", "nan", "silence"])
+@pytest.mark.parametrize("shape", [(257, 200), (101, 77), (16, 9)])
+def test_matches_reference(use_jit, options, kind, shape):
+    for seed in range(3):
+        assert_same_peaks(spectrogram(seed, shape, kind), options)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_matches_reference_in_double_precision(use_jit, dtype):
+    X = spectrogram(0, (1025, 150), "ties", dtype)
+    assert_same_peaks(X, PEAK_PICKING_OPTIONS[0])
+
+
+def test_window_larger_than_spectrogram(use_jit):
+    X = spectrogram(0, (20, 20), "random")
+    assert len(pick_peaks(X, tau=29, kappa=66, hop_tau=6, hop_kappa=17)) == 0